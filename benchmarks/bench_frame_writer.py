@@ -0,0 +1,60 @@
+"""Compare the wall time of a generation loop that saves frames inline vs. through AsyncFrameWriter.
+
+"Generation" is simulated with a fixed sleep per frame (standing in for the accelerator being busy),
+so with the async writer the loop time should drop to roughly `num_frames * generate_ms`, i.e. no
+longer include PNG encode/write time.
+
+    python benchmarks/bench_frame_writer.py --num_frames 60 --size 512 --generate_ms 50
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+from PIL import Image
+
+from stable_diffusion_videos.frame_writer import AsyncFrameWriter
+
+
+def _frames(num_frames, size):
+    rng = np.random.default_rng(0)
+    # Smooth-ish content so PNG compression does real work, like it does for generated images
+    base = rng.integers(0, 255, (size // 8, size // 8, 3), dtype=np.uint8)
+    base = np.asarray(Image.fromarray(base).resize((size, size), Image.BICUBIC))
+    return [Image.fromarray(np.roll(base, i, axis=1)) for i in range(num_frames)]
+
+
+def _run_sync(frames, output_dir, generate_s):
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        time.sleep(generate_s)
+        frame.save(Path(output_dir) / ("frame%06d.png" % i))
+    return time.perf_counter() - start, 0.0
+
+
+def _run_async(frames, output_dir, generate_s, num_workers, max_queue_size):
+    start = time.perf_counter()
+    writer = AsyncFrameWriter(output_dir, num_workers=num_workers, max_queue_size=max_queue_size)
+    for i, frame in enumerate(frames):
+        time.sleep(generate_s)
+        writer.write(i, frame)
+    loop_time = time.perf_counter() - start
+    writer.close()
+    return loop_time, time.perf_counter() - start - loop_time
+
+
+def main(num_frames=60, size=512, generate_ms=50, num_workers=2, max_queue_size=16):
+    frames = _frames(num_frames, size)
+    generate_s = generate_ms / 1000
+    print(f"{'mode':<8} {'loop (s)':>10} {'final flush (s)':>16}")
+    with tempfile.TemporaryDirectory() as sync_dir, tempfile.TemporaryDirectory() as async_dir:
+        loop_time, flush_time = _run_sync(frames, sync_dir, generate_s)
+        print(f"{'sync':<8} {loop_time:>10.2f} {flush_time:>16.2f}")
+        loop_time, flush_time = _run_async(frames, async_dir, generate_s, num_workers, max_queue_size)
+        print(f"{'async':<8} {loop_time:>10.2f} {flush_time:>16.2f}")
+    print(f"generation alone: {num_frames * generate_s:.2f}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
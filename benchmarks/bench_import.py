@@ -0,0 +1,42 @@
+"""Measure how long it takes to import stable_diffusion_videos.
+
+Each statement is timed in a fresh interpreter, with the interpreter's own startup time subtracted.
+No model weights are loaded by any of these. Importing the package itself takes milliseconds, but `walk`
+and `SCHEDULERS` need torch and diffusers, so they can't be faster than importing those two, which takes
+seconds on its own. That floor is printed as the first row, compare the others with it.
+
+    python benchmarks/bench_import.py --repeats 5
+"""
+import subprocess
+import sys
+import time
+
+import fire
+
+STATEMENTS = [
+    "import torch, diffusers",
+    "import stable_diffusion_videos",
+    "from stable_diffusion_videos import SCHEDULERS",
+    "from stable_diffusion_videos import walk",
+]
+
+
+def _time_statement(statement, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(repeats=5):
+    baseline = _time_statement("pass", repeats)
+    print(f"{'statement':<50} {'time (ms)':>10}")
+    for statement in STATEMENTS:
+        elapsed = _time_statement(statement, repeats) - baseline
+        print(f"{statement:<50} {elapsed * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
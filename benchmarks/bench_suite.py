@@ -0,0 +1,238 @@
+"""Benchmark the pipeline, walk and video encoding on CPU with tiny stand-in models.
+
+Every case runs in a fresh interpreter (so peak RSS is per case), is warmed up once and then timed
+`repeats` times. For each case the frames/sec of the median run, the time per stage (see
+`stable_diffusion_videos.Profiler`) and the peak RSS are reported, and compared with the stored
+baseline. The script exits with status 1 if any case got slower or bigger than `tolerance` allows.
+
+    python benchmarks/bench_suite.py                      # all cases, compared with benchmarks/baseline.json
+    python benchmarks/bench_suite.py --cases walk_b1,walk_b4
+    python benchmarks/bench_suite.py --update_baseline    # after an intended change, or on a new machine
+
+The tiny models make absolute numbers meaningless compared to a real checkpoint on a GPU, but the
+overheads around the models (scheduling, batching, decoding, writing frames) are all there, so
+relative changes show up. Baselines are machine specific: record one per CI box type.
+"""
+import json
+import os
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+
+BENCHMARK_DIR = Path(__file__).resolve().parent
+DEFAULT_BASELINE = BENCHMARK_DIR / "baseline.json"
+
+# The tiny stand-in models live with the tests
+sys.path.insert(0, str(BENCHMARK_DIR.parent / "tests"))
+
+WALK_KWARGS = dict(
+    prompts=["a cat", "a dog", "a bird"],
+    seeds=[1, 2, 3],
+    num_steps=8,
+    height=64,
+    width=64,
+    num_inference_steps=4,
+    disable_tqdm=True,
+)
+
+CASES = {
+    "pipeline_b1": dict(kind="pipeline", batch_size=1),
+    "pipeline_b4": dict(kind="pipeline", batch_size=4),
+    "walk_b1": dict(kind="walk", batch_size=1, latent_interpolation_steps=0),
+    "walk_b4": dict(kind="walk", batch_size=4, latent_interpolation_steps=0),
+    "walk_interp_b4": dict(kind="walk", batch_size=4, latent_interpolation_steps=4),
+    "walk_strength_b4": dict(kind="walk", batch_size=4, latent_interpolation_steps=4, strength=0.7, scheduler="ddim"),
+    "walk_upsample_b4": dict(kind="walk", batch_size=4, latent_interpolation_steps=0, upsample=True),
+    "make_video": dict(kind="make_video", num_frames=48, num_workers=1),
+    "make_video_parallel": dict(kind="make_video", num_frames=48, num_workers=4, gop_size=12, segment_frames=12),
+}
+
+
+def _pipeline_case(pipeline, batch_size):
+    def run(output_dir):
+        pipeline.set_progress_bar_config(disable=True)
+        pipeline(["a cat"] * batch_size, height=64, width=64, num_inference_steps=4)
+        return batch_size
+
+    return run
+
+
+def _walk_case(pipeline, upsample=False, **kwargs):
+    from stable_diffusion_videos import walk
+    from tiny_models import NearestUpsampler
+
+    def run(output_dir):
+        walk(
+            pipeline=pipeline,
+            output_dir=output_dir,
+            name="run",
+            upsample=upsample,
+            upsampling_pipeline=NearestUpsampler() if upsample else None,
+            **WALK_KWARGS,
+            **kwargs,
+        )
+        return len(list((Path(output_dir) / "run").glob("frame*.png")))
+
+    return run
+
+
+def _make_video_case(num_frames, **kwargs):
+    import numpy as np
+    from PIL import Image
+
+    from stable_diffusion_videos.stable_diffusion_walk import make_video_ffmpeg
+
+    frame_dir = Path(tempfile.mkdtemp(prefix="bench_frames_"))
+    rng = np.random.default_rng(0)
+    for i in range(num_frames):
+        Image.fromarray(rng.integers(0, 255, (256, 256, 3), dtype=np.uint8)).save(frame_dir / ("frame%06d.png" % i))
+
+    def run(output_dir):
+        make_video_ffmpeg(frame_dir, str(Path(output_dir).resolve() / "video.mp4"), **kwargs)
+        return num_frames
+
+    return run
+
+
+def run_case(name, repeats=3):
+    """Run a single case in this process and return its results."""
+    import torch
+
+    from stable_diffusion_videos import Profiler
+    from tiny_models import tiny_pipeline
+
+    case = dict(CASES[name])
+    kind = case.pop("kind")
+    if kind == "make_video":
+        if shutil.which("ffmpeg") is None:
+            return dict(skipped="ffmpeg not found")
+        run = _make_video_case(**case)
+    elif kind == "pipeline":
+        run = _pipeline_case(tiny_pipeline(), **case)
+    else:
+        run = _walk_case(tiny_pipeline(), **case)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        run(output_dir)  # warmup
+        timings, num_frames = [], 0
+        profiler = Profiler(synchronize=False)
+        with profiler.activate(), torch.no_grad():
+            for _ in range(repeats):
+                with tempfile.TemporaryDirectory() as run_dir:
+                    start = time.perf_counter()
+                    num_frames = run(run_dir)
+                    timings.append(time.perf_counter() - start)
+
+    median = statistics.median(timings)
+    return dict(
+        frames=num_frames,
+        seconds=median,
+        fps=num_frames / median,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        stages={stage: stats["total_s"] / repeats for stage, stats in profiler.summary().items()},
+    )
+
+
+def _run_case_subprocess(name, repeats, num_threads):
+    # The package is imported from this checkout, whether or not it's installed
+    python_path = os.pathsep.join(filter(None, [str(BENCHMARK_DIR.parent), os.environ.get("PYTHONPATH")]))
+    env = dict(os.environ, PYTHONPATH=python_path, OMP_NUM_THREADS=str(num_threads), MKL_NUM_THREADS=str(num_threads))
+    process = subprocess.run(
+        [sys.executable, __file__, "--case", name, "--repeats", str(repeats)],
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Benchmark case {name} failed:\n{process.stderr}")
+    # The case's own output (progress prints etc.) comes first, the results are on the last line
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def _regressions(name, result, baseline, tolerance):
+    if name not in baseline or "skipped" in result or "skipped" in baseline[name]:
+        return []
+    base, found = baseline[name], []
+    if result["fps"] < base["fps"] * (1 - tolerance):
+        found.append(f"{name}: {result['fps']:.2f} frames/s, baseline {base['fps']:.2f}")
+    if result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance):
+        found.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB, baseline {base['peak_rss_mb']:.0f} MB")
+    return found
+
+
+def main(
+    cases=None,
+    case=None,
+    repeats=3,
+    num_threads=1,
+    baseline=str(DEFAULT_BASELINE),
+    update_baseline=False,
+    tolerance=0.3,
+    output=None,
+):
+    """Run the benchmark suite.
+
+    Args:
+        cases (Union[str, List[str]], optional): Names of the cases to run. Defaults to all of them.
+        case (str, optional): Run only this case in-process and print its results as JSON. Used internally.
+        repeats (int, optional): Number of timed runs per case. Defaults to 3.
+        num_threads (int, optional): Number of CPU threads each case may use. Defaults to 1, which gives the most
+            stable numbers.
+        baseline (str, optional): Path of the baseline results. Defaults to benchmarks/baseline.json.
+        update_baseline (bool, optional): Store the results as the new baseline instead of comparing. Defaults to False.
+        tolerance (float, optional): Relative slowdown in frames/sec or growth in peak RSS tolerated before a
+            case counts as a regression. Defaults to 0.3.
+        output (str, optional): Also write the results to this JSON file. Defaults to None.
+    """
+    if case is not None:
+        print(json.dumps(run_case(case, repeats)))
+        return
+
+    if cases is None:
+        names = list(CASES)
+    else:
+        names = cases.split(",") if isinstance(cases, str) else list(cases)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        raise ValueError(f"Unknown benchmark cases {unknown}, choose from {list(CASES)}")
+
+    baseline_path = Path(baseline)
+    baseline_results = json.loads(baseline_path.read_text()) if baseline_path.is_file() else {}
+
+    results, regressions = {}, []
+    print(f"{'case':<20} {'frames/s':>10} {'baseline':>10} {'peak RSS (MB)':>14}  slowest stages")
+    for name in names:
+        result = results[name] = _run_case_subprocess(name, repeats, num_threads)
+        if "skipped" in result:
+            print(f"{name:<20} skipped: {result['skipped']}")
+            continue
+        base_fps = baseline_results.get(name, {}).get("fps")
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in list(result["stages"].items())[:3])
+        print(
+            f"{name:<20} {result['fps']:>10.2f} {base_fps if base_fps is not None else float('nan'):>10.2f}"
+            f" {result['peak_rss_mb']:>14.0f}  {stages}"
+        )
+        regressions += _regressions(name, result, baseline_results, tolerance)
+
+    if output is not None:
+        Path(output).write_text(json.dumps(results, indent=2))
+
+    if update_baseline:
+        baseline_path.write_text(json.dumps(dict(baseline_results, **results), indent=2) + "\n")
+        print(f"Baseline written to {baseline_path}")
+        return
+
+    if regressions:
+        print("\nRegressions (tolerance {:.0%}):\n  ".format(tolerance) + "\n  ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
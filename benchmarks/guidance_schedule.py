@@ -0,0 +1,110 @@
+"""Count the UNet FLOPs per frame of classifier free guidance schedules.
+
+Every schedule generates the same images, with the same seeds, from pure noise. The UNet FLOPs are counted
+with `torch.utils.flop_counter`, and each schedule's images are compared with those of guiding every step
+(mean absolute pixel difference).
+
+    python benchmarks/guidance_schedule.py                                  # tiny stand-in models on the CPU
+    python benchmarks/guidance_schedule.py --tiny False --height 512 --width 512 --num_inference_steps 50
+
+FLOPs per frame don't depend on the weights, so the tiny models already give the relative savings. The image
+differences are only meaningful with a real checkpoint.
+"""
+import sys
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+
+# The tiny stand-in models live with the tests
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+
+SCHEDULES = {
+    "every step": dict(),
+    "interval 0.0-0.8": dict(guidance_interval=(0.0, 0.8)),
+    "interval 0.2-0.8": dict(guidance_interval=(0.2, 0.8)),
+    "every 2nd step": dict(guidance_every=2),
+    "every 3rd step": dict(guidance_every=3),
+    "0.0-0.8, every 2nd": dict(guidance_interval=(0.0, 0.8), guidance_every=2),
+}
+
+
+def main(
+    tiny=True,
+    num_images=4,
+    height=64,
+    width=64,
+    num_inference_steps=10,
+    guidance_scale=7.5,
+    scheduler="klms",
+    device=None,
+):
+    """Run the benchmark.
+
+    Args:
+        tiny (bool, optional): Use tiny randomly initialised models instead of the default checkpoint. Defaults to True.
+        num_images (int, optional): Number of images generated per schedule, in one batch. Defaults to 4.
+        height (int, optional): Height of the images. Defaults to 64.
+        width (int, optional): Width of the images. Defaults to 64.
+        num_inference_steps (int, optional): Number of denoising steps. Defaults to 10.
+        guidance_scale (float, optional): Classifier free guidance scale. Defaults to 7.5.
+        scheduler (str, optional): Scheduler, one of "default", "ddim" and "klms". Defaults to "klms".
+        device (str, optional): Device to run on. Defaults to the GPU if there is one.
+    """
+    from stable_diffusion_videos import get_pipeline
+    from stable_diffusion_videos.stable_diffusion_pipeline import autocast
+    from stable_diffusion_videos.stable_diffusion_walk import SCHEDULERS
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if tiny:
+        from tiny_models import tiny_pipeline
+
+        pipeline = tiny_pipeline(device=device)
+    else:
+        pipeline = get_pipeline(device=device)
+    pipeline.set_progress_bar_config(disable=True)
+    prompts = [f"prompt {i}" for i in range(num_images)]
+    latents = torch.randn(
+        (num_images, pipeline.unet.in_channels, height // 8, width // 8),
+        generator=torch.Generator(device=pipeline.device).manual_seed(0),
+        device=pipeline.device,
+    )
+
+    def generate(**schedule):
+        with autocast(pipeline.device):
+            return pipeline(
+                prompts,
+                latents=latents,
+                height=height,
+                width=width,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                scheduler=SCHEDULERS[scheduler],
+                output_type="numpy",
+                **schedule,
+            )["sample"]
+
+    generate()  # warmup
+    rows = []
+    for name, schedule in SCHEDULES.items():
+        with FlopCounterMode(display=False) as flop_counter:
+            start = time.perf_counter()
+            images = generate(**schedule)
+            seconds = time.perf_counter() - start
+        unet_flops = sum(flop_counter.get_flop_counts().get(type(pipeline.unet).__name__, {}).values())
+        rows.append((name, unet_flops / num_images, seconds, images))
+
+    full_flops, full_images = rows[0][1], rows[0][3]
+    print(f"{num_images} images of {height}x{width}, {num_inference_steps} {scheduler} steps, guidance scale {guidance_scale}")
+    print(f"{'schedule':<20} {'UNet GFLOPs/frame':>18} {'saved':>7} {'seconds':>8} {'mean abs diff':>14}")
+    for name, flops, seconds, images in rows:
+        error = float(np.abs(images - full_images).mean())
+        print(f"{name:<20} {flops / 1e9:>18.3f} {1 - flops / full_flops:>7.1%} {seconds:>8.2f} {error:>14.4f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
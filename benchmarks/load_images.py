@@ -0,0 +1,127 @@
+"""Load test the image endpoint with concurrent clients, with and without request batching.
+
+Each of `clients` threads sends `requests` image requests one after the other, as the app's users would.
+They're served once by calling the pipeline directly (one image per call, as the app did before batching)
+and once through an `ImageRequestBatcher`. Throughput, latency percentiles and the batch sizes the batcher
+ended up with are printed.
+
+    python benchmarks/load_images.py                                  # tiny stand-in models on the CPU
+    python benchmarks/load_images.py --clients 16 --max_batch_size 8 --tiny False --height 512 --width 512
+
+With the tiny models the UNet is so cheap that batching mostly saves Python overhead; on a GPU with a real
+checkpoint the gain comes from running the UNet on bigger batches.
+"""
+import statistics
+import sys
+import threading
+import time
+from pathlib import Path
+
+import fire
+import torch
+
+# The tiny stand-in models live with the tests
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _load(generate, clients, requests):
+    latencies, errors = [], []
+
+    def client(index):
+        for i in range(requests):
+            start = time.perf_counter()
+            try:
+                generate(f"prompt {index}", seed=index * requests + i)
+            except Exception as e:
+                errors.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+    return dict(
+        requests_per_s=len(latencies) / elapsed,
+        p50_s=statistics.median(latencies),
+        p95_s=_percentile(latencies, 0.95),
+    )
+
+
+def main(
+    clients=8,
+    requests=4,
+    max_batch_size=8,
+    max_wait_ms=50,
+    tiny=True,
+    height=64,
+    width=64,
+    num_inference_steps=4,
+    guidance_scale=7.5,
+    device=None,
+):
+    """Run the load test.
+
+    Args:
+        clients (int, optional): Number of concurrent clients. Defaults to 8.
+        requests (int, optional): Number of requests each client sends. Defaults to 4.
+        max_batch_size (int, optional): `max_batch_size` of the batcher. Defaults to 8.
+        max_wait_ms (float, optional): `max_wait_ms` of the batcher. Defaults to 50.
+        tiny (bool, optional): Use tiny randomly initialised models instead of the default checkpoint. Defaults to True.
+        height (int, optional): Height of the images. Defaults to 64.
+        width (int, optional): Width of the images. Defaults to 64.
+        num_inference_steps (int, optional): Number of denoising steps. Defaults to 4.
+        guidance_scale (float, optional): Classifier free guidance scale. Defaults to 7.5.
+        device (str, optional): Device to run on. Defaults to the GPU if there is one.
+    """
+    from stable_diffusion_videos import ImageRequestBatcher, get_pipeline
+    from stable_diffusion_videos.stable_diffusion_pipeline import autocast
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if tiny:
+        from tiny_models import tiny_pipeline
+
+        pipeline = tiny_pipeline(device=device)
+    else:
+        pipeline = get_pipeline(device=device)
+    pipeline.set_progress_bar_config(disable=True)
+    settings = dict(height=height, width=width, num_inference_steps=num_inference_steps, guidance_scale=guidance_scale)
+
+    def direct(prompt, seed):
+        with autocast(pipeline.device):
+            return pipeline(
+                prompt, generator=torch.Generator(device=pipeline.device).manual_seed(seed), **settings
+            )["sample"][0]
+
+    batcher = ImageRequestBatcher(pipeline, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    def batched(prompt, seed):
+        return batcher(prompt, seed=seed, **settings)
+
+    direct("warmup", 0)
+    batched("warmup", 0)
+    batcher.batch_sizes.clear()
+
+    results = {"direct": _load(direct, clients, requests), "batched": _load(batched, clients, requests)}
+    batcher.close()
+
+    print(f"{clients} clients x {requests} requests, max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms}")
+    print(f"{'mode':<10} {'req/s':>8} {'p50 (s)':>9} {'p95 (s)':>9}")
+    for mode, result in results.items():
+        print(f"{mode:<10} {result['requests_per_s']:>8.2f} {result['p50_s']:>9.3f} {result['p95_s']:>9.3f}")
+    sizes = batcher.batch_sizes
+    print(f"batches: {len(sizes)}, mean size {sum(sizes) / len(sizes):.1f}, largest {max(sizes)}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,124 @@
+"""Compare warm started in-between frames with generating every frame from noise.
+
+A walk with `num_steps` keyframes and `latent_interpolation_steps` frames per pair of keyframes is rendered
+with plain latent interpolation and with each `warm_start` fraction. Their in-between frames are compared with
+a full render: a walk whose keyframes fall on every one of those frames, without interpolation. For each mode
+the wall time, the number of UNet passes (in keyframe equivalents) and the mean absolute pixel difference and
+PSNR to the full render are printed.
+
+    python benchmarks/warm_start.py                                         # tiny stand-in models on the CPU
+    python benchmarks/warm_start.py --tiny False --height 512 --width 512 --num_inference_steps 50
+
+The tiny models output noise, so their numbers only show that the modes run. With a real checkpoint the
+difference to the full render shrinks as `warm_start` goes down, while the cost goes up.
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+import torch
+from PIL import Image
+
+# The tiny stand-in models live with the tests
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "tests"))
+
+
+def _frames(run_dir):
+    return [np.asarray(Image.open(path), dtype=np.float64) / 255 for path in sorted(Path(run_dir).glob("frame*.png"))]
+
+
+def main(
+    warm_starts=(0.25, 0.5, 0.75),
+    num_steps=3,
+    latent_interpolation_steps=4,
+    tiny=True,
+    height=64,
+    width=64,
+    num_inference_steps=10,
+    scheduler="ddim",
+    batch_size=4,
+    device=None,
+):
+    """Run the comparison.
+
+    Args:
+        warm_starts (List[float], optional): `warm_start` fractions to compare. Defaults to (0.25, 0.5, 0.75).
+        num_steps (int, optional): Number of keyframes of the walk. Defaults to 3.
+        latent_interpolation_steps (int, optional): Frames per pair of keyframes. Defaults to 4.
+        tiny (bool, optional): Use tiny randomly initialised models instead of the default checkpoint. Defaults to True.
+        height (int, optional): Height of the frames. Defaults to 64.
+        width (int, optional): Width of the frames. Defaults to 64.
+        num_inference_steps (int, optional): Number of denoising steps. Defaults to 10.
+        scheduler (str, optional): Scheduler of the walks. Defaults to "ddim".
+        batch_size (int, optional): Batch size of the walks. Defaults to 4.
+        device (str, optional): Device to run on. Defaults to the GPU if there is one.
+    """
+    from stable_diffusion_videos import get_pipeline, walk
+    from stable_diffusion_videos.sampling import get_sampling_plan
+    from stable_diffusion_videos.stable_diffusion_walk import SCHEDULERS
+
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if tiny:
+        from tiny_models import tiny_pipeline
+
+        pipeline = tiny_pipeline(device=device)
+    else:
+        pipeline = get_pipeline(device=device)
+    settings = dict(
+        prompts=["a cat", "a dog"],
+        seeds=[1, 2],
+        height=height,
+        width=width,
+        num_inference_steps=num_inference_steps,
+        scheduler=scheduler,
+        batch_size=batch_size,
+        pipeline=pipeline,
+        disable_tqdm=True,
+        save_latents=False,
+    )
+    if isinstance(warm_starts, (int, float)):
+        warm_starts = [warm_starts]
+    num_timesteps = len(get_sampling_plan(SCHEDULERS[scheduler], num_inference_steps).timesteps)
+    per_pair = latent_interpolation_steps - 1
+
+    def run(**kwargs):
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            walk(output_dir=output_dir, name="run", **settings, **kwargs)
+            seconds = time.perf_counter() - start
+            return seconds, _frames(Path(output_dir) / "run")
+
+    # The full render's keyframes are at the in-between frames' positions, every `latent_interpolation_steps`-th
+    # one is at a keyframe of the interpolated walks
+    full_seconds, full_frames = run(
+        num_steps=(num_steps - 1) * latent_interpolation_steps + 1, latent_interpolation_steps=0
+    )
+    reference = [
+        full_frames[pair * latent_interpolation_steps + i] for pair in range(num_steps - 1) for i in range(1, per_pair + 1)
+    ]
+
+    rows = [("full render", full_seconds, len(full_frames), 0.0, float("inf"))]
+    for warm_start in [None] + list(warm_starts):
+        seconds, frames = run(num_steps=num_steps, latent_interpolation_steps=latent_interpolation_steps, warm_start=warm_start)
+        unet_passes = num_steps
+        if warm_start is not None:
+            step = min(max(int(round(warm_start * num_timesteps)), 1), num_timesteps - 1)
+            unet_passes += len(frames) * (num_timesteps - step) / num_timesteps
+        error = float(np.mean([np.abs(a - b).mean() for a, b in zip(frames, reference)]))
+        mse = float(np.mean([((a - b) ** 2).mean() for a, b in zip(frames, reference)]))
+        psnr = 10 * np.log10(1 / mse) if mse > 0 else float("inf")
+        name = "interpolation" if warm_start is None else f"warm_start={warm_start}"
+        rows.append((name, seconds, unet_passes, error, psnr))
+
+    print(f"{num_steps} keyframes, {per_pair} in-between frames per pair, {num_inference_steps} {scheduler} steps")
+    print(f"{'mode':<18} {'seconds':>8} {'UNet passes':>12} {'mean abs diff':>14} {'PSNR (dB)':>10}")
+    for name, seconds, unet_passes, error, psnr in rows:
+        print(f"{name:<18} {seconds:>8.2f} {unet_passes:>12.1f} {error:>14.4f} {psnr:>10.2f}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -104,6 +104,7 @@ __getattr__, __dir__, __all__ = _attach(
         "commands.user": ["notebook_login"],
         "app": [
             "interface",
+            "make_interface",
         ],
         "stable_diffusion_pipeline": [
             "StableDiffusionPipeline",
@@ -111,9 +112,42 @@ __getattr__, __dir__, __all__ = _attach(
         ],
         "stable_diffusion_walk": [
             "walk",
+            "rerender",
             "SCHEDULERS",
             "pipeline",
         ],
+        "embedding_cache": [
+            "TextEmbeddingCache",
+        ],
+        "registry": [
+            "get_pipeline",
+            "get_upsampler",
+            "model_cache",
+        ],
+        "profiling": [
+            "Profiler",
+        ],
+        "sharding": [
+            "walk_sharded",
+        ],
+        "batching": [
+            "ImageRequestBatcher",
+        ],
+        "batch_sizing": [
+            "MemoryPolicy",
+            "calibrate_batch_size",
+        ],
+        "adaptive": [
+            "walk_adaptive",
+        ],
+        "seed_sweep": [
+            "sweep_seeds",
+            "choose_seeds",
+        ],
+        "video_encoding": [
+            "encode_video_segmented",
+            "VideoEncodingError",
+        ],
         "upsampling": [
             "PipelineRealESRGAN"
         ]
@@ -0,0 +1,301 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from .frame_writer import AsyncFrameWriter
+from .interpolation import lerp, slerp
+from .latent_store import KeyframeLatentStore
+from .profiling import get_profiler
+from .registry import DEFAULT_MODEL_ID, get_pipeline, get_upsampler
+from .stable_diffusion_pipeline import autocast
+from .stable_diffusion_walk import (
+    SCHEDULERS,
+    _upsample_images,
+    _upsamples_on_device,
+    _write_latent_frames,
+    make_video_ffmpeg,
+)
+
+
+def frame_distance(a, b, metric="pixel"):
+    """Cheap distance between two rendered keyframes.
+
+    Args:
+        a (dict): Keyframe with a `"thumbnail"` (downscaled image in [0, 1]) and a `"latent"`.
+        b (dict): The other keyframe.
+        metric (str, optional): "pixel" for the mean absolute difference of the thumbnails, i.e. the average
+            change of a pixel's color on a [0, 1] scale, or "latent" for the mean absolute difference of the
+            latents relative to their mean magnitude. Defaults to "pixel".
+
+    Returns:
+        float: The distance.
+    """
+    if metric == "pixel":
+        return (a["thumbnail"] - b["thumbnail"]).abs().mean().item()
+    if metric == "latent":
+        scale = (a["latent"].abs().mean() + b["latent"].abs().mean()) / 2
+        return ((a["latent"] - b["latent"]).abs().mean() / scale).item()
+    raise ValueError(f"Unknown distance metric {metric!r}, choose from 'pixel' and 'latent'")
+
+
+def walk_adaptive(
+    prompts=["blueberry spaghetti", "strawberry spaghetti"],
+    seeds=[42, 123],
+    num_steps=60,
+    initial_steps=5,
+    threshold=0.02,
+    distance="pixel",
+    output_dir="dreams",
+    name="berry_good_spaghetti",
+    height=512,
+    width=512,
+    guidance_scale=7.5,
+    eta=0.0,
+    num_inference_steps=50,
+    do_loop=False,
+    make_video=False,
+    use_lerp_for_text=True,
+    scheduler="klms",
+    disable_tqdm=False,
+    upsample=False,
+    fps=30,
+    batch_size=1,
+    frame_filename_ext=".png",
+    latent_interpolation_steps=20,
+    pipeline=None,
+    device=None,
+    upsampling_pipeline=None,
+    decode_chunk_size=None,
+    encode_kwargs=None,
+):
+    """Like `walk`, but places the keyframes where the video changes, instead of evenly.
+
+    Each segment starts with `initial_steps` evenly spaced keyframes. Then, while any two neighbouring keyframes
+    are further apart than `threshold` (see `frame_distance`), a keyframe is added halfway between the furthest
+    ones, `batch_size` at a time, until every segment's keyframes are close enough or the walk has used up
+    `num_steps` keyframes per segment. Stretches where little happens get few UNet passes, abrupt changes get
+    many.
+
+    The output is retimed so it plays smoothly: with `latent_interpolation_steps`, each pair of keyframes gets
+    in-between frames in proportion to its distance (on average `latent_interpolation_steps`), so every frame
+    changes about as much as the last. Without interpolation the keyframes are the frames; as neighbouring
+    keyframes end up about equally far apart, they play smoothly at a fixed frame rate.
+
+    Every keyframe's denoised latent is saved to `keyframe_latents.npy` in the run directory as soon as it's
+    generated, in the order they were generated. The in-between frames are interpolated, decoded and written a
+    pair of keyframes at a time once the keyframes are placed, so only one pair's latents are in memory at once.
+
+    An `adaptive_report.json` in the run directory lists every keyframe's position, its `latent_index` in
+    `keyframe_latents.npy`, its distance to the next one and number of frames, and how many keyframes an even
+    spacing as fine as the finest one used would take.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import walk_adaptive
+        >>> walk_adaptive(['a cat', 'a dog'], [42, 1337], num_steps=60, threshold=0.02, make_video=True)
+        ```
+
+    Args:
+        prompts (List[str], optional): Prompts to walk between.
+        seeds (List[int], optional): Random seed of each prompt.
+        num_steps (int, optional): Maximum number of keyframes per segment, on average. Defaults to 60.
+        initial_steps (int, optional): Number of evenly spaced keyframes each segment starts with. Defaults to 5.
+        threshold (float, optional): Neighbouring keyframes further apart than this are split. 0 spends the whole
+            `num_steps` budget. Defaults to 0.02.
+        distance (str, optional): Distance metric, "pixel" or "latent", see `frame_distance`. Defaults to "pixel".
+        output_dir (str, optional): Root dir where images will be saved. Defaults to "dreams".
+        name (str, optional): Sub directory of output_dir to save this run's files. Defaults to "berry_good_spaghetti".
+        height (int, optional): Height of image to generate. Defaults to 512.
+        width (int, optional): Width of image to generate. Defaults to 512.
+        guidance_scale (float, optional): Higher = more adherance to prompt. Defaults to 7.5.
+        eta (float, optional): ETA. Defaults to 0.0.
+        num_inference_steps (int, optional): Number of diffusion steps. Defaults to 50.
+        do_loop (bool, optional): Whether to loop from last prompt back to first. Defaults to False.
+        make_video (bool, optional): Whether to make a video or just save the images. Defaults to False.
+        use_lerp_for_text (bool, optional): Use LERP instead of SLERP for text embeddings when walking. Defaults to True.
+        scheduler (str, optional): Which scheduler to use. Defaults to "klms". Choices are "default", "ddim", "klms".
+        disable_tqdm (bool, optional): Whether to turn off the tqdm progress bars. Defaults to False.
+        upsample (bool, optional): If True, uses Real-ESRGAN to upsample images 4x. Defaults to False.
+        fps (int, optional): The frames per second of the video. Defaults to 30.
+        batch_size (int, optional): Number of keyframes generated per pipeline call. Defaults to 1.
+        frame_filename_ext (str, optional): File extension of the saved frames. Defaults to ".png".
+        latent_interpolation_steps (int, optional): Average number of frames decoded per pair of keyframes, 0 to
+            save the keyframes themselves. Defaults to 20.
+        pipeline (StableDiffusionPipeline, optional): Pipeline to generate with. Defaults to the pipeline
+            returned by `get_pipeline(device=device)`.
+        device (Union[str, torch.device], optional): Device to load the default pipeline on when `pipeline` is not given.
+        upsampling_pipeline (Callable, optional): Upsampler used when `upsample=True`. Defaults to the shared `get_upsampler()`.
+        decode_chunk_size (int, optional): Number of in-between latents decoded per VAE call. Defaults to as many as
+            fit in available memory.
+        encode_kwargs (dict, optional): Arguments of `encode_video_segmented` to make the video with, e.g.
+            `dict(segment_frames=500, num_workers=4)`. Defaults to None.
+
+    Returns:
+        str: Path to video file saved if make_video=True, else None.
+    """
+    if pipeline is None:
+        pipeline = get_pipeline(DEFAULT_MODEL_ID, device=device)
+    if upsample and upsampling_pipeline is None:
+        upsampling_pipeline = get_upsampler()
+    if not 2 <= initial_steps <= num_steps:
+        raise ValueError(f"`initial_steps` has to be in [2, num_steps] but is {initial_steps}")
+    assert len(prompts) == len(seeds)
+    pipeline.set_progress_bar_config(disable=disable_tqdm)
+
+    if do_loop:
+        prompts = prompts + prompts[:1]
+        seeds = seeds + seeds[:1]
+    num_segments = len(prompts) - 1
+    budget = num_segments * (num_steps - 1) + 1
+
+    output_path = Path(output_dir) / name
+    output_path.mkdir(exist_ok=True, parents=True)
+    latent_store = KeyframeLatentStore(
+        output_path, budget, (pipeline.unet.in_channels, height // 8, width // 8), create=True
+    )
+    # Without interpolation the keyframes are the frames. They're saved as they're generated and numbered in
+    # walk order at the end.
+    keyframes_path = output_path / "keyframes"
+    if not latent_interpolation_steps:
+        keyframes_path.mkdir(exist_ok=True)
+
+    def noise(seed):
+        return torch.randn(
+            (1, pipeline.unet.in_channels, height // 8, width // 8),
+            device=pipeline.device,
+            generator=torch.Generator(device=pipeline.device).manual_seed(seed),
+        )
+
+    embeds = [pipeline.embed_text(prompt) for prompt in prompts]
+    noises = [noise(seed) for seed in seeds]
+    interpolate_text = lerp if use_lerp_for_text else slerp
+
+    # Keyframes sit at positions u in [0, num_segments]: segment floor(u), t = u - floor(u). Each segment
+    # boundary is a single keyframe, shared by the segments on either side.
+    keyframes = {}
+    key_writer = AsyncFrameWriter(keyframes_path, frame_filename=f"key%06d{frame_filename_ext}")
+    thumbnail_factor = max(min(height, width) // 64, 1)
+
+    def generate(positions):
+        segments = [min(int(u), num_segments - 1) for u in positions]
+        ts = [u - segment for u, segment in zip(positions, segments)]
+        embeds_batch = torch.cat(
+            [interpolate_text(t, embeds[s], embeds[s + 1]).reshape(embeds[s].shape) for s, t in zip(segments, ts)]
+        )
+        latents_batch = torch.cat([slerp(t, noises[s], noises[s + 1]).reshape(noises[s].shape) for s, t in zip(segments, ts)])
+        with autocast(pipeline.device):
+            outputs = pipeline(
+                latents=latents_batch,
+                text_embeddings=embeds_batch,
+                height=height,
+                width=width,
+                guidance_scale=guidance_scale,
+                eta=eta,
+                num_inference_steps=num_inference_steps,
+                output_type="pt",
+                scheduler=SCHEDULERS[scheduler],
+            )
+        samples = outputs["sample"]
+        thumbnails = F.avg_pool2d(samples.float(), thumbnail_factor)
+        if latent_interpolation_steps:
+            images = [None] * len(positions)
+        elif upsample:
+            on_device = _upsamples_on_device(upsampling_pipeline)
+            images = _upsample_images(upsampling_pipeline, samples if on_device else samples.cpu().permute(0, 2, 3, 1).numpy())
+        else:
+            images = list(samples.mul(255).round_().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy())
+        latent_store.write(len(keyframes), outputs["latent"])
+        for row, (u, image) in enumerate(zip(positions, images)):
+            index = len(keyframes)
+            if image is not None:
+                key_writer.write(index, image)
+            # Latents are read back from the store, only the latent distance needs them at hand
+            latent = outputs["latent"][row : row + 1] if distance == "latent" else None
+            keyframes[u] = dict(index=index, latent=latent, thumbnail=thumbnails[row])
+
+    def batched(positions):
+        for start in range(0, len(positions), batch_size):
+            generate(positions[start : start + batch_size])
+
+    # Start evenly spaced, then split the pairs of neighbours that are furthest apart
+    batched(sorted({float(u) for u in np.linspace(0, num_segments, num_segments * (initial_steps - 1) + 1)}))
+    distances = {}
+    while len(keyframes) < budget:
+        positions = sorted(keyframes)
+        for pair in zip(positions, positions[1:]):
+            if pair not in distances:
+                distances[pair] = frame_distance(keyframes[pair[0]], keyframes[pair[1]], distance)
+        too_far = sorted(
+            (pair for pair in zip(positions, positions[1:]) if distances[pair] > threshold),
+            key=lambda pair: distances[pair],
+            reverse=True,
+        )
+        if not too_far:
+            break
+        with get_profiler().stage("adaptive_refine", num_pairs=len(too_far)):
+            batched(sorted((a + b) / 2 for a, b in too_far[: min(batch_size, budget - len(keyframes))]))
+
+    positions = sorted(keyframes)
+    pair_distances = [
+        distances[pair] if pair in distances else frame_distance(keyframes[pair[0]], keyframes[pair[1]], distance)
+        for pair in zip(positions, positions[1:])
+    ]
+    key_writer.close()
+    latent_store.flush()
+
+    # Retime: pairs get frames in proportion to how far apart they are
+    frame_filename = f"frame%06d{frame_filename_ext}"
+    if latent_interpolation_steps:
+        mean_distance = max(float(np.mean(pair_distances)), 1e-8)
+        steps = [max(2, round(latent_interpolation_steps * d / mean_distance)) for d in pair_distances]
+        def read_latent(u):
+            index = keyframes[u]["index"]
+            return latent_store.read(index, index + 1, device=pipeline.device)
+
+        frame_index = 0
+        with AsyncFrameWriter(output_path, frame_filename=frame_filename) as frame_writer, autocast(pipeline.device):
+            end = read_latent(positions[0])
+            for u, n in zip(positions[1:], steps):
+                start, end = end, read_latent(u)
+                with get_profiler().stage("interpolate_frames"):
+                    in_between = torch.cat([torch.lerp(start, end, i / n) for i in range(1, n)])
+                frame_index = _write_latent_frames(
+                    pipeline,
+                    in_between,
+                    frame_writer,
+                    frame_index,
+                    upsampling_pipeline=upsampling_pipeline if upsample else None,
+                    decode_chunk_size=decode_chunk_size,
+                )
+        frames_per_pair = [n - 1 for n in steps]
+    else:
+        for frame_index, u in enumerate(positions):
+            key_path = keyframes_path / (f"key%06d{frame_filename_ext}" % keyframes[u]["index"])
+            os.replace(key_path, output_path / (frame_filename % frame_index))
+        keyframes_path.rmdir()
+        frames_per_pair = [1] * len(pair_distances)
+
+    finest = min(b - a for a, b in zip(positions, positions[1:]))
+    report = dict(
+        unet_keyframes=len(keyframes),
+        budget=budget,
+        even_spacing_keyframes=int(round(num_segments / finest)) + 1,
+        frames=sum(frames_per_pair) if latent_interpolation_steps else len(positions),
+        keyframes=[
+            dict(position=u, segment=min(int(u), num_segments - 1), t=u - min(int(u), num_segments - 1),
+                 latent_index=keyframes[u]["index"], distance_to_next=d, frames_to_next=n)
+            for u, d, n in zip(positions, pair_distances + [None], frames_per_pair + [None])
+        ],
+    )
+    (output_path / "adaptive_report.json").write_text(json.dumps(report, indent=2))
+    print(
+        f"Adaptive walk: {report['unet_keyframes']} keyframes generated (budget {budget}), an even spacing as fine"
+        f" would take {report['even_spacing_keyframes']}"
+    )
+
+    if make_video:
+        return make_video_ffmpeg(output_path, f"{name}.mp4", fps=fps, frame_filename=frame_filename, **(encode_kwargs or {}))
@@ -1,9 +1,13 @@
 import time
+from functools import partial
 
 import gradio as gr
 import torch
 
-from .stable_diffusion_walk import SCHEDULERS, pipeline, walk
+from .batching import ImageRequestBatcher
+from .registry import get_pipeline, get_upsampler
+from .stable_diffusion_pipeline import autocast
+from .stable_diffusion_walk import SCHEDULERS, walk
 
 
 def fn_images(
@@ -14,21 +18,44 @@ def fn_images(
     num_inference_steps,
     disable_tqdm,
     upsample,
+    guidance_start=0.0,
+    guidance_end=1.0,
+    guidance_every=1,
+    pipeline=None,
+    device=None,
+    batcher=None,
 ):
     if upsample:
-        from .upsampling import PipelineRealESRGAN
+        upsampling_pipeline = get_upsampler()
+    # The batcher's default pipeline is this same shared one
+    if pipeline is None:
+        pipeline = get_pipeline(device=device)
+    pipeline.set_progress_bar_config(disable=disable_tqdm)
 
-        upsampling_pipeline = PipelineRealESRGAN.from_pretrained('nateraw/real-esrgan')
+    if batcher is not None:
+        # Generated together with the other requests that come in at the same time
+        img = batcher(
+            prompt,
+            seed=seed,
+            scheduler=SCHEDULERS[scheduler],
+            guidance_scale=guidance_scale,
+            num_inference_steps=num_inference_steps,
+            output_type='pil' if not upsample else 'numpy',
+            guidance_interval=(guidance_start, guidance_end),
+            guidance_every=int(guidance_every),
+        )
+        return img if not upsample else upsampling_pipeline(img)
 
-    pipeline.set_progress_bar_config(disable=disable_tqdm)
-    pipeline.scheduler = SCHEDULERS[scheduler]  # klms, default, ddim
-    with torch.autocast("cuda"):
+    with autocast(pipeline.device):
         img = pipeline(
             prompt,
             guidance_scale=guidance_scale,
             num_inference_steps=num_inference_steps,
             generator=torch.Generator(device=pipeline.device).manual_seed(seed),
             output_type='pil' if not upsample else 'numpy',
+            scheduler=SCHEDULERS[scheduler],  # klms, default, ddim
+            guidance_interval=(guidance_start, guidance_end),
+            guidance_every=int(guidance_every),
         )["sample"][0]
         return img if not upsample else upsampling_pipeline(img)
 
@@ -47,6 +74,11 @@ def fn_videos(
     use_lerp_for_text,
     output_dir,
     upsample,
+    guidance_start=0.0,
+    guidance_end=1.0,
+    guidance_every=1,
+    pipeline=None,
+    device=None,
 ):
     prompts = [prompt_1, prompt_2]
     seeds = [seed_1, seed_2]
@@ -67,53 +99,90 @@ def fn_videos(
         name=time.strftime("%Y%m%d-%H%M%S"),
         scheduler=scheduler,
         disable_tqdm=disable_tqdm,
-        upsample=upsample
+        upsample=upsample,
+        guidance_interval=(guidance_start, guidance_end),
+        guidance_every=int(guidance_every),
+        pipeline=pipeline,
+        device=device,
     )
     return video_path
 
 
-interface_videos = gr.Interface(
-    fn_videos,
-    inputs=[
-        gr.Textbox("blueberry spaghetti"),
-        gr.Number(42, label='Seed 1', precision=0),
-        gr.Textbox("strawberry spaghetti"),
-        gr.Number(42, label='Seed 2', precision=0),
-        gr.Dropdown(["klms", "ddim", "default"], value="klms"),
-        gr.Slider(0.0, 20.0, 8.5),
-        gr.Slider(1, 200, 50),
-        gr.Slider(3, 240, 10),
-        gr.Checkbox(False),
-        gr.Checkbox(False),
-        gr.Checkbox(True),
-        gr.Textbox(
-            "dreams",
-            placeholder=(
-                "Folder where outputs will be saved. Each output will be saved in a new folder."
+def make_interface(pipeline=None, device=None, max_batch_size=8, max_wait_ms=50):
+    """Build the Gradio app.
+
+    Concurrent requests to the "Images!" tab are generated in batches by an `ImageRequestBatcher`.
+
+    Args:
+        pipeline (StableDiffusionPipeline, optional): Pipeline used to serve requests. Defaults to the
+            pipeline returned by `get_pipeline(device=device)`, loaded on the first request.
+        device (Union[str, torch.device], optional): Device for the default pipeline, e.g. "cpu".
+        max_batch_size (int, optional): Maximum number of image requests generated together. 1 turns batching
+            off. Defaults to 8.
+        max_wait_ms (float, optional): How long an image request may wait for others to batch with. Defaults to 50.
+
+    Returns:
+        gradio.TabbedInterface: The app, with an "Images!" and a "Videos!" tab.
+    """
+
+    def guidance_inputs():
+        # Guiding fewer steps skips the unconditional half of the UNet batch on the others
+        return [
+            gr.Slider(0.0, 1.0, 0.0, label='Guidance start (fraction of steps)'),
+            gr.Slider(0.0, 1.0, 1.0, label='Guidance end (fraction of steps)'),
+            gr.Slider(1, 10, 1, step=1, label='Unconditional pass every n guided steps'),
+        ]
+
+    interface_videos = gr.Interface(
+        partial(fn_videos, pipeline=pipeline, device=device),
+        inputs=[
+            gr.Textbox("blueberry spaghetti"),
+            gr.Number(42, label='Seed 1', precision=0),
+            gr.Textbox("strawberry spaghetti"),
+            gr.Number(42, label='Seed 2', precision=0),
+            gr.Dropdown(["klms", "ddim", "default"], value="klms"),
+            gr.Slider(0.0, 20.0, 8.5),
+            gr.Slider(1, 200, 50),
+            gr.Slider(3, 240, 10),
+            gr.Checkbox(False),
+            gr.Checkbox(False),
+            gr.Checkbox(True),
+            gr.Textbox(
+                "dreams",
+                placeholder=(
+                    "Folder where outputs will be saved. Each output will be saved in a new folder."
+                ),
             ),
-        ),
-        gr.Checkbox(False),
-    ],
-    outputs=gr.Video(),
-)
-
-interface_images = gr.Interface(
-    fn_images,
-    inputs=[
-        gr.Textbox("blueberry spaghetti"),
-        gr.Number(42, label='Seed', precision=0),
-        gr.Dropdown(["klms", "ddim", "default"], value="klms"),
-        gr.Slider(0.0, 20.0, 8.5),
-        gr.Slider(1, 200, 50),
-        gr.Checkbox(False),
-        gr.Checkbox(False),
-    ],
-    outputs=gr.Image(type="pil"),
-)
-
-interface = gr.TabbedInterface(
-    [interface_images, interface_videos], ["Images!", "Videos!"]
-)
+            gr.Checkbox(False),
+            *guidance_inputs(),
+        ],
+        outputs=gr.Video(),
+    )
+
+    batcher = None
+    if max_batch_size > 1:
+        batcher = ImageRequestBatcher(pipeline, device, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    interface_images = gr.Interface(
+        partial(fn_images, pipeline=pipeline, device=device, batcher=batcher),
+        inputs=[
+            gr.Textbox("blueberry spaghetti"),
+            gr.Number(42, label='Seed', precision=0),
+            gr.Dropdown(["klms", "ddim", "default"], value="klms"),
+            gr.Slider(0.0, 20.0, 8.5),
+            gr.Slider(1, 200, 50),
+            gr.Checkbox(False),
+            gr.Checkbox(False),
+            *guidance_inputs(),
+        ],
+        outputs=gr.Image(type="pil"),
+    )
+
+    return gr.TabbedInterface(
+        [interface_images, interface_videos], ["Images!", "Videos!"]
+    )
+
+
+interface = make_interface()
 
 if __name__ == "__main__":
     interface.launch(debug=True)
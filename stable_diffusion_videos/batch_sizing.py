@@ -0,0 +1,169 @@
+import contextlib
+
+import numpy as np
+import torch
+
+from .memory import available_memory, is_out_of_memory, measure_peak_memory
+from .sampling import get_sampling_plan
+from .stable_diffusion_pipeline import autocast
+
+
+def calibrate_batch_size(
+    pipeline,
+    height=512,
+    width=512,
+    guidance_scale=7.5,
+    scheduler=None,
+    max_batch_size=32,
+    memory_fraction=0.8,
+):
+    """Largest number of images the pipeline can generate at once in the memory available on its device.
+
+    After a warmup, a single denoising step and the decoding are run for 1 and for 2 images, to measure how much
+    memory a call takes on top of what's in use, for itself and per image. The peak doesn't depend on the number
+    of steps. On CPU the peak is measured from the process' resident memory, see `measure_peak_memory`.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import calibrate_batch_size
+        >>> batch_size = calibrate_batch_size(pipeline, height=768, width=768)
+        ```
+
+    Args:
+        pipeline (StableDiffusionPipeline): The pipeline, on the device to calibrate for.
+        height (int, optional): Height of the images. Defaults to 512.
+        width (int, optional): Width of the images. Defaults to 512.
+        guidance_scale (float, optional): Guidance scale of the calls, above 1 doubles the UNet batch. Defaults to 7.5.
+        scheduler (optional): Scheduler of the calls. Defaults to the pipeline's scheduler.
+        max_batch_size (int, optional): Upper bound of the result. Defaults to 32.
+        memory_fraction (float, optional): Fraction of the available memory to fill. Defaults to 0.8.
+
+    Returns:
+        int: The batch size, at least 1.
+    """
+    scheduler = scheduler if scheduler is not None else pipeline.scheduler
+    # Only the last step of a short schedule is run, which every scheduler supports
+    num_inference_steps = 4
+    start_step = len(get_sampling_plan(scheduler, num_inference_steps).timesteps) - 1
+    embeds = pipeline.embed_prompts("")
+
+    def run(batch_size):
+        latents = torch.randn((batch_size, pipeline.unet.in_channels, height // 8, width // 8), device=pipeline.device)
+        with autocast(pipeline.device):
+            pipeline(
+                latents=latents,
+                text_embeddings=embeds.expand(batch_size, -1, -1),
+                height=height,
+                width=width,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps,
+                start_step=start_step,
+                scheduler=scheduler,
+                output_type="pt",
+            )
+
+    try:
+        run(1)
+        _, peak_one = measure_peak_memory(lambda: run(1), pipeline.device)
+        _, peak_two = measure_peak_memory(lambda: run(2), pipeline.device)
+    except (RuntimeError, MemoryError) as e:
+        if not is_out_of_memory(e):
+            raise
+        return 1
+    if peak_one is None or peak_two is None:
+        return 1
+    per_image = max(peak_two - peak_one, 1)
+    fixed = max(peak_one - per_image, 0)
+    budget = memory_fraction * available_memory(pipeline.device) - fixed
+    return int(min(max(budget // per_image, 1), max_batch_size))
+
+
+class MemoryPolicy:
+    """Runs pipeline calls in chunks that fit in memory, splitting them further when they don't.
+
+    A call's images are generated at most `max_batch_size` at a time. When a chunk runs out of memory it's split
+    in half and retried, and the smaller size is kept for every later chunk. When a single image doesn't fit,
+    it's retried with attention slicing, which then stays on for later calls. Attention slicing is only turned on
+    for the policy's own calls: the pipeline's setting is restored when each of them returns.
+
+    The images are the ones a single call would generate, up to floating point differences between batch sizes,
+    as long as the initial `latents` are given.
+
+    Example:
+        ```python
+        >>> policy = MemoryPolicy(max_batch_size=8)
+        >>> outputs = policy(pipeline, latents=latents, text_embeddings=text_embeddings, num_inference_steps=50)
+        ```
+
+    Args:
+        max_batch_size (int, optional): Maximum number of images per pipeline call. Defaults to no limit.
+        attention_slicing (bool, optional): Slice attention from the start, instead of only once a single image
+            runs out of memory. Defaults to False.
+    """
+
+    def __init__(self, max_batch_size=None, attention_slicing=False):
+        self.max_batch_size = max_batch_size
+        self.attention_slicing = attention_slicing
+        self.num_splits = 0
+
+    def __call__(self, pipeline, latents, text_embeddings, guidance_scale=7.5, prev_img=None, **kwargs):
+        """Call `pipeline` on `latents` and `text_embeddings` in chunks, with its other arguments, and merge the outputs."""
+        batch_size = latents.shape[0]
+
+        def rows(value, start, stop):
+            # Per image arguments are chunked along with the latents, the others are shared by all chunks
+            if isinstance(value, (list, tuple)):
+                return list(value[start:stop])
+            if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size > 1:
+                return value[start:stop]
+            return value
+
+        outputs, start = [], 0
+        while start < batch_size:
+            stop = min(start + (self.max_batch_size or batch_size), batch_size)
+            try:
+                with pipeline.attention_slicing() if self.attention_slicing else contextlib.nullcontext():
+                    outputs.append(
+                        pipeline(
+                            latents=latents[start:stop],
+                            text_embeddings=text_embeddings[start:stop],
+                            guidance_scale=rows(guidance_scale, start, stop),
+                            prev_img=rows(prev_img, start, stop),
+                            **kwargs,
+                        )
+                    )
+                start = stop
+                continue
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory(e):
+                    raise
+                if stop - start > 1:
+                    self.max_batch_size = (stop - start + 1) // 2
+                    self.num_splits += 1
+                    print(f"Out of memory, generating at most {self.max_batch_size} images at once from now on")
+                elif not self.attention_slicing:
+                    self.attention_slicing = True
+                    print("Out of memory with a single image, slicing attention from now on")
+                else:
+                    raise
+            # Free what the failed call left behind, once its traceback is gone
+            if torch.device(pipeline.device).type == "cuda":
+                torch.cuda.empty_cache()
+        return _concat_outputs(outputs)
+
+
+def _concat_outputs(outputs):
+    if len(outputs) == 1:
+        return outputs[0]
+    merged = {}
+    for key, value in outputs[0].items():
+        values = [output[key] for output in outputs]
+        if value is None:
+            merged[key] = None
+        elif isinstance(value, torch.Tensor):
+            merged[key] = torch.cat(values)
+        elif isinstance(value, np.ndarray):
+            merged[key] = np.concatenate(values)
+        else:
+            merged[key] = [item for value in values for item in value]
+    return merged
@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+
+import torch
+
+from .registry import get_pipeline
+from .stable_diffusion_pipeline import autocast
+
+
+class ImageRequest(NamedTuple):
+    prompt: str
+    seed: int
+    guidance_scale: float
+    key: tuple  # requests with the same key can share a batch
+    scheduler: object
+    future: Future
+    arrival: float
+
+
+class ImageRequestBatcher:
+    """Coalesce concurrent single-image requests into batched pipeline calls.
+
+    Requests are collected by a background thread. Those with the same size, number of inference steps,
+    scheduler, guidance schedule and output type are run together as one batch of at most `max_batch_size` images, as soon as
+    the batch is full or the oldest request has waited `max_wait_ms`. Each request keeps its own seed and
+    guidance scale, so the image it gets is the one a batch-1 call with the same arguments would generate
+    (up to floating point differences between batch sizes).
+
+    Example:
+        ```python
+        >>> batcher = ImageRequestBatcher(max_batch_size=8, max_wait_ms=50)
+        >>> image = batcher('blueberry spaghetti', seed=42)  # blocks, safe to call from many threads
+        ```
+
+    Args:
+        pipeline (StableDiffusionPipeline, optional): Pipeline to run. Defaults to the pipeline returned by
+            `get_pipeline(device=device)`, loaded when the first batch runs.
+        device (Union[str, torch.device], optional): Device for the default pipeline.
+        max_batch_size (int, optional): Maximum number of images generated per pipeline call. Defaults to 8.
+        max_wait_ms (float, optional): How long a request may wait for others to batch with. Defaults to 50.
+    """
+
+    def __init__(self, pipeline=None, device=None, max_batch_size=8, max_wait_ms=50):
+        self.pipeline = pipeline
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.batch_sizes = []  # size of every batch run so far
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def __call__(self, prompt, seed=42, **kwargs):
+        """Generate an image for `prompt` and wait for it. See `submit` for the arguments."""
+        return self.submit(prompt, seed=seed, **kwargs).result()
+
+    def submit(
+        self,
+        prompt,
+        seed=42,
+        scheduler=None,
+        guidance_scale=7.5,
+        num_inference_steps=50,
+        height=512,
+        width=512,
+        output_type="pil",
+        guidance_interval=None,
+        guidance_every=1,
+    ):
+        """Queue a request for one image.
+
+        Args:
+            prompt (str): The prompt.
+            seed (int, optional): Seed of the initial noise. Defaults to 42.
+            scheduler (optional): Scheduler passed to the pipeline call. Defaults to the pipeline's scheduler.
+            guidance_scale (float, optional): Classifier free guidance scale. Defaults to 7.5.
+            num_inference_steps (int, optional): Number of denoising steps. Defaults to 50.
+            height (int, optional): Height of the image. Defaults to 512.
+            width (int, optional): Width of the image. Defaults to 512.
+            output_type (str, optional): "pil" for a PIL image, else a HWC float array. Defaults to "pil".
+            guidance_interval (Tuple[float, float], optional): Fraction of the steps to apply guidance in, see
+                `StableDiffusionPipeline.__call__`. Defaults to None (every step).
+            guidance_every (int, optional): Run the unconditional UNet pass on every this many guided steps. Defaults to 1.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the image.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot submit to a closed ImageRequestBatcher")
+        self._ensure_started()
+        future = Future()
+        # Guidance only applies above 1, and a batch either guides all its images or none, on the same steps
+        guidance_interval = tuple(guidance_interval) if guidance_interval is not None else None
+        key = (
+            height,
+            width,
+            num_inference_steps,
+            id(scheduler),
+            output_type,
+            guidance_scale > 1.0,
+            guidance_interval,
+            guidance_every,
+        )
+        self._queue.put(ImageRequest(prompt, seed, guidance_scale, key, scheduler, future, time.monotonic()))
+        return future
+
+    def close(self):
+        """Finish the queued requests and stop the background thread."""
+        self._closed = True
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="image-request-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        pending, closing = [], False
+        while pending or not closing:
+            # Wait for requests until the oldest one's time is up or a batch is full
+            if not pending:
+                request = self._queue.get()
+                if request is None:
+                    closing = True
+                    continue
+                pending.append(request)
+            while not closing:
+                batch_key = pending[0].key
+                if sum(request.key == batch_key for request in pending) >= self.max_batch_size:
+                    break
+                timeout = pending[0].arrival + self.max_wait - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                else:
+                    pending.append(request)
+
+            batch_key = pending[0].key
+            batch = [request for request in pending if request.key == batch_key][: self.max_batch_size]
+            pending = [request for request in pending if request not in batch]
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        try:
+            if self.pipeline is None:
+                self.pipeline = get_pipeline(device=self.device)
+            pipeline = self.pipeline
+            height, width, num_inference_steps, _, output_type, _, guidance_interval, guidance_every = batch[0].key
+
+            # Every request's noise comes from its own generator, exactly as in a batch-1 call
+            latents = torch.cat(
+                [
+                    torch.randn(
+                        (1, pipeline.unet.in_channels, height // 8, width // 8),
+                        generator=torch.Generator(device=pipeline.device).manual_seed(request.seed),
+                        device=pipeline.device,
+                    )
+                    for request in batch
+                ]
+            )
+            with autocast(pipeline.device):
+                images = pipeline(
+                    latents=latents,
+                    text_embeddings=pipeline.embed_prompts([request.prompt for request in batch]),
+                    height=height,
+                    width=width,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=[request.guidance_scale for request in batch],
+                    output_type=output_type,
+                    scheduler=batch[0].scheduler,
+                    guidance_interval=guidance_interval,
+                    guidance_every=guidance_every,
+                )["sample"]
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+
+        self.batch_sizes.append(len(batch))
+        for request, image in zip(batch, images):
+            request.future.set_result(image)
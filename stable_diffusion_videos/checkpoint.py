@@ -0,0 +1,99 @@
+import json
+import os
+from pathlib import Path
+
+import torch
+
+
+class WalkManifest:
+    """Append-only journal of the batches a walk has finished, used to resume it exactly.
+
+    Every completed batch appends one JSON line to `manifest.jsonl` in the run directory, recording
+    which frames it wrote and where in the walk it ended, together with the latent carried over into
+    the next batch (saved under `checkpoints/`). Resuming reads only the last line of the file.
+
+    A record is staged when its batch has been generated and committed once its frames are on disk, so
+    the manifest never points past frames that were actually written.
+
+    Args:
+        output_dir (Union[str, Path]): The run directory.
+    """
+
+    filename = "manifest.jsonl"
+
+    def __init__(self, output_dir):
+        self.output_dir = Path(output_dir)
+        self.path = self.output_dir / self.filename
+        self.checkpoint_dir = self.output_dir / "checkpoints"
+        self._staged = None
+        self._committed_latent = None
+
+    def reset(self):
+        """Forget any previous run in this directory."""
+        if self.path.exists():
+            self.path.unlink()
+        if self.checkpoint_dir.exists():
+            for path in self.checkpoint_dir.glob("latent_*.pt"):
+                path.unlink()
+        self._staged = None
+        self._committed_latent = None
+
+    def last_record(self):
+        """Return the last committed record, or None if nothing was committed yet."""
+        if not self.path.is_file():
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+            block_size = 4096
+            tail = b""
+            # Read backwards until we have the last complete line. A partially written last line
+            # (the process died while appending) is ignored.
+            while end > 0:
+                start = max(end - block_size, 0)
+                f.seek(start)
+                tail = f.read(end - start) + tail
+                end = start
+                lines = tail.split(b"\n")
+                complete = [line for line in (lines[1:] if end > 0 else lines) if line.strip()]
+                for line in reversed(complete):
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._committed_latent = record.get("latent")
+                    return record
+        return None
+
+    def load_latent(self, record, device):
+        """Load the latent carried over from `record`'s batch, or None if it had none."""
+        if record.get("latent") is None:
+            return None
+        return torch.load(self.output_dir / record["latent"], map_location=device)
+
+    def stage(self, record, latent=None):
+        """Save the carry-over `latent` of a finished batch and hold `record` until `commit`."""
+        self.commit()
+        record = dict(record, latent=None)
+        if latent is not None:
+            self.checkpoint_dir.mkdir(exist_ok=True, parents=True)
+            latent_path = self.checkpoint_dir / ("latent_%06d.pt" % record["batch"])
+            torch.save(latent.detach().cpu(), latent_path)
+            record["latent"] = str(latent_path.relative_to(self.output_dir))
+        self._staged = record
+
+    def commit(self):
+        """Append the staged record. Call once the staged batch's frames are written."""
+        if self._staged is None:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps(self._staged) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # Only the latest carry-over latent is needed to resume
+        if self._committed_latent is not None and self._committed_latent != self._staged["latent"]:
+            old_path = self.output_dir / self._committed_latent
+            if old_path.exists():
+                old_path.unlink()
+        self._committed_latent = self._staged["latent"]
+        self._staged = None
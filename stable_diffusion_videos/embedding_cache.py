@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .memory import to_device
+
+
+class TextEmbeddingCache:
+    """LRU cache of text encoder outputs, keyed by (text encoder identity, prompt).
+
+    A text encoder is identified by the name or path and revision it was loaded from, its device and its
+    precision, so encoders that weren't loaded with `from_pretrained` (empty `name_or_path`) aren't cached.
+    Entries live in memory on the device they were computed on. If `cache_dir` is given, every computed
+    embedding is also written there as a `.npy` file and memory-mapped back in on a miss, so repeated prompts
+    are free across runs and processes too. On CPU the memory-mapped file is used as is, for other devices
+    it's only read when copied over.
+
+    Args:
+        max_size (int, optional): Maximum number of embeddings kept in memory. Defaults to 256.
+        cache_dir (Union[str, Path], optional): Directory to persist embeddings to. Defaults to None (memory only).
+    """
+
+    def __init__(self, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.cache_dir = Path(cache_dir).expanduser() if cache_dir is not None else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def encoder_key(text_encoder):
+        """Identity of `text_encoder`, including where its outputs live and in which precision.
+
+        Returns:
+            tuple: The key, or None if the encoder can't be identified, in which case nothing is cached for it.
+        """
+        name_or_path = getattr(text_encoder.config, "_name_or_path", "")
+        if not name_or_path:
+            return None
+        revision = getattr(text_encoder.config, "_commit_hash", None)
+        precision = "autocast" if torch.is_autocast_enabled() else str(text_encoder.dtype)
+        return (name_or_path, revision, str(text_encoder.device), precision)
+
+    def get(self, encoder_key, prompt):
+        """Return the cached embedding of `prompt`, or None. Counts a hit or a miss."""
+        if encoder_key is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        key = (encoder_key, prompt)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+
+        embedding = self._load(encoder_key, prompt)
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._insert(key, embedding)
+        return embedding
+
+    def put(self, encoder_key, prompt, embedding):
+        """Store the embedding of a single `prompt`, of shape (1, seq_len, hidden_size)."""
+        if encoder_key is None:
+            return
+        with self._lock:
+            self._insert((encoder_key, prompt), embedding)
+        self._save(encoder_key, prompt, embedding)
+
+    def clear(self):
+        """Drop all in-memory entries and reset the statistics. Files on disk are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.disk_hits = self.misses = 0
+
+    def stats(self):
+        """Hit/miss counters. `misses` is the number of prompts that went through the text encoder."""
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, size=len(self._entries))
+
+    def _insert(self, key, embedding):
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _path(self, encoder_key, prompt):
+        name_or_path, revision, _, precision = encoder_key
+        if self.cache_dir is None:
+            return None
+        digest = hashlib.sha1(repr((name_or_path, revision, precision, prompt)).encode("utf-8")).hexdigest()
+        return self.cache_dir / f"{digest}.npy"
+
+    def _load(self, encoder_key, prompt):
+        path = self._path(encoder_key, prompt)
+        if path is None or not path.is_file():
+            return None
+        with warnings.catch_warnings():
+            # The memory map is read-only, and so is the tensor, nothing writes to cached embeddings
+            warnings.filterwarnings("ignore", message="The given NumPy array is not writable")
+            embedding = torch.from_numpy(np.load(path, mmap_mode="r"))
+        return to_device(embedding, encoder_key[2])
+
+    def _save(self, encoder_key, prompt, embedding):
+        path = self._path(encoder_key, prompt)
+        if path is None or embedding.dtype == torch.bfloat16:
+            return
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, embedding.detach().cpu().numpy())
+        os.replace(tmp_path, path)
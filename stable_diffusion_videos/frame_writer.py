@@ -0,0 +1,254 @@
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from .profiling import get_profiler
+
+
+class AsyncFrameWriter:
+    """Encode and write frames on background threads so generation doesn't wait on disk.
+
+    Frames are handed over with `write` and saved by a pool of worker threads (PIL releases the GIL
+    while compressing). At most `max_queue_size` frames are pending at any time; `write` blocks until
+    a slot frees up, so a slow disk applies back-pressure instead of buffering frames without bound.
+    An error raised while writing a frame is re-raised from the next call to `write`, `flush` or `close`.
+
+    Example:
+        ```python
+        >>> with AsyncFrameWriter('dreams/my_run') as writer:
+        ...     for i, image in enumerate(images):
+        ...         writer.write(i, image)
+        ```
+
+    Args:
+        output_dir (Union[str, Path]): Directory frames are written to.
+        frame_filename (str, optional): Filename pattern, formatted with the frame index. Defaults to "frame%06d.png".
+        num_workers (int, optional): Number of encoding threads. Defaults to 2.
+        max_queue_size (int, optional): Maximum number of frames waiting to be written. Defaults to 16.
+        atomic (bool, optional): Write each frame to a temporary file first and rename it once complete, so a
+            frame that exists on disk is never truncated, even after a crash. Defaults to False.
+    """
+
+    def __init__(self, output_dir, frame_filename="frame%06d.png", num_workers=2, max_queue_size=16, atomic=False):
+        self.output_dir = Path(output_dir)
+        self.frame_filename = frame_filename
+        self.atomic = atomic
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="frame-writer")
+        self._slots = threading.BoundedSemaphore(max_queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._error = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def frame_path(self, frame_index):
+        """Path the frame with index `frame_index` is written to."""
+        return self.output_dir / (self.frame_filename % frame_index)
+
+    def write(self, frame_index, image):
+        """Queue `image` (a PIL image or HWC uint8 array) to be written as frame `frame_index`.
+
+        Returns:
+            Path: Path the frame will be written to.
+        """
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed AsyncFrameWriter")
+        self._raise_error()
+        path = self.frame_path(frame_index)
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._save, image, path, self.atomic)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return path
+
+    def flush(self):
+        """Block until every queued frame is on disk."""
+        with self._lock:
+            pending = list(self._pending)
+        wait(pending)
+        self._raise_error()
+
+    def close(self):
+        """Flush and stop the worker threads."""
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._executor.shutdown(wait=True)
+
+    @staticmethod
+    def _save(image, path, atomic=False):
+        with get_profiler().stage("frame_encode"):
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            if atomic:
+                partial_path = path.with_name(path.name + ".partial")
+                image.save(partial_path, format=Image.registered_extensions()[path.suffix.lower()])
+                os.replace(partial_path, path)
+            else:
+                image.save(path)
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None and self._error is None:
+                self._error = future.exception()
+        self._slots.release()
+
+    def _raise_error(self):
+        with self._lock:
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+
+class FFmpegVideoWriter:
+    """Stream frames into an ffmpeg process as raw RGB, so the video is done when the last frame is.
+
+    The ffmpeg process is started when the first frame arrives (that's when the frame size is known) and
+    frames are piped to its stdin from a background thread, through a queue of at most `max_queue_size`
+    frames. Frames must be written in order. `close` waits for ffmpeg to finish and raises
+    `subprocess.CalledProcessError` (with ffmpeg's stderr) if it failed.
+
+    Args:
+        video_path (Union[str, Path]): Where to write the video.
+        fps (int, optional): Frames per second of the video. Defaults to 30.
+        ffmpeg_args (str, optional): Output options passed to ffmpeg. Defaults to "-vcodec libx264 -crf 10 -pix_fmt yuv420p".
+        max_queue_size (int, optional): Maximum number of frames waiting to be piped. Defaults to 16.
+    """
+
+    def __init__(self, video_path, fps=30, ffmpeg_args="-vcodec libx264 -crf 10 -pix_fmt yuv420p", max_queue_size=16):
+        self.video_path = Path(video_path)
+        self.fps = fps
+        self.ffmpeg_args = ffmpeg_args
+        self.next_frame_index = None
+        self._queue = queue.Queue(max_queue_size)
+        self._process = None
+        self._stderr = None
+        self._thread = None
+        self._size = None
+        self._error = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, frame_index, image):
+        """Queue `image` (a PIL image or HWC uint8 RGB array) as frame `frame_index`."""
+        if self._closed:
+            raise RuntimeError("Cannot write to a closed FFmpegVideoWriter")
+        if self._error is not None:
+            self.close()
+        if self.next_frame_index is not None and frame_index != self.next_frame_index:
+            raise ValueError(f"Frames must be written in order: expected frame {self.next_frame_index}, got {frame_index}")
+        self.next_frame_index = frame_index + 1
+
+        frame = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) else image, dtype=np.uint8)
+        if self._process is None:
+            self._start(width=frame.shape[1], height=frame.shape[0])
+        elif frame.shape[:2] != self._size:
+            raise ValueError(f"All frames must have the same size, expected {self._size}, got {frame.shape[:2]}")
+        self._queue.put(frame)
+
+    def flush(self):
+        """Block until every queued frame has been handed to ffmpeg."""
+        self._queue.join()
+
+    def close(self):
+        """Finish the video. Raises `subprocess.CalledProcessError` if ffmpeg failed."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._process is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._process.stdin.close()
+        returncode = self._process.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode("utf-8", errors="replace")
+        self._stderr.close()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self._process.args, stderr=stderr)
+        if self._error is not None:
+            raise self._error
+
+    def _start(self, width, height):
+        self._size = (height, width)
+        cmd = (
+            f"ffmpeg -y -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r {self.fps} -i - {self.ffmpeg_args}".split()
+            + [str(self.video_path)]
+        )
+        self._stderr = tempfile.TemporaryFile()
+        self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr)
+        self._thread = threading.Thread(target=self._pipe_frames, name="ffmpeg-writer", daemon=True)
+        self._thread.start()
+
+    def _pipe_frames(self):
+        while True:
+            frame = self._queue.get()
+            try:
+                if frame is None:
+                    return
+                if self._error is None:
+                    with get_profiler().stage("video_pipe"):
+                        self._process.stdin.write(frame.tobytes())
+            except (BrokenPipeError, OSError) as e:
+                # ffmpeg died, keep draining so `write` never blocks. `close` reports ffmpeg's exit status.
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+class FrameWriterGroup:
+    """Fan frames out to several writers (e.g. an `AsyncFrameWriter` and an `FFmpegVideoWriter`)."""
+
+    def __init__(self, writers):
+        self.writers = list(writers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, frame_index, image):
+        for writer in self.writers:
+            writer.write(frame_index, image)
+
+    def flush(self):
+        for writer in self.writers:
+            writer.flush()
+
+    def close(self):
+        """Close every writer, then re-raise the first error any of them raised."""
+        error = None
+        for writer in self.writers:
+            try:
+                writer.close()
+            except Exception as e:
+                error = error or e
+        if error is not None:
+            raise error
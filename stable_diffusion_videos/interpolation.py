@@ -0,0 +1,164 @@
+import numpy as np
+import torch
+
+from .profiling import get_profiler
+
+
+def slerp(t, v0, v1, DOT_THRESHOLD=0.9995):
+    """helper function to spherically interpolate two arrays v1 v2
+
+    `t` can be a float or a 1-D array/tensor of N values. In the latter case all N interpolants are
+    computed in one broadcasted call and stacked along a new leading dimension, i.e. the result has
+    shape (N, *v0.shape). Torch inputs are interpolated on their own device.
+    """
+
+    if not isinstance(v0, np.ndarray):
+        return _slerp_torch(t, v0, v1, DOT_THRESHOLD)
+
+    if np.ndim(t) > 0:
+        t = np.asarray(t, dtype=v0.dtype).reshape(-1, *(1,) * v0.ndim)
+
+    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+    if np.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * v0 + t * v1
+    else:
+        theta_0 = np.arccos(dot)
+        sin_theta_0 = np.sin(theta_0)
+        theta_t = theta_0 * t
+        sin_theta_t = np.sin(theta_t)
+        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = sin_theta_t / sin_theta_0
+        v2 = s0 * v0 + s1 * v1
+
+    return v2
+
+
+def _slerp_torch(t, v0, v1, DOT_THRESHOLD=0.9995):
+    # Same math as the NumPy path, without leaving the device. Computed in float32 (at least).
+    compute_dtype = torch.promote_types(v0.dtype, torch.float32)
+    t = torch.as_tensor(t, dtype=compute_dtype, device=v0.device)
+    t = t.reshape(t.shape + (1,) * v0.dim())
+    a, b = v0.to(compute_dtype), v1.to(compute_dtype)
+
+    dot = torch.sum(a * b / (torch.linalg.norm(a) * torch.linalg.norm(b)))
+    if torch.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * a + t * b
+    else:
+        theta_0 = torch.arccos(dot)
+        sin_theta_0 = torch.sin(theta_0)
+        theta_t = theta_0 * t
+        sin_theta_t = torch.sin(theta_t)
+        s0 = torch.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = sin_theta_t / sin_theta_0
+        v2 = s0 * a + s1 * b
+
+    return v2.to(v0.dtype)
+
+
+def lerp(t, v0, v1):
+    """Linearly interpolate two tensors. Like `slerp`, `t` can be a float or a 1-D array of N values."""
+    t = torch.as_tensor(t, dtype=v0.dtype, device=v0.device)
+    if t.dim() == 0:
+        return torch.lerp(v0, v1, t)
+    t = t.reshape(t.shape + (1,) * v0.dim())
+    expanded_shape = t.shape[:1] + v0.shape
+    return torch.lerp(v0.expand(expanded_shape), v1.expand(expanded_shape), t)
+
+
+def interpolate_consecutive(latents, latent_interpolation_steps):
+    """Linearly interpolate between every pair of consecutive latents.
+
+    Returns the `latent_interpolation_steps - 1` in-between latents of each pair (excluding the latents
+    themselves), pair after pair.
+    """
+    if latents.shape[0] < 2 or latent_interpolation_steps < 2:
+        return latents[:0]
+    return torch.stack(
+        [
+            torch.lerp(latents[:-1], latents[1:], float(i) / latent_interpolation_steps)
+            for i in range(1, latent_interpolation_steps)
+        ],
+        1,
+    ).reshape((-1, *latents.shape[1:]))
+
+
+class KeyframeInputs:
+    """Text embeddings and initial noise of the keyframes of a walk (see `WalkPlan`).
+
+    The inputs of a segment's keyframes are interpolated at once on the pipeline's device, the first time one of
+    them is needed, and the last two segments used are kept. Batches are gathered into buffers that are reused
+    from batch to batch.
+
+    Args:
+        pipeline (StableDiffusionPipeline): Pipeline whose text encoder and UNet the inputs are for.
+        prompts (List[str]): Prompts of the walk, including the first one again for looped walks.
+        seeds (List[int]): Random seed of each prompt.
+        num_steps (int): Number of keyframes per segment.
+        height (int): Height of the images.
+        width (int): Width of the images.
+        use_lerp_for_text (bool, optional): Use LERP instead of SLERP for the text embeddings. Defaults to True.
+        batch_size (int, optional): Largest number of keyframes gathered at once. Defaults to 1.
+    """
+
+    def __init__(self, pipeline, prompts, seeds, num_steps, height, width, use_lerp_for_text=True, batch_size=1):
+        self.pipeline = pipeline
+        self.prompts = prompts
+        self.seeds = seeds
+        self.num_steps = num_steps
+        self.height = height
+        self.width = width
+        self.use_lerp_for_text = use_lerp_for_text
+        self.batch_size = batch_size
+        self._segments = {}
+        self._buffers = None
+
+    def noise(self, seed):
+        """Initial latents of a prompt's own keyframe."""
+        pipeline = self.pipeline
+        return torch.randn(
+            (1, pipeline.unet.in_channels, self.height // 8, self.width // 8),
+            device=pipeline.device,
+            generator=torch.Generator(device=pipeline.device).manual_seed(seed),
+        )
+
+    def segment(self, segment):
+        """Text embeddings and noise of every keyframe of `segment`."""
+        if segment in self._segments:
+            return self._segments[segment]
+
+        with get_profiler().stage("interpolate_inputs", segment=segment):
+            embeds_a = self.pipeline.embed_text(self.prompts[segment])
+            embeds_b = self.pipeline.embed_text(self.prompts[segment + 1])
+            latents_a = self.noise(self.seeds[segment])
+            latents_b = self.noise(self.seeds[segment + 1])
+
+            ts = np.linspace(0, 1, self.num_steps)
+            if self.use_lerp_for_text:
+                segment_embeds = lerp(ts, embeds_a, embeds_b).flatten(0, 1)
+            else:
+                segment_embeds = slerp(ts, embeds_a, embeds_b).flatten(0, 1)
+            segment_latents = slerp(ts, latents_a, latents_b).flatten(0, 1)
+        # A batch spans at most a few consecutive segments, older ones aren't needed anymore
+        for old_segment in [s for s in self._segments if s < segment - 1]:
+            del self._segments[old_segment]
+        self._segments[segment] = (segment_embeds, segment_latents)
+        return self._segments[segment]
+
+    def __call__(self, keyframe):
+        """Text embeddings and noise of a single keyframe, each with a batch dimension of 1."""
+        embeds, latents = self.segment(keyframe.segment)
+        return embeds[keyframe.step:keyframe.step + 1], latents[keyframe.step:keyframe.step + 1]
+
+    def gather(self, keyframes):
+        """Text embeddings and noise of `keyframes`, stacked in the reused buffers.
+
+        The tensors are only valid until the next call.
+        """
+        if self._buffers is None:
+            self._buffers = [inputs.new_empty((self.batch_size, *inputs.shape[1:])) for inputs in self(keyframes[0])]
+        embeds_buffer, latents_buffer = self._buffers
+        for row, keyframe in enumerate(keyframes):
+            embeds, latents = self(keyframe)
+            embeds_buffer[row].copy_(embeds[0])
+            latents_buffer[row].copy_(latents[0])
+        return embeds_buffer[:len(keyframes)], latents_buffer[:len(keyframes)]
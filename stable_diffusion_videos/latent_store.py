@@ -0,0 +1,97 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+
+class KeyframeLatentStore:
+    """Memory-mapped store of the denoised latent of every keyframe of a walk.
+
+    Keyframes are the frames that went through the UNet. Their latents (already divided by the VAE
+    scaling factor, i.e. the `"latent"` output of the pipeline) are kept in `keyframe_latents.npy` in the
+    run directory, next to a flag per keyframe telling whether it was written yet. With these, the
+    frames and video of a run can be rebuilt with the VAE alone, see `stable_diffusion_videos.rerender`.
+
+    Args:
+        output_dir (Union[str, Path]): The run directory.
+        num_keyframes (int, optional): Number of keyframes of the walk. Required when `create=True`.
+        latent_shape (Tuple[int], optional): Shape of a single latent, (channels, height, width). Required when `create=True`.
+        create (bool, optional): Create a new (empty) store, replacing any existing one. Defaults to False.
+    """
+
+    filename = "keyframe_latents.npy"
+    written_filename = "keyframe_latents_written.npy"
+
+    def __init__(self, output_dir, num_keyframes=None, latent_shape=None, create=False):
+        self.output_dir = Path(output_dir)
+        path, written_path = self.output_dir / self.filename, self.output_dir / self.written_filename
+        if create:
+            self.latents = np.lib.format.open_memmap(
+                path, mode="w+", dtype=np.float32, shape=(num_keyframes, *latent_shape)
+            )
+            self.written = np.lib.format.open_memmap(written_path, mode="w+", dtype=np.bool_, shape=(num_keyframes,))
+        else:
+            if not path.is_file():
+                raise FileNotFoundError(f"No keyframe latents found at {path}")
+            self.latents = np.load(path, mmap_mode="r+")
+            self.written = np.load(written_path, mmap_mode="r+")
+            if num_keyframes is not None and len(self.latents) != num_keyframes:
+                raise ValueError(f"Expected {num_keyframes} keyframes in {path}, found {len(self.latents)}")
+        # Reused pinned host buffer for reads onto a GPU, and the event of the last copy out of it
+        self._staging = None
+        self._staging_copy = None
+
+    def __len__(self):
+        return len(self.latents)
+
+    @classmethod
+    def exists(cls, output_dir):
+        return (Path(output_dir) / cls.filename).is_file()
+
+    def write(self, start, latents):
+        """Store `latents` as keyframes `start`, `start + 1`, ..."""
+        self.latents[start:start + len(latents)] = latents.detach().float().cpu().numpy()
+        self.written[start:start + len(latents)] = True
+
+    def read(self, start, stop, device=None):
+        """Keyframe latents `start` up to (excluding) `stop`, as a float32 tensor.
+
+        Reads onto a GPU are staged in a pinned host buffer that's reused from read to read, so the copy to the
+        device runs asynchronously.
+        """
+        latents = self.latents[start:stop]
+        device = torch.device(device) if device is not None else None
+        if device is None or device.type != "cuda":
+            return torch.from_numpy(np.array(latents)).to(device)
+
+        if self._staging is None or len(self._staging) < len(latents):
+            self._staging = torch.empty((len(latents), *self.latents.shape[1:]), dtype=torch.float32).pin_memory()
+        elif self._staging_copy is not None:
+            # The previous read's copy has to be done before its data is overwritten
+            self._staging_copy.synchronize()
+        staging = self._staging[:len(latents)]
+        staging.numpy()[...] = latents
+        output = staging.to(device, non_blocking=True)
+        self._staging_copy = torch.cuda.Event()
+        self._staging_copy.record(torch.cuda.current_stream(device))
+        return output
+
+    def wait_until_written(self, index, stop_event=None, poll_interval=0.05):
+        """Block until keyframe `index` was written, possibly by another process sharing the store.
+
+        Raises `RuntimeError` if `stop_event` (e.g. a `multiprocessing.Event`) is set while waiting.
+        """
+        while not self.written[index]:
+            if stop_event is not None and stop_event.is_set():
+                raise RuntimeError(f"Stopped waiting for keyframe {index} of {self.output_dir}")
+            time.sleep(poll_interval)
+
+    def num_written(self):
+        """Number of keyframes written, counting from the first one up to the first gap."""
+        missing = np.flatnonzero(~self.written)
+        return int(missing[0]) if len(missing) else len(self.written)
+
+    def flush(self):
+        self.latents.flush()
+        self.written.flush()
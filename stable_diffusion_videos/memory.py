@@ -0,0 +1,110 @@
+import os
+import threading
+
+import torch
+
+
+def available_memory(device):
+    """Number of bytes that can still be allocated on `device`.
+
+    On CUDA this is the free device memory plus what PyTorch's caching allocator holds but isn't using.
+    On CPU it's the memory the OS reports as available.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def relieve_memory_pressure(device, min_free_fraction=0.1):
+    """Hand the memory PyTorch's caching allocator holds but doesn't use back to the device, if it runs low.
+
+    Emptying the cache after every batch only makes the allocator request the same memory from the driver again
+    for the next one. So the cache is only emptied when less than `min_free_fraction` of the device's memory is
+    free outside of it, e.g. for other processes sharing the GPU. A no-op on CPU.
+
+    Returns:
+        bool: Whether the cache was emptied.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return False
+    free, total = torch.cuda.mem_get_info(device)
+    if free >= min_free_fraction * total or torch.cuda.memory_reserved(device) == torch.cuda.memory_allocated(device):
+        return False
+    torch.cuda.empty_cache()
+    return True
+
+
+def to_device(tensor, device):
+    """Copy `tensor` to `device`, from pinned host memory if it goes from the CPU to a GPU.
+
+    The copy to the GPU is then asynchronous. PyTorch's pinned memory allocator caches the staging buffers and
+    only reuses one once its copy is done. Tensors that are already on `device` are returned as they are.
+    """
+    device = torch.device(device)
+    if device.type != "cuda" or tensor.device.type != "cpu":
+        return tensor.to(device)
+    return tensor.pin_memory().to(device, non_blocking=True)
+
+
+def is_out_of_memory(error):
+    """Whether `error` is an allocation failure, on CUDA or on the CPU."""
+    if isinstance(error, MemoryError) or type(error).__name__ == "OutOfMemoryError":
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ("out of memory" in message or "can't allocate memory" in message)
+
+
+def _resident_memory():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+def measure_peak_memory(fn, device):
+    """Call `fn()` and return its result and the peak memory it took on `device` on top of what was in use before.
+
+    On CUDA the peak is tracked by PyTorch's allocator. On CPU the process' resident memory is sampled while
+    `fn` runs, which misses short spikes and is None where the OS doesn't report it.
+
+    Returns:
+        Tuple[Any, Optional[int]]: The result of `fn()` and the peak in bytes.
+    """
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        result = fn()
+        torch.cuda.synchronize(device)
+        return result, torch.cuda.max_memory_allocated(device) - baseline
+
+    baseline = _resident_memory()
+    if baseline is None:
+        return fn(), None
+    peak, done = [baseline], threading.Event()
+
+    def sample():
+        while not done.wait(0.001):
+            peak[0] = max(peak[0], _resident_memory())
+
+    thread = threading.Thread(target=sample, name="peak-memory-sampler", daemon=True)
+    thread.start()
+    try:
+        result = fn()
+    finally:
+        done.set()
+        thread.join()
+    return result, max(peak[0], _resident_memory()) - baseline
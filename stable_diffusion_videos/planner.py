@@ -0,0 +1,178 @@
+import math
+from typing import List, NamedTuple
+
+
+class Keyframe(NamedTuple):
+    """A frame of the walk that is generated by the diffusion model."""
+
+    index: int  # position among all keyframes of the walk
+    segment: int  # which pair of prompts it lies between
+    step: int  # position within the segment
+    t: float  # interpolation weight between the segment's two prompts/noises
+
+
+class PlannedBatch(NamedTuple):
+    """Keyframes generated together in a single pipeline call.
+
+    `rows[i]` is the row of the pipeline's batch that produces `keyframes[i]`. Keyframes that duplicate
+    their predecessor share its row, so `num_rows` can be smaller than `len(keyframes)`.
+    """
+
+    keyframes: List[Keyframe]
+    rows: List[int]
+
+    @property
+    def num_rows(self):
+        return max(self.rows) + 1
+
+    def unet_keyframes(self):
+        """The keyframes that each occupy a row of the pipeline's batch, in row order."""
+        seen, keyframes = set(), []
+        for keyframe, row in zip(self.keyframes, self.rows):
+            if row not in seen:
+                seen.add(row)
+                keyframes.append(keyframe)
+        return keyframes
+
+
+class WalkPlan:
+    """Every keyframe of a walk, packed into fixed-size pipeline batches upfront.
+
+    The last keyframe of a segment (t=1) and the first of the next one (t=0) have the same prompt and
+    noise, so the latter is not generated again but reuses the former's output. Batches are filled
+    across segment boundaries, so only the very last batch of the walk can be smaller than `batch_size`.
+
+    When `chain_batches` is set (img2img walks with `strength < 1`, where each batch starts from the last
+    latent of the previous one) the boundary keyframes are *not* duplicates, since they're denoised from
+    different previous latents, and batches end at segment boundaries exactly like a per-segment walk.
+
+    Args:
+        num_segments (int): Number of prompt pairs walked between.
+        num_steps (int): Number of keyframes per segment.
+        batch_size (int): Maximum number of rows per pipeline batch.
+        chain_batches (bool, optional): Whether batches depend on the previous batch's output. Defaults to False.
+    """
+
+    def __init__(self, num_segments, num_steps, batch_size, chain_batches=False):
+        self.num_segments = num_segments
+        self.num_steps = num_steps
+        self.batch_size = batch_size
+        self.chain_batches = chain_batches
+        self.batches = []
+
+        keyframes, rows = [], []
+
+        def flush():
+            if keyframes:
+                self.batches.append(PlannedBatch(list(keyframes), list(rows)))
+                keyframes.clear()
+                rows.clear()
+
+        for segment in range(num_segments):
+            for step in range(num_steps):
+                t = step / (num_steps - 1) if num_steps > 1 else 0.0
+                keyframe = Keyframe(segment * num_steps + step, segment, step, t)
+                is_duplicate = not chain_batches and segment > 0 and step == 0 and num_steps > 1
+                if is_duplicate:
+                    # Reuse the previous keyframe's row. It's always in the current batch, since a batch is
+                    # only flushed when a keyframe that needs a row of its own comes in.
+                    rows.append(rows[-1])
+                else:
+                    if rows and rows[-1] + 1 == batch_size:
+                        flush()
+                    rows.append(rows[-1] + 1 if rows else 0)
+                keyframes.append(keyframe)
+            if chain_batches:
+                flush()
+        flush()
+
+    def __len__(self):
+        return len(self.batches)
+
+    @property
+    def num_keyframes(self):
+        return self.num_segments * self.num_steps
+
+    @property
+    def num_rows(self):
+        """Number of keyframes that go through the UNet."""
+        return sum(batch.num_rows for batch in self.batches)
+
+    def frame_ranges(self, latent_interpolation_steps=0):
+        """Range of frame indices `(start, stop)` that each batch writes, in batch order.
+
+        Without latent interpolation every keyframe is a frame. With it, a batch writes the in-between frames
+        from the previous batch's last keyframe through its own keyframes (excluding the keyframes).
+        """
+        ranges, start = [], 0
+        for i, batch in enumerate(self.batches):
+            if latent_interpolation_steps:
+                num_pairs = len(batch.keyframes) if i > 0 else len(batch.keyframes) - 1
+                num_frames = num_pairs * max(latent_interpolation_steps - 1, 0)
+            else:
+                num_frames = len(batch.keyframes)
+            ranges.append((start, start + num_frames))
+            start += num_frames
+        return ranges
+
+    def progressive_order(self):
+        """Batch indices in coarse-to-fine order, as a list of levels.
+
+        The first level holds the batches with the prompts' own keyframes (the start of every segment and the end
+        of the walk). Every further level holds the batch halfway between each pair of neighbouring batches that
+        are already done, like bisecting t: 0.5, then 0.25 and 0.75, ... Together the levels hold every batch once.
+        """
+        if not self.batches:
+            return []
+        anchors = {i for i, batch in enumerate(self.batches) if any(k.step == 0 for k in batch.keyframes)}
+        anchors = sorted(anchors | {len(self.batches) - 1})
+        levels = [anchors]
+        gaps = [(a, b) for a, b in zip(anchors, anchors[1:]) if b - a > 1]
+        while gaps:
+            level, next_gaps = [], []
+            for a, b in gaps:
+                middle = (a + b) // 2
+                level.append(middle)
+                next_gaps += [(x, y) for x, y in ((a, middle), (middle, b)) if y - x > 1]
+            levels.append(level)
+            gaps = next_gaps
+        return levels
+
+    def shards(self, num_shards):
+        """Split the batches into at most `num_shards` contiguous ranges `(start, stop)` of about equal UNet work.
+
+        When batches are chained, ranges only start at a segment boundary.
+        """
+        cut_points = [
+            i for i, batch in enumerate(self.batches)
+            if i > 0 and (not self.chain_batches or batch.keyframes[0].step == 0)
+        ]
+        rows_before = [0]
+        for batch in self.batches:
+            rows_before.append(rows_before[-1] + batch.num_rows)
+
+        starts = [0]
+        for shard in range(1, num_shards):
+            target = self.num_rows * shard / num_shards
+            candidates = [i for i in cut_points if i > starts[-1]]
+            if not candidates:
+                break
+            starts.append(min(candidates, key=lambda i: abs(rows_before[i] - target)))
+        starts = sorted(set(starts))
+        return list(zip(starts, starts[1:] + [len(self.batches)]))
+
+    def report(self, executed_batches=None):
+        """Planned pipeline batches and rows, compared with batching each segment on its own."""
+        naive_batches = self.num_segments * math.ceil(self.num_steps / self.batch_size)
+        report = dict(
+            keyframes=self.num_keyframes,
+            planned_batches=len(self.batches),
+            planned_rows=self.num_rows,
+            deduplicated_keyframes=self.num_keyframes - self.num_rows,
+            per_segment_batches=naive_batches,
+            per_segment_rows=self.num_keyframes,
+            batch_fill=self.num_rows / (len(self.batches) * self.batch_size) if self.batches else 0.0,
+        )
+        if executed_batches is not None:
+            report["executed_batches"] = executed_batches
+        return report
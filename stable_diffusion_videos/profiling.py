@@ -0,0 +1,178 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import torch
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class NullProfiler:
+    """Profiler that records nothing. It's the active profiler unless a `Profiler` is activated."""
+
+    enabled = False
+
+    def stage(self, name, **args):
+        return _NULL_STAGE
+
+
+_active_profiler = NullProfiler()
+
+
+def get_profiler():
+    """The profiler stages are currently recorded to, a `NullProfiler` if none is active."""
+    return _active_profiler
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler.synchronize:
+            torch.cuda.synchronize()
+        self.profiler._record(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class Profiler:
+    """Records wall time, call counts and peak memory of the stages of a walk.
+
+    Code paths worth measuring are wrapped in `get_profiler().stage(name)`. Those calls are close to free
+    unless a `Profiler` is activated, which is process-wide so stages running on background threads
+    (e.g. frame encoding) are recorded too.
+
+    Example:
+        ```python
+        >>> profiler = Profiler()
+        >>> with profiler.activate():
+        ...     walk(...)
+        >>> profiler.save('dreams/my_run')  # profile.json + trace.json, open the latter in chrome://tracing
+        ```
+
+    Args:
+        synchronize (bool, optional): Wait for queued CUDA work at the start and end of every stage, so
+            asynchronous kernels are attributed to the stage that launched them. Slows the run down a
+            bit. Defaults to True when CUDA is initialized.
+    """
+
+    enabled = True
+
+    def __init__(self, synchronize=None):
+        self.synchronize = torch.cuda.is_initialized() if synchronize is None else synchronize
+        self.stats = {}
+        self.events = []
+        self.thread_names = {}
+        self._origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def stage(self, name, **args):
+        """Context manager timing one call of stage `name`. `args` are shown with the call in the trace."""
+        return _Stage(self, name, args)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the profiler `get_profiler` returns while the context is active."""
+        global _active_profiler
+        previous, _active_profiler = _active_profiler, self
+        if torch.cuda.is_initialized():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            yield self
+        finally:
+            _active_profiler = previous
+
+    def _record(self, name, start, end, args):
+        peak_memory = self._peak_memory()
+        thread = threading.current_thread()
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = dict(count=0, total_s=0.0, max_s=0.0, peak_memory_bytes=0)
+            duration = (end - start) / 1e9
+            stats["count"] += 1
+            stats["total_s"] += duration
+            stats["max_s"] = max(stats["max_s"], duration)
+            stats["peak_memory_bytes"] = max(stats["peak_memory_bytes"], peak_memory)
+            self.events.append((name, start, end, thread.ident, args))
+            self.thread_names[thread.ident] = thread.name
+
+    @staticmethod
+    def _peak_memory():
+        # High-water mark of the process so far: the CUDA allocator's when it's in use, else the max RSS
+        if torch.cuda.is_initialized():
+            return torch.cuda.max_memory_allocated()
+        if resource is None:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def summary(self):
+        """Per stage call count, total/mean/max wall time in seconds and peak memory, slowest stage first."""
+        with self._lock:
+            summary = {name: dict(stats) for name, stats in self.stats.items()}
+        for stats in summary.values():
+            stats["mean_s"] = stats["total_s"] / stats["count"]
+        return dict(sorted(summary.items(), key=lambda item: item[1]["total_s"], reverse=True))
+
+    def trace_events(self):
+        """The recorded calls in the Chrome trace event format."""
+        pid = os.getpid()
+        with self._lock:
+            events, thread_names = list(self.events), dict(self.thread_names)
+        trace = [
+            dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=thread_name))
+            for tid, thread_name in thread_names.items()
+        ]
+        for name, start, end, tid, args in events:
+            trace.append(
+                dict(
+                    name=name,
+                    ph="X",
+                    ts=(start - self._origin) / 1e3,
+                    dur=(end - start) / 1e3,
+                    pid=pid,
+                    tid=tid,
+                    args=args,
+                )
+            )
+        return trace
+
+    def save(self, output_dir, summary_filename="profile.json", trace_filename="trace.json"):
+        """Write the summary and the trace (viewable in chrome://tracing or Perfetto) to `output_dir`.
+
+        Returns:
+            Tuple[Path, Path]: Paths of the summary and the trace file.
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(exist_ok=True, parents=True)
+        summary_path, trace_path = output_dir / summary_filename, output_dir / trace_filename
+        summary_path.write_text(json.dumps(self.summary(), indent=2))
+        trace_path.write_text(json.dumps(dict(traceEvents=self.trace_events(), displayTimeUnit="ms")))
+        return summary_path, trace_path
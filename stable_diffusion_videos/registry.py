@@ -0,0 +1,220 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from .stable_diffusion_pipeline import StableDiffusionPipeline
+
+
+DEFAULT_MODEL_ID = "runwayml/stable-diffusion-v1-5"
+DEFAULT_UPSAMPLER_ID = "nateraw/real-esrgan"
+
+
+def default_device():
+    """The device pipelines are placed on when none is given: CUDA if available, else CPU."""
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def model_nbytes(model):
+    """Bytes taken by the parameters and buffers of the torch modules in `model` and its attributes."""
+    modules, seen = [], set()
+
+    def collect(obj, depth):
+        if isinstance(obj, torch.nn.Module):
+            modules.append(obj)
+        elif depth > 0 and hasattr(obj, "__dict__"):
+            for value in vars(obj).values():
+                collect(value, depth - 1)
+
+    # Pipelines keep their models as attributes, upsamplers one level deeper
+    collect(model, 2)
+    nbytes = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if id(tensor) not in seen:
+                seen.add(id(tensor))
+                nbytes += tensor.numel() * tensor.element_size()
+    return nbytes
+
+
+class ModelCache:
+    """Thread safe LRU cache of loaded models, optionally bounded in number and in bytes.
+
+    When a limit is exceeded the least recently used models are dropped from the cache. Their memory is freed
+    once nothing else holds on to them. The model that was just loaded is never evicted, even if it alone is
+    over `max_bytes`.
+
+    Args:
+        max_entries (int, optional): Maximum number of cached models. Defaults to no limit.
+        max_bytes (int, optional): Maximum total size of the cached models' weights, see `model_nbytes`.
+            Defaults to no limit.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._models = OrderedDict()  # key -> (model, nbytes), least recently used first
+        self._lock = threading.RLock()  # guards the dict and the counters, never held while loading
+        self._loading = {}  # key -> lock held while that key's model loads
+
+    def __len__(self):
+        return len(self._models)
+
+    def __contains__(self, key):
+        return key in self._models
+
+    @property
+    def nbytes(self):
+        """Total size of the cached models."""
+        return sum(nbytes for _, nbytes in self._models.values())
+
+    def get(self, key, load):
+        """Get the model cached under `key`, calling `load()` to load it if it isn't cached.
+
+        A model requested from several threads at once is only loaded once, the others wait for it. Loading a
+        model doesn't hold up getting other models.
+        """
+        with self._lock:
+            if key in self._models:
+                return self._hit(key)
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                # Loaded by another thread in the meantime
+                if key in self._models:
+                    return self._hit(key)
+                self.misses += 1
+            try:
+                model = load()
+                nbytes = model_nbytes(model)
+                with self._lock:
+                    self._models[key] = (model, nbytes)
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            return model
+
+    def _hit(self, key):
+        self.hits += 1
+        self._models.move_to_end(key)
+        return self._models[key][0]
+
+    def resize(self, max_entries=None, max_bytes=None):
+        """Set new limits, evicting models as needed."""
+        with self._lock:
+            self.max_entries, self.max_bytes = max_entries, max_bytes
+            self._evict()
+
+    def remove(self, predicate):
+        """Drop every model whose key satisfies `predicate(key)`."""
+        with self._lock:
+            for key in [key for key in self._models if predicate(key)]:
+                del self._models[key]
+
+    def clear(self):
+        """Drop every cached model."""
+        with self._lock:
+            self._models.clear()
+
+    def _evict(self):
+        while len(self._models) > 1 and (
+            (self.max_entries is not None and len(self._models) > self.max_entries)
+            or (self.max_bytes is not None and self.nbytes > self.max_bytes)
+        ):
+            self._models.popitem(last=False)
+
+
+# Shared by everything in the process that loads models. Limit it with `model_cache.resize(...)`.
+model_cache = ModelCache()
+
+
+def _resolve_device(device):
+    device = torch.device(device if device is not None else default_device())
+    if device.type == "cuda" and device.index is None:
+        device = torch.device("cuda", torch.cuda.current_device())
+    return device
+
+
+def get_pipeline(model_id=DEFAULT_MODEL_ID, device=None, torch_dtype=None, use_auth_token=None):
+    """Get a `StableDiffusionPipeline`, loading it on first use.
+
+    Loaded pipelines are kept in the process-wide `model_cache` per (model id, dtype, device), so repeated
+    calls are free and nothing is downloaded or moved to an accelerator until a pipeline is actually needed.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import get_pipeline
+        >>> pipe = get_pipeline(device='cpu')
+        ```
+
+    Args:
+        model_id (str, optional): The Hugging Face repo ID or local path of the weights. Defaults to "runwayml/stable-diffusion-v1-5".
+        device (Union[str, torch.device], optional): Device to place the pipeline on. Defaults to CUDA when available, else CPU.
+        torch_dtype (torch.dtype, optional): Weight dtype. Defaults to float16 on CUDA and float32 elsewhere.
+        use_auth_token (Union[str, bool], optional): Token used to download gated weights. Defaults to the
+            `HF_TOKEN` environment variable if set, else the token saved by `huggingface-cli login`.
+
+    Returns:
+        stable_diffusion_videos.StableDiffusionPipeline: The (possibly cached) pipeline.
+    """
+    device = _resolve_device(device)
+    if use_auth_token is None:
+        use_auth_token = os.environ.get("HF_TOKEN") or True
+    if torch_dtype is None:
+        torch_dtype = torch.float16 if device.type == "cuda" else torch.float32
+
+    def load():
+        kwargs = dict(revision="fp16") if torch_dtype == torch.float16 else {}
+        return StableDiffusionPipeline.from_pretrained(
+            model_id,
+            use_auth_token=use_auth_token,
+            torch_dtype=torch_dtype,
+            **kwargs,
+        ).to(device)
+
+    return model_cache.get(("pipeline", model_id, torch_dtype, str(device)), load)
+
+
+def get_upsampler(model_name_or_path=DEFAULT_UPSAMPLER_ID, device=None, tile=0, tile_pad=10, pre_pad=0, fp32=False):
+    """Get a `PipelineRealESRGAN` upsampler, loading it on first use.
+
+    Like pipelines, upsamplers are kept in the process-wide `model_cache`, per (repo or path, precision, tile
+    settings, device).
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import get_upsampler
+        >>> upsampler = get_upsampler()
+        >>> im_out = upsampler('input_img.jpg')
+        ```
+
+    Args:
+        model_name_or_path (str, optional): The Hugging Face repo ID or path to local model. Defaults to 'nateraw/real-esrgan'.
+        device (Union[str, torch.device], optional): Device to run on. Defaults to CUDA when available, else CPU.
+        tile (int, optional): Upsample in tiles of this many pixels, 0 for whole images. Defaults to 0.
+        tile_pad (int, optional): Padding of each tile. Defaults to 10.
+        pre_pad (int, optional): Padding of the image borders. Defaults to 0.
+        fp32 (bool, optional): Run in float32 instead of float16. Defaults to False.
+
+    Returns:
+        stable_diffusion_videos.PipelineRealESRGAN: The (possibly cached) upsampler.
+    """
+    from .upsampling import PipelineRealESRGAN
+
+    device = _resolve_device(device)
+    key = ("real-esrgan", str(model_name_or_path), fp32, tile, tile_pad, pre_pad, str(device))
+    return model_cache.get(
+        key,
+        lambda: PipelineRealESRGAN.from_pretrained(
+            model_name_or_path, tile=tile, tile_pad=tile_pad, pre_pad=pre_pad, fp32=fp32, device=device
+        ),
+    )
+
+
+def clear_pipelines():
+    """Drop every cached pipeline so its memory can be reclaimed."""
+    model_cache.remove(lambda key: key[0] == "pipeline")
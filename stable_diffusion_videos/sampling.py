@@ -0,0 +1,107 @@
+import copy
+import functools
+import inspect
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from diffusers.schedulers import LMSDiscreteScheduler
+
+
+class SamplingPlan(NamedTuple):
+    """Everything about a denoising loop that only depends on the scheduler, the number of steps and the strength.
+
+    Plans are cached and shared between calls (and threads), so they must never be modified. Every call gets
+    a scheduler of its own from `make_scheduler`, which holds that call's stepping state (e.g. the model
+    outputs of previous steps that PNDM and LMS keep around).
+    """
+
+    scheduler: object  # prototype with the timesteps set, only ever copied
+    timesteps: torch.Tensor  # timesteps that are actually run, i.e. after skipping the first ones for strength < 1
+    t_start: int  # index of timesteps[0] among all the scheduler's timesteps
+    uses_sigmas: bool  # whether the scheduler is indexed by step and scales the model input by its sigmas
+    accepts_eta: bool
+
+    def make_scheduler(self):
+        """A fresh scheduler for one call, with the plan's timesteps set."""
+        return copy.deepcopy(self.scheduler)
+
+    def step_index(self, i, t):
+        """What to pass to `scheduler.step` for step `i`, with timestep `t`."""
+        return self.t_start + i if self.uses_sigmas else t
+
+    def sigma(self, i):
+        """Noise level of step `i` for schedulers that use sigmas."""
+        return self.scheduler.sigmas[self.t_start + i]
+
+    def noise_timesteps(self, batch_size, device=None):
+        """Timesteps to pass to `scheduler.add_noise` when starting from an image (strength < 1)."""
+        timestep = self.t_start if self.uses_sigmas else self.timesteps[0]
+        return torch.full((batch_size,), int(timestep), dtype=torch.long, device=device)
+
+    def guidance_modes(self, guidance_interval=None, guidance_every=1):
+        """How each step of `timesteps` applies classifier free guidance.
+
+        Steps whose position among all the scheduler's timesteps, as a fraction in [0, 1), lies in `guidance_interval`
+        are guided: every `guidance_every`-th of them runs the UNet on the unconditional input as well ("guide"), the
+        others reuse the guidance of the last step that did ("reuse"). Steps outside the interval aren't guided (None).
+        """
+        start, end = guidance_interval if guidance_interval is not None else (0.0, 1.0)
+        num_timesteps = len(self.scheduler.timesteps)
+        modes, num_guided = [], 0
+        for i in range(len(self.timesteps)):
+            if start <= (self.t_start + i) / num_timesteps < end:
+                modes.append("guide" if num_guided % guidance_every == 0 else "reuse")
+                num_guided += 1
+            else:
+                modes.append(None)
+        return modes
+
+    def step_kwargs(self, eta):
+        # eta is only used with the DDIMScheduler, it will be ignored for other schedulers.
+        return dict(eta=eta) if self.accepts_eta else {}
+
+
+def get_sampling_plan(scheduler, num_inference_steps, strength=1.0, start_step=None):
+    """Get the (cached) `SamplingPlan` of `num_inference_steps` steps with `scheduler` at `strength`.
+
+    `scheduler` is only used as a template and isn't modified. Plans are cached by the scheduler's class and
+    config, so equally configured schedulers share them, and the plan's scheduler is a new one made from that
+    config. If `start_step` is given, denoising starts at that index of the scheduler's timesteps instead of
+    where `strength` would start it.
+    """
+    return _get_sampling_plan(type(scheduler), _frozen_config(scheduler), num_inference_steps, strength, start_step)
+
+
+def _frozen_config(scheduler):
+    # Hashable version of the scheduler's config, with lists (e.g. `trained_betas`) as tuples
+    return tuple(
+        sorted((key, tuple(value) if isinstance(value, (list, np.ndarray)) else value)
+               for key, value in scheduler.config.items())
+    )
+
+
+@functools.lru_cache(maxsize=128)
+def _get_sampling_plan(scheduler_class, config, num_inference_steps, strength, start_step):
+    prototype = scheduler_class(**{key: value for key, value in config if not key.startswith("_")})
+    prototype.set_format("pt")
+    # Offset the timesteps by one, for schedulers that support it
+    if "offset" in inspect.signature(prototype.set_timesteps).parameters:
+        prototype.set_timesteps(num_inference_steps, offset=1)
+    else:
+        prototype.set_timesteps(num_inference_steps)
+
+    # With strength < 1 denoising starts part of the way in, see img2img
+    init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+    t_start = max(num_inference_steps - init_timestep, 0)
+    if start_step is not None:
+        if not 0 <= start_step < len(prototype.timesteps):
+            raise ValueError(f"`start_step` has to be in [0, {len(prototype.timesteps)}) but is {start_step}")
+        t_start = start_step
+    return SamplingPlan(
+        scheduler=prototype,
+        timesteps=prototype.timesteps[t_start:],
+        t_start=t_start,
+        uses_sigmas=isinstance(prototype, LMSDiscreteScheduler),
+        accepts_eta="eta" in inspect.signature(prototype.step).parameters,
+    )
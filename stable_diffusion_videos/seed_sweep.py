@@ -0,0 +1,206 @@
+import json
+import math
+from pathlib import Path
+
+import torch
+from PIL import Image, ImageDraw
+
+from .batch_sizing import MemoryPolicy, calibrate_batch_size
+from .registry import DEFAULT_MODEL_ID, get_pipeline
+from .stable_diffusion_pipeline import autocast
+from .stable_diffusion_walk import SCHEDULERS
+
+
+def sweep_seeds(
+    prompts,
+    seeds,
+    output_dir="dreams",
+    name="seed_sweep",
+    height=512,
+    width=512,
+    guidance_scale=7.5,
+    eta=0.0,
+    num_inference_steps=50,
+    scheduler="klms",
+    batch_size=8,
+    pipeline=None,
+    device=None,
+    thumbnail_size=256,
+    disable_tqdm=False,
+):
+    """Generate every prompt with every seed, to pick the seeds of a walk.
+
+    The images are the keyframes a `walk` with the same settings starts each prompt from (up to floating point
+    differences between batch sizes), without rendering any walk. Each prompt is encoded once, and the (prompt,
+    seed) pairs are generated `batch_size` at a time, several seeds of a prompt sharing its embedding. Every
+    prompt gets a sub directory with an image per seed and a `contact_sheet.jpg` of all of them, labeled with
+    their seeds. The sweep's settings and images are recorded in `sweep.json`, from which `choose_seeds` makes
+    the arguments of a walk.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import choose_seeds, sweep_seeds, walk
+        >>> sweep_seeds(['a cat', 'a dog'], seeds=range(16), name='animals_sweep')
+        >>> # Look at dreams/animals_sweep/prompt000/contact_sheet.jpg, ...
+        >>> walk(**choose_seeds(name='animals_sweep', choices=[3, 11]), num_steps=60, make_video=True)
+        ```
+
+    Args:
+        prompts (List[str]): Prompts to generate.
+        seeds (List[int]): Seeds to try for every prompt.
+        output_dir (str, optional): Root dir where the sweep is saved. Defaults to "dreams".
+        name (str, optional): Sub directory of output_dir to save the sweep to. Defaults to "seed_sweep".
+        height (int, optional): Height of the images. Defaults to 512.
+        width (int, optional): Width of the images. Defaults to 512.
+        guidance_scale (float, optional): Classifier free guidance scale. Defaults to 7.5.
+        eta (float, optional): ETA. Defaults to 0.0.
+        num_inference_steps (int, optional): Number of diffusion steps. Defaults to 50.
+        scheduler (str, optional): Which scheduler to use, one of "default", "ddim" and "klms". Defaults to "klms".
+        batch_size (Union[int, str], optional): Number of images per pipeline call, or "auto" to pick the largest
+            that fits in memory (see `calibrate_batch_size`). Batches that run out of memory are split. Defaults to 8.
+        pipeline (StableDiffusionPipeline, optional): Pipeline to generate with. Defaults to the pipeline returned
+            by `get_pipeline(device=device)`.
+        device (Union[str, torch.device], optional): Device to load the default pipeline on when `pipeline` is not given.
+        thumbnail_size (int, optional): Size of the longer side of the images on the contact sheets. Defaults to 256.
+        disable_tqdm (bool, optional): Whether to turn off the tqdm progress bars. Defaults to False.
+
+    Returns:
+        dict: The contents of `sweep.json`.
+    """
+    if pipeline is None:
+        pipeline = get_pipeline(DEFAULT_MODEL_ID, device=device)
+    pipeline.set_progress_bar_config(disable=disable_tqdm)
+    prompts, seeds = list(prompts), [int(seed) for seed in seeds]
+    if not prompts or not seeds:
+        raise ValueError("Need at least one prompt and one seed")
+    if batch_size == "auto":
+        batch_size = calibrate_batch_size(pipeline, height, width, guidance_scale, SCHEDULERS[scheduler])
+        print(f"Using batch_size={batch_size}")
+
+    output_path = Path(output_dir) / name
+    prompt_paths = [output_path / f"prompt{i:03d}" for i in range(len(prompts))]
+    for path in prompt_paths:
+        path.mkdir(exist_ok=True, parents=True)
+
+    # Same noise as a walk's keyframe with this seed
+    def noise(seed):
+        return torch.randn(
+            (1, pipeline.unet.in_channels, height // 8, width // 8),
+            device=pipeline.device,
+            generator=torch.Generator(device=pipeline.device).manual_seed(seed),
+        )
+
+    embeds = pipeline.embed_prompts(prompts)
+    jobs = [(prompt_index, seed) for prompt_index in range(len(prompts)) for seed in seeds]
+    memory_policy = MemoryPolicy(max_batch_size=batch_size)
+    thumbnails = {}
+    with autocast(pipeline.device):
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs[start:start + batch_size]
+            prompt_indices = torch.tensor([prompt_index for prompt_index, _ in batch], device=embeds.device)
+            samples = memory_policy(
+                pipeline,
+                latents=torch.cat([noise(seed) for _, seed in batch]),
+                text_embeddings=embeds.index_select(0, prompt_indices),
+                height=height,
+                width=width,
+                guidance_scale=guidance_scale,
+                eta=eta,
+                num_inference_steps=num_inference_steps,
+                scheduler=SCHEDULERS[scheduler],
+            )["sample"]
+            for (prompt_index, seed), image in zip(batch, samples):
+                image_path = prompt_paths[prompt_index] / f"seed{seed}.png"
+                image.save(image_path)
+                image.thumbnail((thumbnail_size, thumbnail_size))
+                thumbnails[prompt_index, seed] = image
+
+    for prompt_index, path in enumerate(prompt_paths):
+        sheet = contact_sheet([thumbnails[prompt_index, seed] for seed in seeds], [f"seed {seed}" for seed in seeds])
+        sheet.save(path / "contact_sheet.jpg", quality=90)
+
+    record = dict(
+        settings=dict(
+            height=height,
+            width=width,
+            guidance_scale=guidance_scale,
+            eta=eta,
+            num_inference_steps=num_inference_steps,
+            scheduler=scheduler,
+        ),
+        seeds=seeds,
+        prompts=[
+            dict(
+                prompt=prompt,
+                contact_sheet=f"{path.name}/contact_sheet.jpg",
+                images={str(seed): f"{path.name}/seed{seed}.png" for seed in seeds},
+                chosen_seed=None,
+            )
+            for prompt, path in zip(prompts, prompt_paths)
+        ],
+    )
+    (output_path / "sweep.json").write_text(json.dumps(record, indent=2))
+    print(f"Swept {len(seeds)} seeds for {len(prompts)} prompts in {len(range(0, len(jobs), batch_size))} batches, see {output_path}")
+    return record
+
+
+def choose_seeds(output_dir="dreams", name="seed_sweep", choices=None):
+    """Pick a seed for every prompt of a sweep, and get the arguments of a walk through them.
+
+    The choices are recorded in the sweep's `sweep.json`, so they can also be made by editing its `chosen_seed`
+    fields, and picked up by calling this without `choices`.
+
+    Args:
+        output_dir (str, optional): Root dir of the sweep. Defaults to "dreams".
+        name (str, optional): Sub directory of output_dir the sweep was saved to. Defaults to "seed_sweep".
+        choices (Union[List[int], Dict[int, int]], optional): Seed for every prompt, in order, or a mapping from prompt
+            index to seed to change only some of them. Defaults to the choices already recorded.
+
+    Returns:
+        dict: `prompts`, `seeds` and the image settings of the sweep, to pass on to `walk`.
+    """
+    sweep_path = Path(output_dir) / name / "sweep.json"
+    record = json.loads(sweep_path.read_text())
+    entries = record["prompts"]
+    if choices is not None:
+        if not isinstance(choices, dict):
+            choices = list(choices)
+            if len(choices) != len(entries):
+                raise ValueError(f"Got {len(choices)} seeds for the {len(entries)} prompts of the sweep")
+            choices = dict(enumerate(choices))
+        for prompt_index, seed in choices.items():
+            if int(seed) not in record["seeds"]:
+                raise ValueError(f"Seed {seed} wasn't part of the sweep, choose from {record['seeds']}")
+            entries[int(prompt_index)]["chosen_seed"] = int(seed)
+        sweep_path.write_text(json.dumps(record, indent=2))
+
+    missing = [i for i, entry in enumerate(entries) if entry["chosen_seed"] is None]
+    if missing:
+        raise ValueError(f"No seed chosen yet for prompt(s) {missing} of {sweep_path}")
+    return dict(
+        prompts=[entry["prompt"] for entry in entries],
+        seeds=[entry["chosen_seed"] for entry in entries],
+        **record["settings"],
+    )
+
+
+def contact_sheet(images, labels):
+    """Lay same sized `images` out in a square-ish grid, each with its label in the bottom left corner."""
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    cell = images[0].size
+    sheet = Image.new("RGB", (columns * cell[0], rows * cell[1]))
+    draw = ImageDraw.Draw(sheet)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        x, y = (i % columns) * cell[0], (i // columns) * cell[1]
+        sheet.paste(image.convert("RGB"), (x, y))
+        left, top, right, bottom = draw.textbbox((x + 4, y + cell[1] - 16), label)
+        draw.rectangle((left - 2, top - 2, right + 2, bottom + 2), fill=(0, 0, 0))
+        draw.text((x + 4, y + cell[1] - 16), label, fill=(255, 255, 255))
+    return sheet
+
+
+if __name__ == "__main__":
+    import fire
+
+    fire.Fire(dict(sweep=sweep_seeds, choose=choose_seeds))
@@ -0,0 +1,199 @@
+import functools
+import inspect
+import json
+import multiprocessing
+import os
+import re
+import queue
+import shutil
+from multiprocessing.connection import wait
+from pathlib import Path
+
+import torch
+
+from .latent_store import KeyframeLatentStore
+from .planner import WalkPlan
+from .registry import DEFAULT_MODEL_ID, get_pipeline
+from .stable_diffusion_walk import make_video_ffmpeg, walk
+
+
+def _run_shard(shard, device, pipeline_factory, walk_kwargs, latent_channels, store_ready):
+    pipeline = pipeline_factory(device=device)
+    # The coordinator creates the keyframe latent store once a worker tells it the shape of the latents
+    latent_channels.put(pipeline.unet.in_channels)
+    while not store_ready.wait(timeout=0.1):
+        if shard["stop_event"].is_set():
+            return
+    walk(pipeline=pipeline, shard=shard, **walk_kwargs)
+
+
+def _merge_shards(shards_path, num_shards, output_path, num_frames, frame_filename_ext):
+    # Move the shards' frames in order into the run directory, and sum up their reports
+    frame_pattern = re.compile(r"frame(\d{6})" + re.escape(frame_filename_ext) + "$")
+    merged = set()
+    executed_batches = 0
+    shard_timings = []
+    for index in range(num_shards):
+        shard_path = Path(shards_path) / str(index)
+        for frame_path in sorted(shard_path.iterdir()):
+            match = frame_pattern.match(frame_path.name)
+            if match:
+                os.replace(frame_path, Path(output_path) / frame_path.name)
+                merged.add(int(match.group(1)))
+        shard_report = json.loads((shard_path / "plan_report.json").read_text())
+        executed_batches += shard_report["executed_batches"]
+        shard_timings.append(dict(batch_times=shard_report["batch_times"], handoff_wait_s=shard_report["handoff_wait_s"]))
+    missing = sorted(set(range(num_frames)) - merged)
+    extra = sorted(merged - set(range(num_frames)))
+    if missing or extra:
+        problems = []
+        if missing:
+            problems.append(f"{len(missing)} frame(s) missing, e.g. frame {missing[0]}")
+        if extra:
+            problems.append(f"{len(extra)} frame(s) beyond the last one ({num_frames - 1}), e.g. frame {extra[0]}")
+        raise RuntimeError(f"The workers didn't write the expected frames: {'; '.join(problems)}")
+    return executed_batches, shard_timings
+
+
+def walk_sharded(
+    num_workers=None,
+    devices=None,
+    pipeline_factory=None,
+    **walk_kwargs,
+):
+    """Render a walk with several worker processes, e.g. one per GPU, and merge their frames.
+
+    The walk's batches (see `WalkPlan`) are split into contiguous ranges of about equal work, one per worker.
+    Each worker loads its own pipeline and writes its frames, numbered as in a single process run, to
+    `<output_dir>/<name>/shards/<worker>`. Once all of them are done the frames are moved into the run
+    directory as one contiguous `frame%06d` sequence and the video is made from them.
+
+    A worker's first in-between frames are interpolated from the last latent of the previous worker's range,
+    which is handed over through the run's keyframe latent store. The worker makes those frames last, after its
+    own range, so the workers run at the same time. Chained walks (`strength < 1` with latent interpolation) are
+    split at segment boundaries, but as every batch there starts from the previous one, a worker can only start
+    generating once the previous one is done. Only plain walks get faster. Each worker's `plan_report.json` in
+    its shard directory has the wall clock start and end of every UNet batch it ran and how long it waited for
+    the previous worker, and the run's `plan_report.json` collects them.
+
+    The frames are byte-identical to those of `walk` with the same arguments, as long as the VAE decodes the
+    same number of latents at a time in both (pass `decode_chunk_size` to be sure) and the devices compute
+    the same results. With `warm_start` and a `batch_size` above 1 they can differ by rounding: a worker denoises
+    the previous worker's last keyframe again on its own, rather than in a batch with its neighbours.
+
+    Worker processes are spawned, so call this from under `if __name__ == "__main__":` in scripts.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import walk_sharded
+        >>> walk_sharded(devices=['cuda:0', 'cuda:1'], prompts=['a cat', 'a dog'], seeds=[42, 1337], num_steps=120)
+        ```
+
+    Args:
+        num_workers (int, optional): Number of worker processes. Defaults to the number of `devices`, or of GPUs.
+        devices (List[Union[str, torch.device]], optional): Device of each worker, cycled if there are more workers.
+            Defaults to one GPU per worker if there are any, else the CPU.
+        pipeline_factory (Callable, optional): Picklable callable that each worker calls with `device=<device>`
+            to get its pipeline. Defaults to loading the default model with `get_pipeline`.
+        **walk_kwargs: Arguments of `walk`. `resume`, `pipeline` and `device` aren't supported, and the video is
+            always made from the saved frames.
+
+    Returns:
+        str: Path to video file saved if make_video=True, else None.
+    """
+    for unsupported in ("resume", "pipeline", "device", "shard"):
+        if walk_kwargs.get(unsupported):
+            raise ValueError(f"walk_sharded doesn't support `{unsupported}`")
+    if walk_kwargs.get("batch_size") == "auto":
+        raise ValueError("walk_sharded needs a fixed `batch_size`, every worker has to plan the same batches")
+    if walk_kwargs.get("save_frames") is False:
+        raise ValueError("walk_sharded merges saved frames, so `save_frames` can't be turned off")
+
+    if devices is None:
+        num_gpus = torch.cuda.device_count()
+        devices = [f"cuda:{i}" for i in range(num_gpus)] if num_gpus else ["cpu"]
+    if num_workers is None:
+        num_workers = len(devices)
+    if pipeline_factory is None:
+        pipeline_factory = functools.partial(get_pipeline, DEFAULT_MODEL_ID)
+
+    # Fill in walk's defaults, so the plan is the one every worker will compute
+    args = inspect.signature(walk).bind(**walk_kwargs)
+    args.apply_defaults()
+    args = args.arguments
+    num_segments = len(args["prompts"]) - (0 if args["do_loop"] else 1)
+    plan = WalkPlan(
+        num_segments,
+        args["num_steps"],
+        args["batch_size"],
+        chain_batches=args["strength"] < 1 and bool(args["latent_interpolation_steps"]),
+    )
+    shards = plan.shards(num_workers)
+
+    output_path = Path(args["output_dir"]) / args["name"]
+    output_path.mkdir(exist_ok=True, parents=True)
+    shards_path = output_path / "shards"
+    if shards_path.exists():
+        shutil.rmtree(shards_path)
+
+    context = multiprocessing.get_context("spawn")
+    stop_event, store_ready, latent_channels = context.Event(), context.Event(), context.Queue()
+    processes = []
+    for index, (start, stop) in enumerate(shards):
+        shard = dict(index=index, start=start, stop=stop, frames_dir=str(shards_path / str(index)), stop_event=stop_event)
+        process = context.Process(
+            target=_run_shard,
+            args=(shard, devices[index % len(devices)], pipeline_factory, walk_kwargs, latent_channels, store_ready),
+            name=f"walk-shard-{index}",
+        )
+        process.start()
+        processes.append(process)
+
+    try:
+        # The latents have as many channels as the UNet's input, which only the workers' pipelines know
+        while True:
+            try:
+                channels = latent_channels.get(timeout=0.5)
+                break
+            except queue.Empty:
+                for process in processes:
+                    if process.exitcode is not None:
+                        raise RuntimeError(f"Walk worker {process.name} failed with exit code {process.exitcode}")
+        latent_shape = (channels, args["height"] // 8, args["width"] // 8)
+        KeyframeLatentStore(output_path, plan.num_keyframes, latent_shape, create=True).flush()
+        store_ready.set()
+
+        running = list(processes)
+        while running:
+            wait([process.sentinel for process in running])
+            for process in [process for process in running if not process.is_alive()]:
+                running.remove(process)
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError(f"Walk worker {process.name} failed with exit code {process.exitcode}")
+    finally:
+        # Wake up workers waiting for a latent that will never come, then make sure they're gone
+        stop_event.set()
+        for process in processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    frame_filename_ext = args["frame_filename_ext"]
+    num_frames = plan.frame_ranges(args["latent_interpolation_steps"])[-1][1]
+    executed_batches, shard_timings = _merge_shards(shards_path, len(shards), output_path, num_frames, frame_filename_ext)
+
+    report = plan.report(executed_batches=executed_batches)
+    report["shards"] = shards
+    report["shard_timings"] = shard_timings
+    (output_path / "plan_report.json").write_text(json.dumps(report, indent=2))
+
+    if args["make_video"]:
+        return make_video_ffmpeg(
+            output_path,
+            f"{args['name']}.mp4",
+            fps=args["fps"],
+            frame_filename=f"frame%06d{frame_filename_ext}",
+            **(args["encode_kwargs"] or {}),
+        )
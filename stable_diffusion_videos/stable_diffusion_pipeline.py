@@ -1,7 +1,7 @@
-import inspect
+import contextlib
 import warnings
 from tqdm.auto import tqdm
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import torch
 from diffusers import ModelMixin
@@ -13,6 +13,18 @@ from diffusers.schedulers import (DDIMScheduler, LMSDiscreteScheduler,
                                   PNDMScheduler)
 from transformers import CLIPFeatureExtractor, CLIPTextModel, CLIPTokenizer
 
+from .embedding_cache import TextEmbeddingCache
+from .memory import available_memory, to_device
+from .profiling import get_profiler
+from .sampling import get_sampling_plan
+
+
+def autocast(device):
+    """Mixed precision context for `device`. Autocast is only used on CUDA, elsewhere this is a no-op."""
+    if torch.device(device).type == "cuda":
+        return torch.autocast("cuda")
+    return contextlib.nullcontext()
+
 
 class StableDiffusionPipeline(DiffusionPipeline):
     def __init__(
@@ -36,7 +48,8 @@ class StableDiffusionPipeline(DiffusionPipeline):
             safety_checker=safety_checker,
             feature_extractor=feature_extractor,
         )
-    
+        self.embedding_cache = TextEmbeddingCache()
+
     def enable_attention_slicing(self, slice_size: Optional[Union[str, int]] = "auto"):
         r"""
         Enable sliced attention computation.
@@ -64,6 +77,24 @@ class StableDiffusionPipeline(DiffusionPipeline):
         # set slice_size = `None` to disable `attention slicing`
         self.enable_attention_slicing(None)
 
+    @property
+    def attention_slice_size(self):
+        """The UNet's current attention slice size, None when attention isn't sliced."""
+        for module in self.unet.modules():
+            if hasattr(module, "_slice_size"):
+                return module._slice_size
+        return None
+
+    @contextlib.contextmanager
+    def attention_slicing(self, slice_size: Optional[Union[str, int]] = "auto"):
+        """Slice attention (see `enable_attention_slicing`) within a `with` block only, then restore the previous setting."""
+        previous = self.attention_slice_size
+        self.enable_attention_slicing(slice_size)
+        try:
+            yield
+        finally:
+            self.unet.set_attention_slice(previous)
+
     @torch.no_grad()
     def __call__(
         self,
@@ -71,7 +102,7 @@ class StableDiffusionPipeline(DiffusionPipeline):
         height: Optional[int] = 512,
         width: Optional[int] = 512,
         num_inference_steps: Optional[int] = 50,
-        guidance_scale: Optional[float] = 7.5,
+        guidance_scale: Optional[Union[float, List[float]]] = 7.5,
         eta: Optional[float] = 0.0,
         generator: Optional[torch.Generator] = None,
         latents: Optional[torch.FloatTensor] = None,
@@ -79,8 +110,22 @@ class StableDiffusionPipeline(DiffusionPipeline):
         output_type: Optional[str] = "pil",
         strength: Optional[float] = 1.0,
         prev_img: Optional[torch.FloatTensor] = None,
+        scheduler: Optional[Union[DDIMScheduler, PNDMScheduler, LMSDiscreteScheduler]] = None,
+        record_step: Optional[int] = None,
+        start_step: Optional[int] = None,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        guidance_every: int = 1,
         **kwargs,
     ):
+        # `scheduler` (or `self.scheduler`) is only a template: every call steps a copy of its own, so the
+        # pipeline can be called from several threads at once.
+        # `record_step` and `start_step` are indices into the scheduler's timesteps. The latents right before
+        # step `record_step` are returned as "intermediate_latent", and a later call with `start_step` set to
+        # the same index continues denoising from (an interpolation of) them instead of from noise.
+        # `output_type="latent"` skips decoding and returns the latents as "sample".
+        # `guidance_interval` (start, end) limits classifier free guidance to the steps within that fraction of the
+        # denoising, and with `guidance_every` k only every k-th of those runs the unconditional UNet pass, the
+        # others reuse its last guidance. Unguided steps only run the conditional half of the batch.
         if "torch_device" in kwargs:
             device = kwargs.pop("torch_device")
             warnings.warn(
@@ -94,6 +139,8 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 device = "cuda" if torch.cuda.is_available() else "cpu"
             self.to(device)
 
+        profiler = get_profiler()
+
         if text_embeddings is None:
             if isinstance(prompt, str):
                 batch_size = 1
@@ -111,34 +158,27 @@ class StableDiffusionPipeline(DiffusionPipeline):
                 )
 
             # get prompt text embeddings
-            text_input = self.tokenizer(
-                prompt,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-            text_embeddings = self.text_encoder(text_input.input_ids.to(self.device))[0]
+            text_embeddings = self.embed_prompts(prompt)
         else:
             batch_size = text_embeddings.shape[0]
 
         # here `guidance_scale` is defined analog to the guidance weight `w` of equation (2)
         # of the Imagen paper: https://arxiv.org/pdf/2205.11487.pdf . `guidance_scale = 1`
         # corresponds to doing no classifier free guidance.
-        do_classifier_free_guidance = guidance_scale > 1.0
+        if isinstance(guidance_scale, (list, tuple)):
+            # One guidance scale per image of the batch
+            if len(set(guidance_scale)) == 1:
+                guidance_scale = guidance_scale[0]
+            else:
+                guidance_scale = torch.tensor(guidance_scale, device=self.device).view(-1, 1, 1, 1)
+        do_classifier_free_guidance = bool((torch.as_tensor(guidance_scale) > 1.0).any())
+        if guidance_every < 1:
+            raise ValueError(f"`guidance_every` has to be at least 1 but is {guidance_every}")
+        cond_embeddings = text_embeddings
         # get unconditional embeddings for classifier free guidance
         if do_classifier_free_guidance:
-            # max_length = text_input.input_ids.shape[-1]
-            max_length = 77  # self.tokenizer.model_max_length
-            uncond_input = self.tokenizer(
-                [""] * batch_size,
-                padding="max_length",
-                max_length=max_length,
-                return_tensors="pt",
-            )
-            uncond_embeddings = self.text_encoder(
-                uncond_input.input_ids.to(self.device)
-            )[0]
+            # the unconditional embedding is encoded once per text encoder and broadcast to the batch
+            uncond_embeddings = self.get_uncond_embeddings(batch_size)
 
             # For classifier free guidance, we need to do two forward passes.
             # Here we concatenate the unconditional and text embeddings into a single batch
@@ -159,76 +199,83 @@ class StableDiffusionPipeline(DiffusionPipeline):
                     f"Unexpected latents shape, got {latents.shape}, expected"
                     f" {latents_shape}"
                 )
-            latents = latents.to(self.device)
+            latents = to_device(latents, self.device)
 
-        # set timesteps
-        accepts_offset = "offset" in set(
-            inspect.signature(self.scheduler.set_timesteps).parameters.keys()
-        )
-        extra_set_kwargs = {}
-        if accepts_offset:
-            extra_set_kwargs["offset"] = 1
+        if start_step is not None and strength < 1:
+            raise ValueError("`start_step` and `strength` < 1 can't be combined")
 
-        self.scheduler.set_timesteps(num_inference_steps, **extra_set_kwargs)
-        timesteps, num_inference_steps = self.get_timesteps(num_inference_steps, strength)
-        # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
-        if isinstance(self.scheduler, LMSDiscreteScheduler):
-            latents = latents * self.scheduler.sigmas[0]
+        # timesteps, sigmas etc. are computed once per (scheduler, num_inference_steps, strength)
+        plan = get_sampling_plan(
+            scheduler if scheduler is not None else self.scheduler, num_inference_steps, strength, start_step
+        )
+        scheduler = plan.make_scheduler()
+        timesteps = plan.timesteps
 
         if strength < 1:
             assert prev_img is not None, "Need to provide a img to allow for img2img generations"
-            latents = self.scheduler.add_noise(original_samples= 0.18215 * prev_img, noise=latents, timesteps=torch.tensor([timesteps[:1].repeat(latents.shape[0])
-],dtype=torch.long)).float()
+            latents = scheduler.add_noise(original_samples= 0.18215 * prev_img, noise=latents, timesteps=plan.noise_timesteps(latents.shape[0], latents.device)).float()
             assert latents.shape[0] == batch_size, "Somehow batchsize was not broadcasted"
-        # prepare extra kwargs for the scheduler step, since not all schedulers have the same signature
+        elif start_step is not None:
+            # already partially denoised, and scaled by the sigmas if the scheduler uses them
+            pass
+        elif plan.uses_sigmas:
+            # if we use LMSDiscreteScheduler, let's make sure latents are mulitplied by sigmas
+            latents = latents * plan.sigma(0)
         # eta (η) is only used with the DDIMScheduler, it will be ignored for other schedulers.
         # eta corresponds to η in DDIM paper: https://arxiv.org/abs/2010.02502
         # and should be between [0, 1]
-        accepts_eta = "eta" in set(
-            inspect.signature(self.scheduler.step).parameters.keys()
-        )
-        extra_step_kwargs = {}
-        if accepts_eta:
-            extra_step_kwargs["eta"] = eta
+        extra_step_kwargs = plan.step_kwargs(eta)
+        guidance_modes = plan.guidance_modes(guidance_interval, guidance_every)
+        guidance_delta = None  # noise_pred_text - noise_pred_uncond of the last guided step, when it's reused
 
+        intermediate_latents = None
         for i, t in enumerate(self.progress_bar(timesteps)):
+            if plan.t_start + i == record_step:
+                intermediate_latents = latents
+            guide = do_classifier_free_guidance and guidance_modes[i] == "guide"
             # expand the latents if we are doing classifier free guidance
             latent_model_input = (
-                torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+                torch.cat([latents] * 2) if guide else latents
             )
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                sigma = self.scheduler.sigmas[i]
+            if plan.uses_sigmas:
+                sigma = plan.sigma(i)
                 # the model input needs to be scaled to match the continuous ODE formulation in K-LMS
                 latent_model_input = latent_model_input / ((sigma**2 + 1) ** 0.5)
 
             # predict the noise residual
-            noise_pred = self.unet(
-                latent_model_input, t, encoder_hidden_states=text_embeddings
-            )["sample"]
+            with profiler.stage("unet", step=i, batch_size=batch_size):
+                noise_pred = self.unet(
+                    latent_model_input, t, encoder_hidden_states=text_embeddings if guide else cond_embeddings
+                )["sample"]
 
             # perform guidance
-            if do_classifier_free_guidance:
+            if guide:
                 noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
                 noise_pred = noise_pred_uncond + guidance_scale * (
                     noise_pred_text - noise_pred_uncond
                 )
+                if guidance_every > 1:
+                    guidance_delta = noise_pred_text - noise_pred_uncond
+            elif do_classifier_free_guidance and guidance_modes[i] == "reuse":
+                noise_pred = noise_pred + (guidance_scale - 1) * guidance_delta
 
             # compute the previous noisy sample x_t -> x_t-1
-            if isinstance(self.scheduler, LMSDiscreteScheduler):
-                latents = self.scheduler.step(
-                    noise_pred, i, latents, **extra_step_kwargs
-                )["prev_sample"]
-            else:
-                latents = self.scheduler.step(
-                    noise_pred, t, latents, **extra_step_kwargs
+            with profiler.stage("scheduler_step", step=i):
+                latents = scheduler.step(
+                    noise_pred, plan.step_index(i, t), latents, **extra_step_kwargs
                 )["prev_sample"]
 
         # scale and decode the image latents with vae
         latents = 1 / 0.18215 * latents
-        image = self.vae.decode(latents).sample
-
-        image = (image / 2 + 0.5).clamp(0, 1)
-        image = image.cpu().permute(0, 2, 3, 1).numpy()
+        if output_type == "latent":
+            return {"sample": latents, "nsfw_content_detected": [False], "latent": latents, "intermediate_latent": intermediate_latents}
+        image = self.decode_latents(latents, chunk_size=latents.shape[0])
+        if output_type == "pt":
+            # Images stay on the device, as (batch_size, 3, height, width) with values in [0, 1]
+            return {"sample": image, "nsfw_content_detected": [False], "latent": latents, "intermediate_latent": intermediate_latents}
+
+        with profiler.stage("postprocess"):
+            image = image.cpu().permute(0, 2, 3, 1).numpy()
         if False:
             safety_cheker_input = self.feature_extractor(
                 self.numpy_to_pil(image), return_tensors="pt"
@@ -239,32 +286,149 @@ class StableDiffusionPipeline(DiffusionPipeline):
         else:
             has_nsfw_concept = [False]
         if output_type == "pil":
-            image = self.numpy_to_pil(image)
+            with profiler.stage("postprocess"):
+                image = self.numpy_to_pil(image)
 
-        return {"sample": image, "nsfw_content_detected": has_nsfw_concept, "latent": latents}
+        return {
+            "sample": image,
+            "nsfw_content_detected": has_nsfw_concept,
+            "latent": latents,
+            "intermediate_latent": intermediate_latents,
+        }
 
     def embed_text(self, text):
         """Helper to embed some text"""
-        with torch.autocast("cuda"):
-            text_input = self.tokenizer(
-                text,
-                padding="max_length",
-                max_length=self.tokenizer.model_max_length,
-                truncation=True,
-                return_tensors="pt",
-            )
-            with torch.no_grad():
-                embed = self.text_encoder(text_input.input_ids.to(self.device))[0]
+        with autocast(self.device):
+            embed = self.embed_prompts(text)
         return embed
 
-    def get_timesteps(self, num_inference_steps, strength):
-        # get the original timestep using init_timestep
-        init_timestep = min(int(num_inference_steps * strength), num_inference_steps)
+    @torch.no_grad()
+    def embed_prompts(self, prompts):
+        """Embed one or more prompts, reusing cached embeddings where possible.
+
+        Prompts missing from `self.embedding_cache` are encoded together in a single text encoder pass.
+
+        Args:
+            prompts (Union[str, List[str]]): Prompt(s) to embed.
+
+        Returns:
+            torch.FloatTensor: Embeddings of shape (len(prompts), seq_len, hidden_size).
+        """
+        if isinstance(prompts, str):
+            prompts = [prompts]
+
+        encoder_key = self.embedding_cache.encoder_key(self.text_encoder)
+        embeddings = {prompt: self.embedding_cache.get(encoder_key, prompt) for prompt in dict.fromkeys(prompts)}
+        missing = [prompt for prompt, embed in embeddings.items() if embed is None]
+        if missing:
+            with get_profiler().stage("text_encode", num_prompts=len(missing)):
+                text_input = self.tokenizer(
+                    missing,
+                    padding="max_length",
+                    max_length=self.tokenizer.model_max_length,
+                    truncation=True,
+                    return_tensors="pt",
+                )
+                encoded = self.text_encoder(to_device(text_input.input_ids, self.device))[0]
+            for prompt, embed in zip(missing, encoded.split(1)):
+                self.embedding_cache.put(encoder_key, prompt, embed)
+                embeddings[prompt] = embed
+        return torch.cat([embeddings[prompt] for prompt in prompts])
 
-        t_start = max(num_inference_steps - init_timestep, 0)
-        timesteps = self.scheduler.timesteps[t_start :]
+    def get_uncond_embeddings(self, batch_size):
+        """Embedding of the empty prompt used for classifier free guidance, expanded to `batch_size`."""
+        return self.embed_prompts("").expand(batch_size, -1, -1)
 
-        return timesteps, num_inference_steps - t_start
+    def decode_latents(self, latents, chunk_size=None, tile_size=None, tile_overlap=8):
+        """Decode (already unscaled) latents to images with values in [0, 1], see `iter_decode_latents`.
+
+        Returns:
+            torch.FloatTensor: Images of shape (batch_size, 3, height, width), on the pipeline's device.
+        """
+        return torch.cat(list(self.iter_decode_latents(latents, chunk_size, tile_size, tile_overlap)))
+
+    @torch.no_grad()
+    def iter_decode_latents(self, latents, chunk_size=None, tile_size=None, tile_overlap=8):
+        """Decode latents with the VAE in chunks, yielding images with values in [0, 1] chunk by chunk.
+
+        Args:
+            latents (torch.FloatTensor): Latents already divided by the VAE scaling factor, i.e. the
+                `"latent"` output of `__call__`.
+            chunk_size (int, optional): Number of latents decoded per VAE call. Defaults to as many as
+                fit in the memory currently available on the device.
+            tile_size (int, optional): If given, each latent is decoded in overlapping tiles of
+                `tile_size` x `tile_size` latent pixels that are blended together, so the activation peak
+                no longer grows with the frame size. Tiles see less context than the full latent, so the
+                result is close to, but not exactly, the untiled decode. Defaults to None (no tiling).
+            tile_overlap (int, optional): Overlap between neighbouring tiles in latent pixels. Defaults to 8.
+
+        Yields:
+            torch.FloatTensor: Images of shape (chunk_size, 3, height, width), on the pipeline's device.
+        """
+        if tile_size is not None and not 0 <= tile_overlap < tile_size:
+            raise ValueError(f"`tile_overlap` has to be in [0, tile_size) but is {tile_overlap}")
+        if latents.shape[0] == 0:
+            return
+        if chunk_size is None:
+            chunk_size = self.auto_decode_chunk_size(latents.shape[-2:], tile_size)
+        profiler = get_profiler()
+        for chunk in latents.split(max(chunk_size, 1)):
+            with profiler.stage("vae_decode", batch_size=chunk.shape[0]):
+                if tile_size is None:
+                    image = self.vae.decode(chunk).sample
+                else:
+                    image = self._decode_tiled(chunk, tile_size, tile_overlap)
+                image = (image / 2 + 0.5).clamp(0, 1)
+            yield image
+
+    def auto_decode_chunk_size(self, latent_size, tile_size=None):
+        """Largest number of latents of spatial size `latent_size` that can be decoded at once in the memory available."""
+        height, width = latent_size
+        if tile_size is not None:
+            height, width = min(height, tile_size), min(width, tile_size)
+        # Rough upper bound of the decoder's peak activation memory per image, measured on the SD VAE
+        element_size = torch.finfo(self.vae.dtype).bits // 8
+        bytes_per_image = (height * 8) * (width * 8) * self.vae.config.block_out_channels[0] * element_size * 12
+        return max(int(0.8 * available_memory(self.device)) // bytes_per_image, 1)
+
+    def _decode_tiled(self, latents, tile_size, tile_overlap):
+        height, width = latents.shape[-2:]
+        scale = 8
+        stride = max(tile_size - tile_overlap, 1)
+
+        def tile_starts(size):
+            if size <= tile_size:
+                return [0]
+            starts = list(range(0, size - tile_size, stride))
+            return starts + [size - tile_size]
+
+        image, weight = None, None
+        for top in tile_starts(height):
+            for left in tile_starts(width):
+                tile = latents[..., top:top + tile_size, left:left + tile_size]
+                decoded = self.vae.decode(tile).sample
+                if image is None:
+                    image = decoded.new_zeros((*decoded.shape[:2], height * scale, width * scale))
+                    weight = decoded.new_zeros((1, 1, height * scale, width * scale))
+
+                # Blend linearly across the overlap, except at the borders of the image
+                tile_weight = decoded.new_ones(decoded.shape[-2:])
+                ramp_size = tile_overlap * scale
+                ramp = torch.arange(1, ramp_size + 1, device=decoded.device, dtype=decoded.dtype) / (ramp_size + 1)
+                if ramp_size > 0 and top > 0:
+                    tile_weight[:ramp_size] *= ramp[:, None]
+                if ramp_size > 0 and top + tile_size < height:
+                    tile_weight[-ramp_size:] *= ramp.flip(0)[:, None]
+                if ramp_size > 0 and left > 0:
+                    tile_weight[:, :ramp_size] *= ramp[None]
+                if ramp_size > 0 and left + tile_size < width:
+                    tile_weight[:, -ramp_size:] *= ramp.flip(0)[None]
+
+                rows = slice(top * scale, top * scale + decoded.shape[-2])
+                cols = slice(left * scale, left * scale + decoded.shape[-1])
+                image[..., rows, cols] += decoded * tile_weight
+                weight[..., rows, cols] += tile_weight
+        return image / weight
 
 
 class NoCheck(ModelMixin):
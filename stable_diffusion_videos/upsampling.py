@@ -1,9 +1,17 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
 from PIL import Image
 from huggingface_hub import hf_hub_download
 
+from .frame_writer import AsyncFrameWriter
+from .profiling import get_profiler
+
 try:
     from realesrgan import RealESRGANer
     from basicsr.archs.rrdbnet_arch import RRDBNet
@@ -14,8 +22,10 @@ except ImportError as e:
     )
 
 class PipelineRealESRGAN:
-    def __init__(self, model_path, tile=0, tile_pad=10, pre_pad=0, fp32=False):
+    def __init__(self, model_path, tile=0, tile_pad=10, pre_pad=0, fp32=False, device=None):
         model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+        # Older releases of realesrgan always pick the device themselves
+        kwargs = dict(device=device) if device is not None else {}
         self.upsampler = RealESRGANer(
             scale=4,
             model_path=model_path,
@@ -23,8 +33,12 @@ class PipelineRealESRGAN:
             tile=tile,
             tile_pad=tile_pad,
             pre_pad=pre_pad,
-            half=not fp32
+            half=not fp32,
+            **kwargs
         )
+        # RealESRGANer keeps the image being upsampled in attributes, so one upsampler shared between threads
+        # (e.g. through `get_upsampler`) runs one image or batch at a time
+        self._lock = threading.Lock()
 
     def __call__(self, image, outscale=4, convert_to_pil=True):
         """Upsample an image array or path.
@@ -38,24 +52,148 @@ class PipelineRealESRGAN:
         Returns:
             Union[np.ndarray, PIL.Image.Image]: An upsampled version of the input image.
         """
-        if isinstance(image, (str, Path)):
-            img = cv2.imread(image, cv2.IMREAD_UNCHANGED)
-        else:
-            img = image
-            img = (img * 255).round().astype("uint8")
-            img = img[:, :, ::-1]
+        img = self._to_bgr(image)
 
-        image, _ = self.upsampler.enhance(img, outscale=outscale)
+        with get_profiler().stage("upsample"):
+            image = self._enhance(img, outscale)
 
         if convert_to_pil:
             image = Image.fromarray(image[:, :, ::-1])
 
         return image
 
+    def upsample_batch(self, images, outscale=4, convert_to_pil=True):
+        """Upsample several images, running same-sized color images through the model together.
+
+        Gives the same results as calling the pipeline on each image, up to floating point differences. Images
+        with an alpha channel and grayscale or 16-bit images are upsampled one at a time, as are all images when
+        tiling is on (but without the round trips through numpy).
+
+        Args:
+            images (List[Union[np.ndarray, str]]): Images as accepted by `__call__`.
+            outscale (int, optional): Amount to upscale the images. Defaults to 4.
+            convert_to_pil (bool, optional): If True, return PIL images. Otherwise, return numpy arrays (BGR). Defaults to True.
+
+        Returns:
+            List[Union[np.ndarray, PIL.Image.Image]]: Upsampled versions of the input images.
+        """
+        outputs = self._upsample_bgr([self._to_bgr(image) for image in images], outscale)
+        if convert_to_pil:
+            outputs = [Image.fromarray(output[:, :, ::-1]) for output in outputs]
+        return outputs
+
+    def _upsample_bgr(self, imgs, outscale):
+        outputs = [None] * len(imgs)
+        groups = {}
+        for i, img in enumerate(imgs):
+            if self._can_batch(img):
+                groups.setdefault(img.shape, []).append(i)
+            else:
+                with get_profiler().stage("upsample"):
+                    outputs[i] = self._enhance(img, outscale)
+        for indices in groups.values():
+            with get_profiler().stage("upsample", batch_size=len(indices)):
+                for i, output in zip(indices, self._enhance_batch([imgs[i] for i in indices], outscale)):
+                    outputs[i] = output
+        return outputs
+
+    def _enhance(self, img, outscale):
+        with self._lock:
+            output, _ = self.upsampler.enhance(img, outscale=outscale)
+        return output
+
+    @staticmethod
+    def _to_bgr(image):
+        if isinstance(image, (str, Path)):
+            img = cv2.imread(str(image), cv2.IMREAD_UNCHANGED)
+            if img is None:
+                raise ValueError(f"Could not read image {image}")
+            return img
+        img = (image * 255).round().astype("uint8")
+        return img[:, :, ::-1]
+
+    def _can_batch(self, img):
+        upsampler = self.upsampler
+        return (
+            img.ndim == 3
+            and img.shape[2] == 3
+            and img.dtype == np.uint8
+            and upsampler.scale == 4  # other scales pad the input to a multiple of their own
+        )
+
+    def upsample_tensor(self, images, outscale=4):
+        """Upsample a batch of image tensors, without copying them to the host.
+
+        Inputs are quantized to 8 bits first, like the images the other methods take, so all of them give the
+        same results.
+
+        Example:
+            ```python
+            >>> images = pipeline('a cat', output_type='pt')['sample']
+            >>> upsampled = upsampler.upsample_tensor(images)
+            ```
+
+        Args:
+            images (torch.Tensor): RGB images of shape (batch_size, 3, height, width) with values in [0, 1], on any device.
+            outscale (int, optional): Amount to upscale the images. Other amounts than the model's 4 are resized
+                with bicubic interpolation, which is close to but not the same as the Lanczos resize of the other
+                methods. Defaults to 4.
+
+        Returns:
+            torch.FloatTensor: The upsampled images, on the upsampler's device, with values in [0, 1].
+        """
+        with get_profiler().stage("upsample", batch_size=images.shape[0]):
+            images = images.to(self.upsampler.device)
+            images = (images * 255).round_().float().div_(255)
+            output = self._forward(images)
+            if outscale is not None and outscale != float(self.upsampler.scale):
+                size = (int(images.shape[2] * outscale), int(images.shape[3] * outscale))
+                output = F.interpolate(output, size=size, mode="bicubic", align_corners=False, antialias=True)
+                output = output.clamp_(0, 1)
+        return output
+
+    @torch.no_grad()
+    def _forward(self, batch):
+        # The model stage of RealESRGANer.enhance for a batch of RGB images in [0, 1]: pad, upsample, crop, clamp
+        upsampler = self.upsampler
+        batch = batch.to(upsampler.device, torch.float16 if upsampler.half else torch.float32)
+        if upsampler.pre_pad != 0:
+            batch = F.pad(batch, (0, upsampler.pre_pad, 0, upsampler.pre_pad), "reflect")
+        with self._lock:
+            if upsampler.tile_size > 0:
+                outputs = []
+                for image in batch.split(1):
+                    upsampler.img = image
+                    upsampler.tile_process()
+                    outputs.append(upsampler.output)
+                output = torch.cat(outputs)
+            else:
+                output = upsampler.model(batch)
+        if upsampler.pre_pad != 0:
+            crop = upsampler.pre_pad * upsampler.scale
+            output = output[:, :, : output.shape[2] - crop, : output.shape[3] - crop]
+        return output.float().clamp_(0, 1)
+
+    def _enhance_batch(self, imgs, outscale):
+        # RealESRGANer.enhance for a stack of uint8 BGR images of the same size
+        height, width = imgs[0].shape[:2]
+        batch = torch.from_numpy(np.stack(imgs)[..., ::-1].astype(np.float32) / 255).permute(0, 3, 1, 2)
+        output = self._forward(batch).cpu().numpy()
+        # Back to BGR and HWC
+        output = (np.transpose(output[:, [2, 1, 0]], (0, 2, 3, 1)) * 255.0).round().astype(np.uint8)
+
+        outputs = list(output)
+        if outscale is not None and outscale != float(self.upsampler.scale):
+            size = (int(width * outscale), int(height * outscale))
+            outputs = [cv2.resize(output, size, interpolation=cv2.INTER_LANCZOS4) for output in outputs]
+        return outputs
+
     @classmethod
-    def from_pretrained(cls, model_name_or_path='nateraw/real-esrgan'):
+    def from_pretrained(cls, model_name_or_path='nateraw/real-esrgan', **kwargs):
         """Initialize a pretrained Real-ESRGAN upsampler.
 
+        Use `get_upsampler` instead to share one loaded upsampler across calls.
+
         Example:
             ```python
             >>> from stable_diffusion_videos import PipelineRealESRGAN
@@ -65,6 +203,7 @@ class PipelineRealESRGAN:
 
         Args:
             model_name_or_path (str, optional): The Hugging Face repo ID or path to local model. Defaults to 'nateraw/real-esrgan'.
+            **kwargs: Passed on to `PipelineRealESRGAN`, i.e. `tile`, `tile_pad`, `pre_pad`, `fp32` and `device`.
 
         Returns:
             stable_diffusion_videos.PipelineRealESRGAN: An instance of `PipelineRealESRGAN` instantiated from pretrained model.
@@ -75,18 +214,62 @@ class PipelineRealESRGAN:
             file = model_name_or_path
         else:
             file = hf_hub_download(model_name_or_path, 'RealESRGAN_x4plus.pth')
-        return cls(file)
+        return cls(file, **kwargs)
 
 
-    def upsample_imagefolder(self, in_dir, out_dir, suffix='out', outfile_ext='.png'):
+    def upsample_imagefolder(
+        self,
+        in_dir,
+        out_dir,
+        suffix='out',
+        outfile_ext='.png',
+        batch_size=4,
+        num_workers=4,
+        overwrite=False,
+    ):
+        """Upsample every image of a folder.
+
+        Images are upsampled `batch_size` at a time (see `upsample_batch`). Reading and decoding the next batch,
+        and encoding and writing the previous ones, happen on thread pools while the model runs. Outputs are
+        written atomically, so after an interruption the same call picks up where it left off, skipping the
+        images whose output already exists.
+
+        Args:
+            in_dir (Union[str, Path]): Directory with the .png/.jpg/.jpeg images to upsample.
+            out_dir (Union[str, Path]): Directory to write the upsampled images to.
+            suffix (str, optional): Appended to each image's name (before the extension). Defaults to 'out'.
+            outfile_ext (str, optional): File extension, and so format, of the outputs. Defaults to '.png'.
+            batch_size (int, optional): Number of images run through the model together. Defaults to 4.
+            num_workers (int, optional): Number of threads reading and number of threads writing images. Defaults to 4.
+            overwrite (bool, optional): Upsample images whose output already exists again. Defaults to False.
+
+        Returns:
+            int: Number of images upsampled.
+        """
         in_dir, out_dir = Path(in_dir), Path(out_dir)
         if not in_dir.exists():
             raise FileNotFoundError(f"Provided input directory {in_dir} does not exist")
 
         out_dir.mkdir(exist_ok=True, parents=True)
-         
-        image_paths = [x for x in in_dir.glob('*') if x.suffix.lower() in ['.png', '.jpg', '.jpeg']]
-        for image in image_paths:
-            im = self(str(image))
-            out_filepath = out_dir / (image.stem + suffix + outfile_ext)
-            im.save(out_filepath)
+
+        image_paths = sorted(x for x in in_dir.glob('*') if x.suffix.lower() in ['.png', '.jpg', '.jpeg'])
+        if not overwrite:
+            image_paths = [x for x in image_paths if not (out_dir / (x.stem + suffix + outfile_ext)).exists()]
+        batches = [image_paths[i : i + batch_size] for i in range(0, len(image_paths), batch_size)]
+
+        # The writer's filename pattern is formatted with each image's name
+        frame_filename = "%s" + suffix.replace('%', '%%') + outfile_ext
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="upsample-reader") as readers:
+            with AsyncFrameWriter(out_dir, frame_filename, num_workers, max_queue_size=2 * batch_size, atomic=True) as writer:
+
+                def read(batch):
+                    return [readers.submit(self._to_bgr, path) for path in batch]
+
+                next_images = read(batches[0]) if batches else []
+                for i, batch in enumerate(batches):
+                    images = [future.result() for future in next_images]
+                    if i + 1 < len(batches):
+                        next_images = read(batches[i + 1])
+                    for path, image in zip(batch, self._upsample_bgr(images, outscale=4)):
+                        writer.write(path.stem, image[:, :, ::-1])
+        return len(image_paths)
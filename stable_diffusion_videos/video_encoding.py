@@ -0,0 +1,158 @@
+import math
+import os
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .profiling import get_profiler
+
+
+class VideoEncodingError(RuntimeError):
+    """Raised when segments of a video couldn't be encoded or joined.
+
+    Attributes:
+        failures (List[dict]): One entry per failed ffmpeg call, with its `segment` number (None for the join),
+            the `frames` range it covered, its `returncode` and the tail of its `stderr`.
+    """
+
+    def __init__(self, video_path, failures):
+        self.video_path = video_path
+        self.failures = failures
+        lines = [f"Could not encode {video_path}, {len(failures)} ffmpeg call(s) failed:"]
+        for failure in failures:
+            what = "joining the segments" if failure["segment"] is None else (
+                f"segment {failure['segment']} (frames {failure['frames'][0]}-{failure['frames'][1] - 1})"
+            )
+            lines.append(f"  {what}, exit status {failure['returncode']}: {failure['stderr']}")
+        super().__init__("\n".join(lines))
+
+
+def count_frames(frame_dir, frame_filename="frame%06d.png"):
+    """Number of consecutively numbered frames in `frame_dir`, starting at frame 0."""
+    frame_dir = Path(frame_dir)
+    num_frames = 0
+    while (frame_dir / (frame_filename % num_frames)).exists():
+        num_frames += 1
+    return num_frames
+
+
+def encode_video_segmented(
+    frame_dir,
+    video_path,
+    frame_filename="frame%06d.png",
+    fps=30,
+    num_frames=None,
+    codec="libx264",
+    crf=10,
+    preset="medium",
+    pix_fmt="yuv420p",
+    gop_size=250,
+    segment_frames=None,
+    num_workers=None,
+):
+    """Encode numbered frames into a video, in a single pass or several segments at a time.
+
+    By default the frames are encoded by a single ffmpeg process. With `segment_frames`, they are split into
+    segments of a whole number of GOPs (keyframe intervals), which are encoded by concurrent ffmpeg processes and
+    then joined with ffmpeg's concat demuxer without re-encoding. Every segment starts with a keyframe, as it would
+    with `gop_size` in a single pass, so the video should only differ from a single pass in the rate control
+    decisions around segment boundaries. The CPU threads are shared between the workers. Segmented encoding is
+    opt-in because the joins haven't been checked with every ffmpeg build and container: check that the frame
+    count and timestamps of a segmented video match a single pass before relying on it.
+
+    The video is written under a temporary name first, so an existing video at `video_path` stays playable until
+    it is replaced. If any segment fails, the others still finish, and a `VideoEncodingError` lists every failure.
+
+    Example:
+        ```python
+        >>> from stable_diffusion_videos import encode_video_segmented
+        >>> encode_video_segmented('dreams/my_run', 'dreams/my_run/my_run.mp4', crf=18, preset='fast')
+        >>> encode_video_segmented('dreams/my_run', 'dreams/my_run/my_run.mp4', segment_frames=500, num_workers=4)
+        ```
+
+    Args:
+        frame_dir (Union[str, Path]): Directory with the frames.
+        video_path (Union[str, Path]): Where to write the video.
+        frame_filename (str, optional): Filename pattern of the frames, formatted with the frame index. Defaults to "frame%06d.png".
+        fps (int, optional): Frames per second of the video. Defaults to 30.
+        num_frames (int, optional): Number of frames to encode, starting at frame 0. Defaults to every consecutively
+            numbered frame in `frame_dir`.
+        codec (str, optional): ffmpeg video codec. Defaults to "libx264".
+        crf (int, optional): Constant rate factor, lower is better quality. Defaults to 10.
+        preset (str, optional): Encoder preset, e.g. "veryfast" or "slow". None leaves the codec's default. Defaults to "medium".
+        pix_fmt (str, optional): Pixel format of the video. Defaults to "yuv420p".
+        gop_size (int, optional): Maximum number of frames between keyframes. Defaults to 250, x264's default.
+        segment_frames (int, optional): Frames per segment, rounded up to a multiple of `gop_size`. Defaults to
+            None, a single pass over all frames.
+        num_workers (int, optional): Number of segments encoded at once. Defaults to the number of CPUs, at most 8.
+
+    Returns:
+        str: Path to the video.
+    """
+    frame_dir = Path(frame_dir)
+    video_path = Path(video_path)
+    if num_frames is None:
+        num_frames = count_frames(frame_dir, frame_filename)
+    if num_frames == 0:
+        raise FileNotFoundError(f"No frames matching {frame_dir / frame_filename}")
+    cpus = os.cpu_count() or 1
+    num_workers = num_workers or min(cpus, 8)
+    if segment_frames is None:
+        segment_frames = num_frames
+    segment_frames = math.ceil(segment_frames / gop_size) * gop_size
+    segments = [(start, min(start + segment_frames, num_frames)) for start in range(0, num_frames, segment_frames)]
+    num_workers = min(num_workers, len(segments))
+    threads = max(cpus // num_workers, 1)
+
+    def encode(start, stop, path):
+        cmd = [
+            "ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps), "-start_number", str(start),
+            "-i", str(frame_dir / frame_filename), "-frames:v", str(stop - start),
+            "-vcodec", codec, "-crf", str(crf), "-g", str(gop_size), "-pix_fmt", pix_fmt,
+        ]
+        if preset is not None:
+            cmd += ["-preset", preset]
+        if num_workers > 1:
+            cmd += ["-threads", str(threads)]
+        with get_profiler().stage("video_encode", frames=stop - start):
+            return subprocess.run(cmd + [str(path)], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def failure(segment, frames, result):
+        stderr = result.stderr.decode("utf-8", errors="replace").strip().splitlines()
+        return dict(segment=segment, frames=frames, returncode=result.returncode, stderr=" | ".join(stderr[-3:]))
+
+    partial_path = video_path.with_name(f"partial_{video_path.name}")
+    if len(segments) == 1:
+        result = encode(0, num_frames, partial_path)
+        if result.returncode != 0:
+            partial_path.unlink(missing_ok=True)
+            raise VideoEncodingError(video_path, [failure(0, (0, num_frames), result)])
+        os.replace(partial_path, video_path)
+        return str(video_path)
+
+    # Segments are kept next to the video, a temporary directory on another filesystem could run out of space
+    with tempfile.TemporaryDirectory(prefix="segments_", dir=video_path.parent) as segment_dir:
+        segment_paths = [Path(segment_dir) / f"segment{i:04d}{video_path.suffix}" for i in range(len(segments))]
+        with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="video-encoder") as executor:
+            results = list(executor.map(lambda args: encode(*args), [(*s, p) for s, p in zip(segments, segment_paths)]))
+        failures = [failure(i, segments[i], result) for i, result in enumerate(results) if result.returncode != 0]
+        if failures:
+            raise VideoEncodingError(video_path, failures)
+
+        list_path = Path(segment_dir) / "segments.txt"
+        list_path.write_text("".join(f"file '{path.resolve().as_posix()}'\n" for path in segment_paths))
+        with get_profiler().stage("video_concat"):
+            result = subprocess.run(
+                [
+                    "ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", str(list_path),
+                    "-c", "copy", str(partial_path),
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+            )
+        if result.returncode != 0:
+            partial_path.unlink(missing_ok=True)
+            raise VideoEncodingError(video_path, [failure(None, (0, num_frames), result)])
+    os.replace(partial_path, video_path)
+    return str(video_path)
@@ -0,0 +1,89 @@
+from diffusers.schedulers import PNDMScheduler
+
+from .interpolation import interpolate_consecutive
+from .sampling import get_sampling_plan
+
+
+def get_warm_start_step(scheduler, num_inference_steps, warm_start):
+    """Index of the scheduler's timesteps from which warm started in-between frames are denoised.
+
+    Args:
+        scheduler: Scheduler of the walk.
+        num_inference_steps (int): Number of diffusion steps of the walk.
+        warm_start (float): Fraction of the denoising steps the keyframes' latents are taken after, in (0, 1).
+
+    Returns:
+        int: The step, at least 1 and before the last one.
+    """
+    if not 0 < warm_start < 1:
+        raise ValueError(f"`warm_start` has to be in (0, 1) but is {warm_start}")
+    if isinstance(scheduler, PNDMScheduler):
+        # Its Runge-Kutta warmup steps keep state that a call starting part of the way in doesn't have
+        raise ValueError("`warm_start` needs the 'ddim' or 'klms' scheduler")
+    num_timesteps = len(get_sampling_plan(scheduler, num_inference_steps).timesteps)
+    return min(max(int(round(warm_start * num_timesteps)), 1), num_timesteps - 1)
+
+
+class WarmStarter:
+    """Denoises in-between frames from the interpolation of their keyframes' partially denoised latents.
+
+    Keyframes are generated with `record_step=start_step`, which returns their latent at that step as
+    `"intermediate_latent"`. Their in-between frames then continue from the interpolation of those partial
+    latents (and of the text embeddings) for the remaining steps, instead of interpolating the final latents.
+
+    Args:
+        pipeline (StableDiffusionPipeline): Pipeline to denoise with.
+        memory_policy (MemoryPolicy): Runs the pipeline calls in chunks that fit in memory.
+        start_step (int): Index of the scheduler's timesteps to continue from, see `get_warm_start_step`.
+        latent_interpolation_steps (int): Number of frames per pair of keyframes, the keyframe included.
+        **call_kwargs: The other arguments of the keyframes' pipeline calls, i.e. `height`, `width`,
+            `guidance_scale`, `eta`, `num_inference_steps`, `scheduler`, `guidance_interval` and `guidance_every`.
+    """
+
+    def __init__(self, pipeline, memory_policy, start_step, latent_interpolation_steps, **call_kwargs):
+        self.pipeline = pipeline
+        self.memory_policy = memory_policy
+        self.start_step = start_step
+        self.latent_interpolation_steps = latent_interpolation_steps
+        self.call_kwargs = call_kwargs
+        self.num_frames = 0
+
+    def __call__(self, latents, partials, embeds, distinct):
+        """Replace the in-between `latents` of every pair of distinct keyframes by warm started ones.
+
+        `partials` and `embeds` hold the partial latent and text embeddings of each keyframe, `latents` the
+        in-between latents of each consecutive pair of them (see `interpolate_consecutive`). `distinct[i]` tells
+        whether the i-th pair differs, duplicated keyframes keep their (constant) interpolated latents.
+        """
+        pairs = [i for i, is_distinct in enumerate(distinct) if is_distinct]
+        per_pair = self.latent_interpolation_steps - 1
+        if not pairs or not per_pair:
+            return latents
+        latents = latents.view(len(distinct), per_pair, *latents.shape[1:])
+        inputs = interpolate_consecutive(partials, self.latent_interpolation_steps)
+        inputs = inputs.view(len(distinct), per_pair, *inputs.shape[1:])[pairs].flatten(0, 1)
+        inputs_embeds = interpolate_consecutive(embeds, self.latent_interpolation_steps)
+        inputs_embeds = inputs_embeds.view(len(distinct), per_pair, *inputs_embeds.shape[1:])[pairs].flatten(0, 1)
+        denoised = self.memory_policy(
+            self.pipeline,
+            latents=inputs,
+            text_embeddings=inputs_embeds,
+            output_type="latent",
+            start_step=self.start_step,
+            **self.call_kwargs,
+        )["latent"]
+        self.num_frames += inputs.shape[0]
+        latents[pairs] = denoised.view(len(pairs), per_pair, *latents.shape[2:]).to(latents.dtype)
+        return latents.flatten(0, 1)
+
+    def keyframe_partial(self, embeds, latents):
+        """Partial latent of a keyframe that was generated elsewhere (e.g. by another shard), denoised again."""
+        outputs = self.memory_policy(
+            self.pipeline,
+            latents=latents,
+            text_embeddings=embeds,
+            output_type="latent",
+            record_step=self.start_step,
+            **self.call_kwargs,
+        )
+        return outputs["intermediate_latent"]
@@ -0,0 +1,119 @@
+import pytest
+import torch
+from tiny_models import tiny_pipeline
+
+from stable_diffusion_videos.batch_sizing import MemoryPolicy
+from stable_diffusion_videos.stable_diffusion_walk import SCHEDULERS
+
+
+class OutOfMemoryAbove:
+    """Wraps a pipeline whose calls run out of memory with more than `max_images` images (attention sliced or not)."""
+
+    def __init__(self, pipeline, max_images, max_images_without_slicing=None):
+        self.pipeline = pipeline
+        if max_images_without_slicing is None:
+            max_images_without_slicing = max_images
+        self.max_images = max_images
+        self.max_images_without_slicing = max_images_without_slicing
+        self.calls = []  # (number of images, whether attention was sliced) of every call
+
+    def __getattr__(self, name):
+        return getattr(self.pipeline, name)
+
+    def __call__(self, latents, **kwargs):
+        sliced = self.pipeline.attention_slice_size is not None
+        self.calls.append((len(latents), sliced))
+        if len(latents) > (self.max_images if sliced else self.max_images_without_slicing):
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return self.pipeline(latents=latents, **kwargs)
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    pipeline = tiny_pipeline()
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+@pytest.fixture(scope="module")
+def inputs(pipeline):
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((6, 4, 8, 8), generator=generator)
+    text_embeddings = pipeline.embed_prompts(["a cat", "a dog", "a bird", "a fish", "a frog", "a horse"])
+    return dict(
+        latents=latents,
+        text_embeddings=text_embeddings,
+        height=64,
+        width=64,
+        num_inference_steps=3,
+        scheduler=SCHEDULERS["klms"],
+        output_type="latent",
+    )
+
+
+@pytest.fixture(scope="module")
+def unsplit(pipeline, inputs):
+    return pipeline(**inputs)["latent"]
+
+
+def chunked(pipeline, inputs, chunk_size):
+    latents, text_embeddings = inputs["latents"], inputs["text_embeddings"]
+    kwargs = {key: value for key, value in inputs.items() if key not in ("latents", "text_embeddings")}
+    outputs = []
+    for start in range(0, len(latents), chunk_size):
+        rows = slice(start, start + chunk_size)
+        outputs.append(pipeline(latents=latents[rows], text_embeddings=text_embeddings[rows], **kwargs)["latent"])
+    return torch.cat(outputs)
+
+
+def assert_matches_unsplit(latents, unsplit):
+    # The tiny UNet's latents grow into the hundreds, batch sizes round differently by a few parts in a million
+    torch.testing.assert_close(latents, unsplit, rtol=1e-5, atol=1e-3)
+
+
+def test_splits_and_retries_batches_that_run_out_of_memory(pipeline, inputs, unsplit):
+    fake = OutOfMemoryAbove(pipeline, max_images=2)
+    policy = MemoryPolicy(max_batch_size=6)
+    outputs = policy(fake, **inputs)
+    # 6 images fail, then 3, and 2 at a time is kept for the rest of the call
+    assert fake.calls == [(6, False), (3, False), (2, False), (2, False), (2, False)]
+    assert (policy.max_batch_size, policy.num_splits) == (2, 2)
+    assert not policy.attention_slicing
+    assert torch.equal(outputs["latent"], chunked(pipeline, inputs, 2))
+    assert_matches_unsplit(outputs["latent"], unsplit)
+    assert outputs["nsfw_content_detected"] == [False] * 3
+
+    # Later calls start from the smaller size
+    fake.calls.clear()
+    policy(fake, **inputs)
+    assert fake.calls == [(2, False)] * 3
+
+
+def test_slices_attention_when_a_single_image_runs_out_of_memory(pipeline, inputs, unsplit):
+    fake = OutOfMemoryAbove(pipeline, max_images=1, max_images_without_slicing=0)
+    policy = MemoryPolicy(max_batch_size=2)
+    outputs = policy(fake, **inputs)
+    assert fake.calls[:3] == [(2, False), (1, False), (1, True)]
+    assert fake.calls[3:] == [(1, True)] * 5
+    assert policy.attention_slicing and policy.max_batch_size == 1
+    assert_matches_unsplit(outputs["latent"], unsplit)
+    # Only the policy's own calls are sliced
+    assert pipeline.attention_slice_size is None
+
+
+def test_raises_what_slicing_doesnt_fix(pipeline, inputs):
+    with pytest.raises(RuntimeError, match="out of memory"):
+        MemoryPolicy(max_batch_size=2)(OutOfMemoryAbove(pipeline, max_images=0), **inputs)
+    assert pipeline.attention_slice_size is None
+
+
+def test_other_errors_are_not_retried(pipeline, inputs):
+    calls = []
+
+    def broken(latents, **kwargs):
+        calls.append(len(latents))
+        raise RuntimeError("shape mismatch")
+
+    with pytest.raises(RuntimeError, match="shape mismatch"):
+        MemoryPolicy(max_batch_size=4)(broken, **inputs)
+    assert calls == [4]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import torch
+from tiny_models import tiny_pipeline
+
+from stable_diffusion_videos.batching import ImageRequestBatcher
+from stable_diffusion_videos.stable_diffusion_walk import SCHEDULERS
+
+# Batches of different sizes round differently, the images are in [0, 1]
+ATOL = 1e-3
+REQUESTS = [("a cat", 1, 7.5), ("a dog", 2, 3.0), ("a bird", 3, 7.5)]
+SETTINGS = dict(height=64, width=64, num_inference_steps=3, output_type="numpy")
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    pipeline = tiny_pipeline()
+    pipeline.set_progress_bar_config(disable=True)
+    return pipeline
+
+
+def unbatched(pipeline, prompt, seed, guidance_scale):
+    # What the app does without a batcher
+    return pipeline(
+        prompt,
+        guidance_scale=guidance_scale,
+        generator=torch.Generator(device=pipeline.device).manual_seed(seed),
+        scheduler=SCHEDULERS["klms"],
+        **SETTINGS,
+    )["sample"][0]
+
+
+def test_batched_requests_match_unbatched_calls(pipeline):
+    batcher = ImageRequestBatcher(pipeline, max_batch_size=len(REQUESTS), max_wait_ms=10_000)
+    futures = [
+        batcher.submit(prompt, seed=seed, guidance_scale=guidance_scale, scheduler=SCHEDULERS["klms"], **SETTINGS)
+        for prompt, seed, guidance_scale in REQUESTS
+    ]
+    images = [future.result(timeout=60) for future in futures]
+    batcher.close()
+    assert batcher.batch_sizes == [len(REQUESTS)]
+    for image, request in zip(images, REQUESTS):
+        expected = unbatched(pipeline, *request)
+        assert image.shape == expected.shape
+        np.testing.assert_allclose(image, expected, rtol=0, atol=ATOL)
+
+
+def test_requests_with_other_settings_are_batched_apart(pipeline):
+    batcher = ImageRequestBatcher(pipeline, max_batch_size=4, max_wait_ms=10_000)
+    settings = [SETTINGS, dict(SETTINGS, num_inference_steps=2), SETTINGS, dict(SETTINGS, height=32)]
+    futures = [batcher.submit("a cat", seed=1, scheduler=SCHEDULERS["klms"], **kwargs) for kwargs in settings]
+    batcher.close()
+    images = [future.result(timeout=60) for future in futures]
+    assert sorted(batcher.batch_sizes) == [1, 1, 2]
+    np.testing.assert_array_equal(images[0], images[2])
+    assert images[3].shape == (32, 64, 3)
+
+
+def test_app_sets_the_progress_bar_before_batching(pipeline):
+    pytest.importorskip("gradio")
+    from stable_diffusion_videos.app import fn_images
+
+    batcher = ImageRequestBatcher(pipeline, max_batch_size=2, max_wait_ms=0)
+    pipeline.set_progress_bar_config(disable=False)
+    args = ("a cat", 1, "klms", 7.5, 3)
+    batched = fn_images(*args, disable_tqdm=True, upsample=False, pipeline=pipeline, batcher=batcher)
+    batcher.close()
+    assert pipeline._progress_bar_config == dict(disable=True)
+    unbatched = fn_images(*args, disable_tqdm=True, upsample=False, pipeline=pipeline)
+    np.testing.assert_allclose(np.asarray(batched), np.asarray(unbatched), rtol=0, atol=1)
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from stable_diffusion_videos.memory import is_out_of_memory, relieve_memory_pressure, to_device
+
+
+def test_to_device_keeps_tensors_on_their_device():
+    tensor = torch.randn(3, 4)
+    assert to_device(tensor, "cpu") is tensor
+    assert not relieve_memory_pressure("cpu")
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs a GPU")
+def test_to_device_copies_to_the_gpu_through_pinned_memory():
+    tensor = torch.randn(3, 4)
+    copied = to_device(tensor, "cuda")
+    assert copied.device.type == "cuda"
+    assert torch.equal(copied.cpu(), tensor)
+    assert not tensor.is_pinned()
+
+
+def test_is_out_of_memory():
+    assert is_out_of_memory(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert is_out_of_memory(RuntimeError("[enforce fail at alloc_cpu.cpp:75] DefaultCPUAllocator: can't allocate memory"))
+    assert is_out_of_memory(MemoryError())
+    assert not is_out_of_memory(RuntimeError("shape mismatch"))
@@ -0,0 +1,70 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from stable_diffusion_videos.registry import ModelCache
+
+
+def blocking_load(model, started, release):
+    # Loads `model` once `release` is set
+    def load():
+        started.set()
+        assert release.wait(timeout=10)
+        return model
+
+    return load
+
+
+def test_same_key_loads_once():
+    cache = ModelCache()
+    loads = []
+
+    def load():
+        loads.append(threading.get_ident())
+        time.sleep(0.1)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        models = list(executor.map(lambda _: cache.get("a", load), range(4)))
+    assert len(loads) == 1
+    assert all(model is models[0] for model in models)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_loading_doesnt_block_other_keys():
+    cache = ModelCache()
+    cached = cache.get("cached", lambda: "cached model")
+    started, release = threading.Event(), threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        loading = executor.submit(cache.get, "slow", blocking_load("slow model", started, release))
+        assert started.wait(timeout=10)
+        # Both a hit and another key's load go through while "slow" is still loading
+        assert cache.get("cached", lambda: pytest.fail("cached model loaded again")) is cached
+        assert cache.get("other", lambda: "other model") == "other model"
+        assert not loading.done()
+        release.set()
+        assert loading.result(timeout=10) == "slow model"
+    assert "slow" in cache
+
+
+def test_failed_load_can_be_retried():
+    cache = ModelCache()
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    with pytest.raises(RuntimeError):
+        cache.get("a", fail)
+    assert "a" not in cache
+    assert cache.get("a", lambda: "model") == "model"
+
+
+def test_evicts_least_recently_used():
+    cache = ModelCache(max_entries=2)
+    for key in "abc":
+        cache.get(key, lambda: key)
+        if key == "b":
+            cache.get("a", lambda: pytest.fail("a loaded again"))
+    assert "b" not in cache and "a" in cache and "c" in cache
@@ -0,0 +1,34 @@
+import torch
+from diffusers.schedulers import DDIMScheduler, LMSDiscreteScheduler
+
+from stable_diffusion_videos.sampling import get_sampling_plan
+
+
+def klms(beta_end=0.012):
+    return LMSDiscreteScheduler(beta_start=0.00085, beta_end=beta_end, beta_schedule="scaled_linear")
+
+
+def test_equally_configured_schedulers_share_a_plan():
+    scheduler = klms()
+    plan = get_sampling_plan(scheduler, 10)
+    assert get_sampling_plan(klms(), 10) is plan
+    assert plan.scheduler is not scheduler
+    assert get_sampling_plan(klms(beta_end=0.02), 10) is not plan
+    assert get_sampling_plan(scheduler, 10, strength=0.5) is not plan
+
+
+def test_plan_ignores_the_state_of_the_scheduler():
+    expected = get_sampling_plan(klms(), 10).timesteps.clone()
+    # A scheduler that was stepped through another number of steps before
+    scheduler = klms()
+    scheduler.set_timesteps(25)
+    plan = get_sampling_plan(scheduler, 10)
+    assert torch.equal(torch.as_tensor(plan.timesteps), torch.as_tensor(expected))
+    assert len(scheduler.timesteps) == 25
+
+
+def test_trained_betas_are_part_of_the_key():
+    betas = torch.linspace(1e-4, 2e-2, 1000).tolist()
+    plan = get_sampling_plan(DDIMScheduler(trained_betas=betas), 10)
+    assert get_sampling_plan(DDIMScheduler(trained_betas=list(betas)), 10) is plan
+    assert get_sampling_plan(DDIMScheduler(), 10) is not plan
@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+from tiny_models import tiny_pipeline
+
+from stable_diffusion_videos.seed_sweep import choose_seeds, sweep_seeds
+from stable_diffusion_videos.stable_diffusion_walk import walk
+
+PROMPTS = ["a cat", "a dog"]
+SEEDS = [3, 5, 7]
+SETTINGS = dict(height=64, width=64, guidance_scale=7.5, eta=0.0, num_inference_steps=3, scheduler="klms")
+
+
+@pytest.fixture
+def sweep(tmp_path):
+    # Batches of 4 mix the prompts' seeds
+    record = sweep_seeds(
+        PROMPTS,
+        SEEDS,
+        output_dir=tmp_path,
+        name="sweep",
+        batch_size=4,
+        pipeline=tiny_pipeline(),
+        thumbnail_size=32,
+        disable_tqdm=True,
+        **SETTINGS,
+    )
+    return tmp_path, record
+
+
+def test_sweep_layout(sweep):
+    output_dir, record = sweep
+    sweep_path = output_dir / "sweep"
+    assert sorted(path.name for path in sweep_path.iterdir()) == ["prompt000", "prompt001", "sweep.json"]
+    for prompt_index in range(len(PROMPTS)):
+        prompt_path = sweep_path / f"prompt{prompt_index:03d}"
+        assert sorted(path.name for path in prompt_path.iterdir()) == [
+            "contact_sheet.jpg", "seed3.png", "seed5.png", "seed7.png"
+        ]
+        assert Image.open(prompt_path / "seed3.png").size == (64, 64)
+        # 3 thumbnails in a 2x2 grid
+        assert Image.open(prompt_path / "contact_sheet.jpg").size == (64, 64)
+
+    assert json.loads((sweep_path / "sweep.json").read_text()) == record
+    assert record["settings"] == SETTINGS
+    assert record["seeds"] == SEEDS
+    assert record["prompts"][1] == dict(
+        prompt="a dog",
+        contact_sheet="prompt001/contact_sheet.jpg",
+        images={"3": "prompt001/seed3.png", "5": "prompt001/seed5.png", "7": "prompt001/seed7.png"},
+        chosen_seed=None,
+    )
+
+
+def test_choose_seeds(sweep):
+    output_dir, _ = sweep
+    with pytest.raises(ValueError, match="No seed chosen"):
+        choose_seeds(output_dir, "sweep")
+    with pytest.raises(ValueError, match="wasn't part of the sweep"):
+        choose_seeds(output_dir, "sweep", choices=[3, 4])
+    with pytest.raises(ValueError, match="2 prompts"):
+        choose_seeds(output_dir, "sweep", choices=[3])
+
+    assert choose_seeds(output_dir, "sweep", choices=[7, 3]) == dict(prompts=PROMPTS, seeds=[7, 3], **SETTINGS)
+    # Changing one choice keeps the other, and the choices are recorded
+    assert choose_seeds(output_dir, "sweep", choices={1: 5})["seeds"] == [7, 5]
+    assert choose_seeds(output_dir, "sweep")["seeds"] == [7, 5]
+    record = json.loads((output_dir / "sweep" / "sweep.json").read_text())
+    assert [entry["chosen_seed"] for entry in record["prompts"]] == [7, 5]
+
+
+def test_walk_starts_from_the_chosen_images(sweep):
+    output_dir, _ = sweep
+    walk_kwargs = choose_seeds(output_dir, "sweep", choices=[5, 7])
+    walk(
+        **walk_kwargs,
+        num_steps=2,
+        latent_interpolation_steps=0,
+        output_dir=output_dir,
+        name="walk",
+        pipeline=tiny_pipeline(),
+        disable_tqdm=True,
+    )
+    frames = sorted((output_dir / "walk").glob("frame*.png"))
+    for frame, image in zip([frames[0], frames[-1]], ["prompt000/seed5.png", "prompt001/seed7.png"]):
+        # Up to rounding between the sweep's and the walk's batch sizes
+        expected = np.asarray(Image.open(output_dir / "sweep" / image), dtype=float)
+        np.testing.assert_allclose(np.asarray(Image.open(frame), dtype=float), expected, atol=2)
@@ -0,0 +1,92 @@
+import hashlib
+import json
+import time
+
+import pytest
+from tiny_models import tiny_pipeline
+
+from stable_diffusion_videos.sharding import _merge_shards, walk_sharded
+from stable_diffusion_videos.stable_diffusion_walk import walk
+
+# Long enough for every worker to have loaded its pipeline before the first one is done
+UNET_DELAY = 0.3
+WALK_KWARGS = dict(
+    prompts=["a cat", "a dog", "a bird"],
+    seeds=[1, 2, 3],
+    num_steps=4,
+    height=64,
+    width=64,
+    num_inference_steps=3,
+    decode_chunk_size=64,
+    disable_tqdm=True,
+)
+
+
+def slow_tiny_pipeline(device="cpu"):
+    # Picklable factory for the workers, with a UNet slow enough for the shards' run times to be comparable
+    pipeline = tiny_pipeline(device=device)
+    forward = pipeline.unet.forward
+
+    def slow_forward(*args, **kwargs):
+        time.sleep(UNET_DELAY)
+        return forward(*args, **kwargs)
+
+    pipeline.unet.forward = slow_forward
+    return pipeline
+
+
+def frame_hashes(path):
+    return {frame.name: hashlib.md5(frame.read_bytes()).hexdigest() for frame in sorted(path.glob("frame*.png"))}
+
+
+def test_shards_run_concurrently_and_match_walk(tmp_path):
+    walk(pipeline=tiny_pipeline(), output_dir=tmp_path, name="single", **WALK_KWARGS)
+    walk_sharded(
+        num_workers=2, devices=["cpu"], pipeline_factory=slow_tiny_pipeline, output_dir=tmp_path, name="sharded", **WALK_KWARGS
+    )
+
+    single, sharded = frame_hashes(tmp_path / "single"), frame_hashes(tmp_path / "sharded")
+    assert single
+    assert sharded == single
+
+    timings = json.loads((tmp_path / "sharded" / "plan_report.json").read_text())["shard_timings"]
+    assert len(timings) == 2
+    first, second = (timing["batch_times"] for timing in timings)
+    assert len(first) > 1 and len(second) > 1
+    # The second worker gets past its first batch while the first one is still generating, instead of waiting
+    # for the first one's last keyframe
+    assert second[1][0] < first[-1][1]
+    assert timings[0]["handoff_wait_s"] == 0
+    assert timings[1]["handoff_wait_s"] < UNET_DELAY * WALK_KWARGS["num_inference_steps"] * len(first)
+
+
+def write_shard(path, frames, executed_batches=1):
+    path.mkdir(parents=True)
+    for frame in frames:
+        (path / f"frame{frame:06d}.png").write_bytes(b"")
+    report = dict(executed_batches=executed_batches, batch_times=[[0.0, 1.0]], handoff_wait_s=0.0)
+    (path / "plan_report.json").write_text(json.dumps(report))
+
+
+def test_merge_shards(tmp_path):
+    write_shard(tmp_path / "shards" / "0", range(0, 3), executed_batches=2)
+    write_shard(tmp_path / "shards" / "1", range(3, 5), executed_batches=3)
+    executed_batches, timings = _merge_shards(tmp_path / "shards", 2, tmp_path, 5, ".png")
+    assert executed_batches == 5
+    assert len(timings) == 2
+    assert sorted(path.name for path in tmp_path.glob("frame*.png")) == [f"frame{i:06d}.png" for i in range(5)]
+
+
+@pytest.mark.parametrize(
+    "frames, message",
+    [
+        ([range(0, 3), range(4, 5)], r"1 frame\(s\) missing, e.g. frame 3$"),
+        ([range(0, 3), range(3, 7)], r"2 frame\(s\) beyond the last one \(4\), e.g. frame 5$"),
+        ([range(0, 2), range(3, 6)], r"1 frame\(s\) missing, e.g. frame 2; 1 frame\(s\) beyond the last one"),
+    ],
+)
+def test_merge_shards_reports_missing_and_extra_frames(tmp_path, frames, message):
+    for index, shard_frames in enumerate(frames):
+        write_shard(tmp_path / "shards" / str(index), shard_frames)
+    with pytest.raises(RuntimeError, match=message):
+        _merge_shards(tmp_path / "shards", len(frames), tmp_path, 5, ".png")
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import torch
+
+from stable_diffusion_videos.stable_diffusion_walk import slerp
+
+DOT_THRESHOLD = 0.9995
+TS = np.linspace(0, 1, 7)
+
+
+def reference_slerp(t, v0, v1, DOT_THRESHOLD=DOT_THRESHOLD):
+    # The NumPy implementation `slerp` had before it ran on the tensors' device, for a single `t`
+    dot = np.sum(v0 * v1 / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+    if np.abs(dot) > DOT_THRESHOLD:
+        v2 = (1 - t) * v0 + t * v1
+    else:
+        theta_0 = np.arccos(dot)
+        sin_theta_0 = np.sin(theta_0)
+        theta_t = theta_0 * t
+        sin_theta_t = np.sin(theta_t)
+        s0 = np.sin(theta_0 - theta_t) / sin_theta_0
+        s1 = sin_theta_t / sin_theta_0
+        v2 = s0 * v0 + s1 * v1
+    return v2
+
+
+def pair(kind, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    v0 = torch.randn((1, 4, 8, 8), generator=generator)
+    noise = torch.randn((1, 4, 8, 8), generator=generator)
+    if kind == "random":
+        return v0, noise
+    if kind == "near_parallel":
+        return v0, v0 + 1e-3 * noise
+    if kind == "antiparallel":
+        return v0, -v0
+    raise ValueError(kind)
+
+
+def cosine(v0, v1):
+    return float(np.sum(v0 * v1) / (np.linalg.norm(v0) * np.linalg.norm(v1)))
+
+
+@pytest.mark.parametrize("kind", ["random", "near_parallel", "antiparallel"])
+def test_pairs_cover_both_branches(kind):
+    v0, v1 = pair(kind)
+    takes_lerp_branch = abs(cosine(v0.numpy(), v1.numpy())) > DOT_THRESHOLD
+    assert takes_lerp_branch == (kind != "random")
+
+
+@pytest.mark.parametrize("kind", ["random", "near_parallel", "antiparallel"])
+def test_torch_float32_matches_numpy_reference(kind):
+    v0, v1 = pair(kind)
+    expected = np.stack([reference_slerp(t, v0.numpy(), v1.numpy()) for t in TS.astype(np.float32)])
+
+    batched = slerp(TS, v0, v1)
+    assert batched.dtype == torch.float32
+    assert batched.shape == (len(TS), *v0.shape)
+    np.testing.assert_allclose(batched.numpy(), expected, rtol=1e-5, atol=1e-5)
+    for t, row in zip(TS, expected):
+        np.testing.assert_allclose(slerp(float(t), v0, v1).numpy(), row, rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize("kind", ["random", "near_parallel", "antiparallel"])
+def test_torch_float16_matches_numpy_reference(kind):
+    # Half precision inputs are interpolated in float32 and rounded once, so compare with the reference in
+    # float64 on the same (rounded) inputs, within float16 resolution
+    v0, v1 = (v.half() for v in pair(kind))
+    expected = np.stack([reference_slerp(t, v0.double().numpy(), v1.double().numpy()) for t in TS])
+
+    batched = slerp(TS, v0, v1)
+    assert batched.dtype == torch.float16
+    np.testing.assert_allclose(batched.double().numpy(), expected, rtol=2e-3, atol=2e-3)
+
+
+@pytest.mark.parametrize("kind", ["random", "near_parallel", "antiparallel"])
+def test_numpy_inputs_match_reference(kind):
+    v0, v1 = (v.numpy() for v in pair(kind))
+    expected = np.stack([reference_slerp(t, v0, v1) for t in TS.astype(np.float32)])
+    np.testing.assert_allclose(slerp(TS, v0, v1), expected, rtol=1e-5, atol=1e-5)
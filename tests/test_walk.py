@@ -0,0 +1,131 @@
+import json
+
+import pytest
+from tiny_models import tiny_pipeline
+
+from stable_diffusion_videos import stable_diffusion_walk
+from stable_diffusion_videos.stable_diffusion_walk import walk
+
+WALK = dict(
+    prompts=["a cat", "a dog", "a bird"],
+    seeds=[1, 2, 3],
+    num_steps=4,
+    height=64,
+    width=64,
+    num_inference_steps=4,
+    latent_interpolation_steps=3,
+    decode_chunk_size=64,
+    disable_tqdm=True,
+)
+
+
+@pytest.fixture(scope="module")
+def pipeline():
+    return tiny_pipeline()
+
+
+def read_frames(run_path):
+    return [path.read_bytes() for path in sorted(run_path.glob("frame*.png"))]
+
+
+def test_encode_kwargs_reach_the_encoder(pipeline, tmp_path, monkeypatch):
+    calls = []
+
+    def make_video_ffmpeg(frame_dir, output_file_name, **kwargs):
+        calls.append(kwargs)
+        return str(frame_dir / output_file_name)
+
+    monkeypatch.setattr(stable_diffusion_walk, "make_video_ffmpeg", make_video_ffmpeg)
+    encode_kwargs = dict(segment_frames=4, num_workers=2, crf=18)
+    video_path = walk(
+        pipeline=pipeline, output_dir=tmp_path, name="run", make_video=True, encode_kwargs=encode_kwargs, **WALK
+    )
+    # Encoded from the saved frames, not streamed (which would have started ffmpeg during the walk)
+    assert video_path == str(tmp_path / "run" / "run.mp4")
+    assert calls == [dict(fps=30, frame_filename="frame%06d.png", **encode_kwargs)]
+    assert read_frames(tmp_path / "run")
+
+
+def test_resume_calibrates_when_the_config_has_no_batch_size(pipeline, tmp_path, monkeypatch):
+    walk(pipeline=pipeline, output_dir=tmp_path, name="full", batch_size=2, **WALK)
+    # A run whose config was written before batch sizes were recorded, and that has no manifest
+    old_path = tmp_path / "old"
+    old_path.mkdir()
+    config = json.loads((tmp_path / "full" / "prompt_config.json").read_text())
+    del config["batch_size"]
+    (old_path / "prompt_config.json").write_text(json.dumps(config))
+
+    calibrations = []
+
+    def calibrate_batch_size(pipeline, height, width, guidance_scale, scheduler):
+        calibrations.append((height, width))
+        return 2
+
+    monkeypatch.setattr(stable_diffusion_walk, "calibrate_batch_size", calibrate_batch_size)
+    walk(
+        pipeline=pipeline,
+        output_dir=tmp_path,
+        name="old",
+        resume=True,
+        batch_size="auto",
+        decode_chunk_size=64,
+        disable_tqdm=True,
+    )
+    assert calibrations == [(64, 64)]
+    assert read_frames(old_path) == read_frames(tmp_path / "full")
+
+
+def test_progressive_walk_makes_the_frames_of_a_linear_walk(pipeline, tmp_path):
+    walk(pipeline=pipeline, output_dir=tmp_path, name="linear", batch_size=2, **WALK)
+    # Without previews, which would need ffmpeg
+    walk(pipeline=pipeline, output_dir=tmp_path, name="progressive", batch_size=2, progressive=True, preview_fps=0, **WALK)
+    linear = read_frames(tmp_path / "linear")
+    assert len(linear) > WALK["num_steps"]
+    assert read_frames(tmp_path / "progressive") == linear
+
+
+class Crash(Exception):
+    pass
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(batch_size=2),
+        dict(batch_size=1, strength=0.7, scheduler="ddim"),
+        dict(batch_size=2, latent_interpolation_steps=0, do_loop=True),
+        dict(batch_size=2, warm_start=0.5, scheduler="ddim"),
+    ],
+    ids=["plain", "chain", "loop", "warm_start"],
+)
+def test_resumed_walk_makes_the_frames_of_an_uninterrupted_one(pipeline, tmp_path, kwargs):
+    walk_kwargs = dict(WALK, **kwargs)
+    forward, calls, crash_at = pipeline.unet.forward, [], None
+
+    def counting_forward(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == crash_at:
+            raise Crash
+        return forward(*args, **kwargs)
+
+    pipeline.unet.forward = counting_forward
+    try:
+        walk(pipeline=pipeline, output_dir=tmp_path, name="full", **walk_kwargs)
+        full_calls = len(calls)
+        calls.clear()
+        crash_at = 7
+        # Interrupt the run part of the way through, in the middle of a batch
+        with pytest.raises(Crash):
+            walk(pipeline=pipeline, output_dir=tmp_path, name="run", **walk_kwargs)
+        full = read_frames(tmp_path / "full")
+        assert 0 < len(read_frames(tmp_path / "run")) < len(full)
+
+        # Everything else comes from the run's config
+        calls.clear()
+        crash_at = None
+        walk(pipeline=pipeline, output_dir=tmp_path, name="run", resume=True, decode_chunk_size=64, disable_tqdm=True)
+    finally:
+        del pipeline.unet.forward
+    assert read_frames(tmp_path / "run") == full
+    # The finished batches weren't generated again
+    assert len(calls) < full_calls
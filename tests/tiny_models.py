@@ -0,0 +1,92 @@
+"""Tiny, randomly initialised stand-ins for the Stable Diffusion models, for the tests and benchmarks on CPU.
+
+They have the same architecture as the real models (so every code path of the pipeline runs) but only
+a few thousand parameters each, and need no download or auth token. Outputs are noise, of course.
+
+    >>> from tiny_models import tiny_pipeline
+    >>> pipe = tiny_pipeline()
+    >>> pipe('a cat', height=64, width=64, num_inference_steps=4)
+"""
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+from diffusers.models import AutoencoderKL, UNet2DConditionModel
+from diffusers.schedulers import PNDMScheduler
+from PIL import Image
+from transformers import CLIPFeatureExtractor, CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+from stable_diffusion_videos.stable_diffusion_pipeline import NoCheck, StableDiffusionPipeline
+
+
+def tiny_tokenizer():
+    """A byte-level CLIP tokenizer without merges (every character is a token)."""
+    vocab_dir = tempfile.mkdtemp(prefix="tiny_clip_tokenizer_")
+    chars = list(bytes_to_unicode().values())
+    vocab = chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab_file, merges_file = os.path.join(vocab_dir, "vocab.json"), os.path.join(vocab_dir, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def tiny_pipeline(seed=0, device="cpu"):
+    """A `StableDiffusionPipeline` built from tiny, randomly initialised models."""
+    torch.manual_seed(seed)
+    tokenizer = tiny_tokenizer()
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=len(tokenizer.encoder),
+            hidden_size=32,
+            intermediate_size=37,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=77,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+    )
+    # The weights only depend on the seed, so the embedding cache can tell encoders apart by it
+    text_encoder.config._name_or_path = f"tiny-clip-text-encoder-seed{seed}"
+    unet = UNet2DConditionModel(
+        sample_size=8,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=8,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=1,
+    )
+    scheduler = PNDMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear")
+    return StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=NoCheck(),
+        feature_extractor=CLIPFeatureExtractor(),
+    ).to(device)
+
+
+class NearestUpsampler:
+    """Stand-in for `PipelineRealESRGAN`: upsamples a HWC float image in [0, 1] by repeating pixels."""
+
+    def __init__(self, scale=4):
+        self.scale = scale
+
+    def __call__(self, image):
+        image = (image * 255).round().astype(np.uint8)
+        return Image.fromarray(image.repeat(self.scale, axis=0).repeat(self.scale, axis=1))